@@ -19,7 +19,7 @@ def create_message(from_, body):
 
 cache = []
 cache_size = 200
-waiters = []
+channel = server.Channel()
 
 @app.route('/')
 def index():
@@ -27,16 +27,10 @@ def index():
 
 @app.route('/a/message/updates', methods=['POST'])
 def message_update():
-    global cache, waiters
-    c = request.environ.get(middleware.CONTINUATION_KEY, None)
+    global cache
     cursor = session.get('cursor')
     if not cache or cursor == cache[-1]['id']:
-        waiters.append(c)
-        try:
-            c.suspend(60)
-        except:
-            waiters.remove(c)
-            raise
+        channel.wait(60)
 
 
     assert cursor != cache[-1]['id'], cursor
@@ -54,7 +48,7 @@ def message_update():
     
 @app.route('/a/message/new', methods=['POST'])
 def message_new():
-    global cache, cache_size, waiters
+    global cache, cache_size
     name = request.environ.get('REMOTE_ADDR') or 'Anonymous'
     forwarded_for = request.environ.get('HTTP_X_FORWARDED_FOR')
     if forwarded_for and name == '127.0.0.1':
@@ -64,9 +58,7 @@ def message_new():
     if len(cache) > cache_size:
         cache = cache[-cache_size:]
 
-    for c in waiters:
-        c.resume()
-    waiters = []
+    channel.publish()
     return jsonify(msg)
     
 
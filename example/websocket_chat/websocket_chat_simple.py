@@ -32,9 +32,8 @@ def websocket_handle(environ, start_response):
             print "recv msg %s" % m
             if m is None:
                 break
-            for p in participants:
-                print "send message %s" % m
-                p.send(m)
+            print "send message %s" % m
+            websocket.broadcast(participants, m)
     finally:
         participants.remove(ws)
     return [""]
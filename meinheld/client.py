@@ -0,0 +1,428 @@
+"""Cooperative HTTP/1.1 client.
+
+Responses are parsed by the bundled C http_parser (server.ResponseParser),
+read straight from the socket into a buffer reused by every response of
+the connection. Connections are kept alive in a per host pool and
+requests can be pipelined on one connection.
+
+    from meinheld import client
+    res = client.get('http://127.0.0.1:8000/')
+    body = res.read()
+"""
+from __future__ import absolute_import
+
+import errno
+import os
+import socket
+import urlparse
+from collections import deque
+from httplib import responses
+
+from meinheld import server
+
+__all__ = ['Connection', 'ConnectionPool', 'ConnectionClosed', 'Response',
+           'request', 'get', 'post', 'pipeline']
+
+_CHUNK_SIZE = 65536
+_CONNECTING = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN)
+_WOULDBLOCK = (errno.EAGAIN, errno.EWOULDBLOCK)
+# safe to send again on a new connection when a kept alive one was closed
+_IDEMPOTENT = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE', 'TRACE'])
+
+
+class ConnectionClosed(IOError):
+    """the connection was closed before the responses of requests sent on it,
+    requests is a list of (method, path)"""
+
+    def __init__(self, requests):
+        self.requests = requests
+        super(ConnectionClosed, self).__init__(
+            'connection closed before the response of %s' %
+            ', '.join('%s %s' % r for r in requests))
+
+
+class Response(object):
+
+    def __init__(self, conn, method, status, version, headers):
+        self._conn = conn
+        self._parser = conn._parser
+        self.method = method
+        self.status = status
+        self.version = version
+        self.reason = responses.get(status, '')
+        self.header_items = headers
+        self.headers = _header_dict(headers)
+        self._released = False
+        self._rest = None
+        self._check_complete()
+
+    @property
+    def complete(self):
+        return self._released
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+
+    def read(self, size=-1):
+        if self._released:
+            return self._read_rest(size)
+        data = self._parser.read(size)
+        self._check_complete()
+        return data
+
+    def readinto(self, b):
+        if self._released:
+            data = self._read_rest(len(b))
+            n = len(data)
+            b[:n] = data
+            return n
+        n = self._parser.readinto(b)
+        self._check_complete()
+        return n
+
+    def _read_rest(self, size):
+        data = self._rest
+        if size is None or size < 0 or size >= len(data):
+            self._rest = ''
+            return data
+        self._rest = data[size:]
+        return data[:size]
+
+    def __iter__(self):
+        while True:
+            data = self.read(_CHUNK_SIZE)
+            if not data:
+                return
+            yield data
+
+    def close(self):
+        """read the rest of the body to reuse the connection"""
+        if self._released:
+            return
+        try:
+            while self._parser.read(_CHUNK_SIZE):
+                pass
+        except (IOError, socket.error):
+            self._conn.close()
+            self._released = True
+            self._rest = ''
+            return
+        self._check_complete()
+
+    def _check_complete(self):
+        if not self._released and self._parser.complete:
+            # the body is buffered, the connection goes to the next response
+            self._rest = self._parser.read()
+            self._released = True
+            self._conn._response_done(self)
+
+
+class Connection(object):
+    """one keep-alive connection, responses are read in request order"""
+
+    def __init__(self, host, port=80, timeout=None, pool=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.sock = None
+        self.requests = 0
+        self._parser = None
+        self._pending = deque()
+        self._unanswered = []
+        self._response = None
+        self._pool = pool
+
+    @property
+    def reusable(self):
+        return (self.sock is not None and self._parser.keep_alive
+                and not self._pending and self._response is None)
+
+    def connect(self):
+        err = None
+        for family, socktype, proto, _, addr in socket.getaddrinfo(
+                self.host, self.port, 0, socket.SOCK_STREAM):
+            sock = socket.socket(family, socktype, proto)
+            try:
+                self._connect(sock, addr)
+            except socket.error as e:
+                sock.close()
+                err = e
+                continue
+            self.sock = sock
+            self._parser = server.ResponseParser(sock)
+            self._unanswered = []
+            self._parser.timeout = self._int_timeout()
+            return
+        if err is None:
+            err = socket.error('getaddrinfo returns an empty list')
+        raise err
+
+    def _int_timeout(self):
+        if not self.timeout:
+            return 0
+        return max(1, int(self.timeout))
+
+    def _connect(self, sock, addr):
+        sock.setblocking(False)
+        if sock.family in (socket.AF_INET, socket.AF_INET6):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        err = sock.connect_ex(addr)
+        if err in _CONNECTING:
+            server.trampoline(sock.fileno(), write=True, timeout=self._int_timeout())
+            err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            raise socket.error(err, os.strerror(err))
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        self._parser = None
+        # get_response() reports the requests the server did not answer
+        self._unanswered = list(self._pending)
+        self._pending.clear()
+        self._response = None
+
+    def _sendall(self, data):
+        sock = self.sock
+        view = memoryview(data)
+        while view:
+            try:
+                n = sock.send(view)
+            except socket.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                if e.args[0] not in _WOULDBLOCK:
+                    raise
+                server.trampoline(sock.fileno(), write=True, timeout=self._int_timeout())
+                continue
+            view = view[n:]
+
+    def _format(self, method, path, body, headers):
+        lines = ['%s %s HTTP/1.1' % (method, path)]
+        names = set()
+        if headers:
+            if hasattr(headers, 'iteritems'):
+                headers = headers.iteritems()
+            for name, value in headers:
+                names.add(name.lower())
+                lines.append('%s: %s' % (name, value))
+        if 'host' not in names:
+            if self.port == 80:
+                lines.append('Host: %s' % self.host)
+            else:
+                lines.append('Host: %s:%d' % (self.host, self.port))
+        chunked = False
+        if body is not None and 'content-length' not in names:
+            if isinstance(body, str):
+                lines.append('Content-Length: %d' % len(body))
+            else:
+                chunked = True
+                lines.append('Transfer-Encoding: chunked')
+        elif body is None and method in ('POST', 'PUT', 'PATCH') and 'content-length' not in names:
+            lines.append('Content-Length: 0')
+        lines.append('\r\n')
+        return '\r\n'.join(lines), chunked
+
+    def send_request(self, method, path, body=None, headers=None):
+        """send a request, get_response() returns the responses in order.
+
+        body is a str or an iterable of str sent chunked.
+        """
+        if self.sock is None:
+            self.connect()
+        head, chunked = self._format(method, path, body, headers)
+        if body is None:
+            self._sendall(head)
+        elif not chunked:
+            self._sendall(head + body)
+        else:
+            self._sendall(head)
+            for data in body:
+                if data:
+                    self._sendall('%x\r\n%s\r\n' % (len(data), data))
+            self._sendall('0\r\n\r\n')
+        self.requests += 1
+        self._pending.append((method, path))
+
+    def get_response(self):
+        if self._response is not None:
+            # the body of the previous response comes first
+            self._response.close()
+        if not self._pending:
+            if self._unanswered:
+                lost, self._unanswered = self._unanswered, []
+                raise ConnectionClosed(lost)
+            raise IOError('no request')
+        method = self._pending.popleft()[0]
+        parser = self._parser
+        try:
+            while True:
+                status, version, headers = parser.read_head(method == 'HEAD')
+                # interim response
+                if status < 100 or status >= 200 or status == 101:
+                    break
+        except (IOError, socket.error):
+            self.close()
+            raise
+        response = Response(self, method, status, version, headers)
+        if not response._released:
+            self._response = response
+        return response
+
+    def request(self, method, path, body=None, headers=None):
+        self.send_request(method, path, body, headers)
+        return self.get_response()
+
+    def _response_done(self, response):
+        if self._response is response:
+            self._response = None
+        if self._parser is None:
+            return
+        if not self._parser.keep_alive:
+            self.close()
+        elif self._pool is not None and self.reusable:
+            self._pool.put(self)
+
+
+class ConnectionPool(object):
+    """keep-alive connections per (host, port)"""
+
+    def __init__(self, maxsize=10, timeout=None):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._idle = {}
+
+    def get(self, host, port):
+        idle = self._idle.get((host, port))
+        while idle:
+            conn = idle.pop()
+            if conn.sock is not None:
+                return conn
+        return Connection(host, port, self.timeout, self)
+
+    def put(self, conn):
+        idle = self._idle.setdefault((conn.host, conn.port), [])
+        if conn in idle:
+            return
+        if len(idle) < self.maxsize and conn.reusable:
+            idle.append(conn)
+        else:
+            conn.close()
+
+    def close(self):
+        for idle in self._idle.values():
+            for conn in idle:
+                conn.close()
+        self._idle.clear()
+
+    def request(self, method, url, body=None, headers=None):
+        host, port, path = _split_url(url)
+        conn = self.get(host, port)
+        reused = conn.requests > 0
+        try:
+            return conn.request(method, path, body, headers)
+        except (IOError, socket.error):
+            conn.close()
+            if not reused or method not in _IDEMPOTENT or not _resendable(body):
+                raise
+        # the server closed the kept alive connection
+        conn = Connection(host, port, self.timeout, self)
+        return conn.request(method, path, body, headers)
+
+    def pipeline(self, requests):
+        """send [(method, url, body, headers), ...] of one host at once,
+        return the responses with the body read.
+
+        the requests a server closing the connection (no keep-alive) left
+        unanswered are sent again on a new connection if they are
+        idempotent, otherwise ConnectionClosed names them."""
+        requests = [(method, _split_url(url), body, headers)
+                    for method, url, body, headers in requests]
+        responses = []
+        if not requests:
+            return responses
+        host, port = requests[0][1][:2]
+        for method, (h, p, path), body, headers in requests:
+            if (h, p) != (host, port):
+                raise ValueError('pipeline to one host')
+
+        conn = self.get(host, port)
+        while True:
+            reused = conn.requests > 0
+            rest = requests[len(responses):]
+            sent = 0
+            try:
+                for method, (h, p, path), body, headers in rest:
+                    conn.send_request(method, path, body, headers)
+                    sent += 1
+            except (IOError, socket.error):
+                # closed by the server, read what it answered
+                if not sent and not reused:
+                    conn.close()
+                    raise
+            answered = 0
+            try:
+                while answered < sent:
+                    response = conn.get_response()
+                    response.body = response.read()
+                    responses.append(response)
+                    answered += 1
+            except (IOError, socket.error):
+                conn.close()
+                lost = rest[answered:sent]
+                if not answered and not reused:
+                    raise
+                if not all(method in _IDEMPOTENT and _resendable(body)
+                           for method, _, body, _ in lost):
+                    raise ConnectionClosed([(method, path)
+                            for method, (h, p, path), body, headers in lost])
+            if len(responses) == len(requests):
+                return responses
+            if not answered and not reused:
+                raise ConnectionClosed([(method, path)
+                        for method, (h, p, path), body, headers in rest])
+            conn = Connection(host, port, self.timeout, self)
+
+
+def _resendable(body):
+    return body is None or isinstance(body, str)
+
+
+def _header_dict(headers):
+    d = {}
+    for name, value in headers:
+        if name in d:
+            d[name] = '%s, %s' % (d[name], value)
+        else:
+            d[name] = value
+    return d
+
+
+def _split_url(url):
+    parts = urlparse.urlsplit(url)
+    if parts.scheme != 'http':
+        raise ValueError('unsupported scheme %r' % (parts.scheme,))
+    path = parts.path or '/'
+    if parts.query:
+        path = '%s?%s' % (path, parts.query)
+    return parts.hostname, parts.port or 80, path
+
+
+_pool = ConnectionPool()
+
+
+def request(method, url, body=None, headers=None):
+    return _pool.request(method, url, body, headers)
+
+
+def get(url, headers=None):
+    return _pool.request('GET', url, None, headers)
+
+
+def post(url, body, headers=None):
+    return _pool.request('POST', url, body, headers)
+
+
+def pipeline(requests):
+    return _pool.pipeline(requests)
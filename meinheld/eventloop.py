@@ -0,0 +1,678 @@
+"""asyncio style event loop on the meinheld main loop.
+
+The loop does not run by itself, server.run() drives it: fd callbacks
+are picoev registrations and timers bound the picoev wait.
+Callbacks run on the hub, not in a request greenlet.
+
+Futures and tasks need trollius (asyncio for python 2), install()
+sets the policy there.
+
+There are no threads: run_in_executor() calls the function on the hub
+and getaddrinfo() (also used by create_connection() for a host name)
+blocks the whole worker while the name is resolved. Pass IP addresses
+or resolve the names before the server starts.
+"""
+from __future__ import absolute_import
+
+import errno
+import fcntl
+import functools
+import heapq
+import os
+import socket
+import sys
+import time
+import traceback
+from collections import deque
+
+from meinheld import server
+
+try:
+    import trollius
+    _AbstractEventLoop = trollius.AbstractEventLoop
+    _AbstractEventLoopPolicy = trollius.AbstractEventLoopPolicy
+    _Transport = trollius.Transport
+except ImportError:
+    trollius = None
+    _AbstractEventLoop = object
+    _AbstractEventLoopPolicy = object
+    _Transport = object
+
+READ = 1
+WRITE = 2
+
+_WOULDBLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+_MAX_READ = 256 * 1024
+
+
+def _fileno(fd):
+    if isinstance(fd, (int, long)):
+        return fd
+    return fd.fileno()
+
+
+def _set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+class Handle(object):
+
+    __slots__ = ('_callback', '_args', '_loop', '_cancelled')
+
+    def __init__(self, callback, args, loop):
+        self._callback = callback
+        self._args = args
+        self._loop = loop
+        self._cancelled = False
+
+    def cancel(self):
+        self._cancelled = True
+        self._callback = None
+        self._args = None
+
+    def _run(self):
+        try:
+            self._callback(*self._args)
+        except Exception as e:
+            self._loop.call_exception_handler({
+                'message': 'Exception in callback %r' % (self._callback,),
+                'exception': e,
+                'handle': self,
+            })
+
+
+class TimerHandle(Handle):
+
+    __slots__ = ('_when',)
+
+    def __init__(self, when, callback, args, loop):
+        super(TimerHandle, self).__init__(callback, args, loop)
+        self._when = when
+
+
+class _SocketTransport(_Transport):
+    """stream transport of a connected non-blocking socket"""
+
+    def __init__(self, loop, sock, protocol):
+        self._loop = loop
+        self._sock = sock
+        self._fd = sock.fileno()
+        self._protocol = protocol
+        self._buffer = []
+        self._buffer_size = 0
+        self._high_water = 64 * 1024
+        self._low_water = 16 * 1024
+        self._writing_paused = False
+        self._reading = False
+        self._closing = False
+        self._eof = False
+        self._extra = {'socket': sock}
+        try:
+            self._extra['sockname'] = sock.getsockname()
+        except socket.error:
+            pass
+        try:
+            self._extra['peername'] = sock.getpeername()
+        except socket.error:
+            pass
+        loop.call_soon(protocol.connection_made, self)
+        loop.call_soon(self.resume_reading)
+
+    def get_extra_info(self, name, default=None):
+        return self._extra.get(name, default)
+
+    def is_closing(self):
+        return self._closing
+
+    # reading
+
+    def pause_reading(self):
+        if self._reading:
+            self._reading = False
+            self._loop.remove_reader(self._fd)
+
+    def resume_reading(self):
+        if not self._reading and not self._closing:
+            self._reading = True
+            self._loop.add_reader(self._fd, self._read_ready)
+
+    def _read_ready(self):
+        try:
+            data = self._sock.recv(_MAX_READ)
+        except socket.error as e:
+            if e.args[0] not in _WOULDBLOCK:
+                self._fatal_error(e)
+            return
+        if data:
+            self._protocol.data_received(data)
+            return
+        self.pause_reading()
+        if not self._protocol.eof_received():
+            self.close()
+
+    # writing
+
+    def get_write_buffer_size(self):
+        return self._buffer_size
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        if high is None:
+            high = 64 * 1024 if low is None else 4 * low
+        if low is None:
+            low = high // 4
+        if not high >= low >= 0:
+            raise ValueError('high (%r) must be >= low (%r) must be >= 0' % (high, low))
+        self._high_water = high
+        self._low_water = low
+        self._check_pause()
+
+    def can_write_eof(self):
+        return True
+
+    def write(self, data):
+        if self._eof:
+            raise RuntimeError('Cannot call write() after write_eof()')
+        if not data or self._sock is None:
+            return
+        if not self._buffer:
+            try:
+                n = self._sock.send(data)
+            except socket.error as e:
+                if e.args[0] not in _WOULDBLOCK:
+                    self._fatal_error(e)
+                    return
+                n = 0
+            data = data[n:]
+            if not data:
+                return
+            self._loop.add_writer(self._fd, self._write_ready)
+        self._buffer.append(data)
+        self._buffer_size += len(data)
+        self._check_pause()
+
+    def writelines(self, list_of_data):
+        self.write(''.join(list_of_data))
+
+    def _write_ready(self):
+        data = ''.join(self._buffer)
+        try:
+            n = self._sock.send(data)
+        except socket.error as e:
+            if e.args[0] not in _WOULDBLOCK:
+                self._buffer = []
+                self._buffer_size = 0
+                self._loop.remove_writer(self._fd)
+                self._fatal_error(e)
+            return
+        data = data[n:]
+        self._buffer = [data] if data else []
+        self._buffer_size = len(data)
+        self._check_resume()
+        if data:
+            return
+        self._loop.remove_writer(self._fd)
+        if self._closing:
+            self._call_connection_lost(None)
+        elif self._eof:
+            self._sock.shutdown(socket.SHUT_WR)
+
+    def write_eof(self):
+        if self._eof:
+            return
+        self._eof = True
+        if not self._buffer:
+            self._sock.shutdown(socket.SHUT_WR)
+
+    def _check_pause(self):
+        if not self._writing_paused and self._buffer_size > self._high_water:
+            self._writing_paused = True
+            self._protocol.pause_writing()
+
+    def _check_resume(self):
+        if self._writing_paused and self._buffer_size <= self._low_water:
+            self._writing_paused = False
+            self._protocol.resume_writing()
+
+    # closing
+
+    def close(self):
+        if self._closing:
+            return
+        self._closing = True
+        self.pause_reading()
+        if not self._buffer:
+            self._loop.call_soon(self._call_connection_lost, None)
+
+    def abort(self):
+        self._force_close(None)
+
+    def _fatal_error(self, exc):
+        self._loop.call_exception_handler({
+            'message': 'Fatal error on transport',
+            'exception': exc,
+            'transport': self,
+            'protocol': self._protocol,
+        })
+        self._force_close(exc)
+
+    def _force_close(self, exc):
+        if self._sock is None:
+            return
+        if self._buffer:
+            self._buffer = []
+            self._buffer_size = 0
+            self._loop.remove_writer(self._fd)
+        if not self._closing:
+            self._closing = True
+            self.pause_reading()
+        self._loop.call_soon(self._call_connection_lost, exc)
+
+    def _call_connection_lost(self, exc):
+        if self._sock is None:
+            return
+        try:
+            self._protocol.connection_lost(exc)
+        finally:
+            self._sock.close()
+            self._sock = None
+            self._protocol = None
+
+
+class PicoevEventLoop(_AbstractEventLoop):
+
+    def __init__(self):
+        self._ready = deque()
+        self._scheduled = []
+        self._seq = 0
+        self._readers = {}
+        self._writers = {}
+        self._exception_handler = None
+        self._debug = False
+        self._closed = False
+        # wakes the loop up from other threads
+        self._wakeup = os.pipe()
+        for fd in self._wakeup:
+            _set_nonblocking(fd)
+        self.add_reader(self._wakeup[0], self._read_wakeup)
+        server._set_loop_hooks(self._on_fd, self._tick)
+
+    # running
+
+    def run_forever(self):
+        raise RuntimeError('the loop is driven by server.run()')
+
+    def run_until_complete(self, future):
+        raise RuntimeError('the loop is driven by server.run()')
+
+    def stop(self):
+        raise RuntimeError('the loop is driven by server.run()')
+
+    def is_running(self):
+        return not self._closed and server._is_running()
+
+    def is_closed(self):
+        return self._closed
+
+    def close(self):
+        if self._closed:
+            return
+        for fd in set(self._readers) | set(self._writers):
+            server._watch_fd(fd, 0)
+        self._readers.clear()
+        self._writers.clear()
+        self._ready.clear()
+        self._scheduled = []
+        for fd in self._wakeup:
+            os.close(fd)
+        server._set_loop_hooks(None, None)
+        self._closed = True
+
+    def get_debug(self):
+        return self._debug
+
+    def set_debug(self, enabled):
+        self._debug = enabled
+
+    # callbacks
+
+    def time(self):
+        return time.time()
+
+    def call_soon(self, callback, *args):
+        handle = Handle(callback, args, self)
+        self._ready.append(handle)
+        return handle
+
+    def call_soon_threadsafe(self, callback, *args):
+        handle = self.call_soon(callback, *args)
+        self._write_wakeup()
+        return handle
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(self.time() + delay, callback, *args)
+
+    def call_at(self, when, callback, *args):
+        handle = TimerHandle(when, callback, args, self)
+        self._seq += 1
+        heapq.heappush(self._scheduled, (when, self._seq, handle))
+        return handle
+
+    def _tick(self):
+        scheduled = self._scheduled
+        now = self.time()
+        while scheduled and scheduled[0][0] <= now:
+            handle = heapq.heappop(scheduled)[2]
+            if not handle._cancelled:
+                self._ready.append(handle)
+
+        # callbacks scheduled by these run on the next tick
+        ready = self._ready
+        for i in xrange(len(ready)):
+            handle = ready.popleft()
+            if not handle._cancelled:
+                handle._run()
+
+        if ready:
+            return 0
+        while scheduled and scheduled[0][2]._cancelled:
+            heapq.heappop(scheduled)
+        if scheduled:
+            return max(0, scheduled[0][0] - self.time())
+        return None
+
+    # fd watchers
+
+    def _update(self, fd):
+        events = 0
+        if fd in self._readers:
+            events |= READ
+        if fd in self._writers:
+            events |= WRITE
+        server._watch_fd(fd, events)
+
+    def _on_fd(self, fd, events):
+        if events & READ:
+            handle = self._readers.get(fd)
+            if handle:
+                handle._run()
+        if events & WRITE:
+            handle = self._writers.get(fd)
+            if handle:
+                handle._run()
+
+    def add_reader(self, fd, callback, *args):
+        fd = _fileno(fd)
+        self._readers[fd] = Handle(callback, args, self)
+        self._update(fd)
+
+    def remove_reader(self, fd):
+        fd = _fileno(fd)
+        handle = self._readers.pop(fd, None)
+        if handle is None:
+            return False
+        handle.cancel()
+        self._update(fd)
+        return True
+
+    def add_writer(self, fd, callback, *args):
+        fd = _fileno(fd)
+        self._writers[fd] = Handle(callback, args, self)
+        self._update(fd)
+
+    def remove_writer(self, fd):
+        fd = _fileno(fd)
+        handle = self._writers.pop(fd, None)
+        if handle is None:
+            return False
+        handle.cancel()
+        self._update(fd)
+        return True
+
+    def _write_wakeup(self):
+        try:
+            os.write(self._wakeup[1], 'x')
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def _read_wakeup(self):
+        try:
+            while os.read(self._wakeup[0], 4096):
+                pass
+        except OSError:
+            pass
+
+    # futures (trollius)
+
+    def create_future(self):
+        if trollius is None:
+            raise RuntimeError('futures need trollius')
+        return trollius.Future(loop=self)
+
+    def create_task(self, coro):
+        if trollius is None:
+            raise RuntimeError('tasks need trollius')
+        return trollius.Task(coro, loop=self)
+
+    def run_in_executor(self, executor, func, *args):
+        # no threads, run it now. it blocks the loop
+        future = self.create_future()
+        try:
+            future.set_result(func(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def getaddrinfo(self, host, port, family=0, type=0, proto=0, flags=0):
+        return self.run_in_executor(None, socket.getaddrinfo,
+                host, port, family, type, proto, flags)
+
+    def sock_recv(self, sock, n):
+        future = self.create_future()
+        self._sock_recv(future, False, sock, n)
+        return future
+
+    def _sock_recv(self, future, registered, sock, n):
+        fd = sock.fileno()
+        if registered:
+            self.remove_reader(fd)
+        if future.cancelled():
+            return
+        try:
+            data = sock.recv(n)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                self.add_reader(fd, self._sock_recv, future, True, sock, n)
+            else:
+                future.set_exception(e)
+        else:
+            future.set_result(data)
+
+    def sock_sendall(self, sock, data):
+        future = self.create_future()
+        self._sock_sendall(future, False, sock, data)
+        return future
+
+    def _sock_sendall(self, future, registered, sock, data):
+        fd = sock.fileno()
+        if registered:
+            self.remove_writer(fd)
+        if future.cancelled():
+            return
+        try:
+            n = sock.send(data)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                n = 0
+            else:
+                future.set_exception(e)
+                return
+        if n == len(data):
+            future.set_result(None)
+        else:
+            self.add_writer(fd, self._sock_sendall, future, True, sock, data[n:])
+
+    def sock_connect(self, sock, address):
+        future = self.create_future()
+        try:
+            sock.connect(address)
+        except socket.error as e:
+            if e.args[0] not in (errno.EINPROGRESS, errno.EAGAIN, errno.EWOULDBLOCK):
+                future.set_exception(e)
+                return future
+            self.add_writer(sock.fileno(), self._sock_connect_done, future, sock)
+        else:
+            future.set_result(None)
+        return future
+
+    def _sock_connect_done(self, future, sock):
+        self.remove_writer(sock.fileno())
+        if future.cancelled():
+            return
+        err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            future.set_exception(socket.error(err, os.strerror(err)))
+        else:
+            future.set_result(None)
+
+    def create_connection(self, protocol_factory, host=None, port=None,
+                          ssl=None, family=0, proto=0, flags=0, sock=None,
+                          local_addr=None, server_hostname=None):
+        """connect a stream transport, return a future of
+        (transport, protocol). a host name is resolved blocking."""
+        if ssl:
+            raise NotImplementedError('ssl transports are not supported')
+        future = self.create_future()
+        if sock is not None:
+            if host is not None or port is not None:
+                raise ValueError('host/port and sock can not be specified at the same time')
+            sock.setblocking(False)
+            self._connection_made(future, protocol_factory, sock)
+            return future
+        try:
+            infos = socket.getaddrinfo(host, port, family, socket.SOCK_STREAM,
+                                       proto, flags)
+        except socket.error as e:
+            future.set_exception(e)
+            return future
+        self._connect_next(future, protocol_factory, infos, local_addr, None)
+        return future
+
+    def _connect_next(self, future, protocol_factory, infos, local_addr, err):
+        while infos:
+            family, socktype, proto, _, address = infos.pop(0)
+            sock = socket.socket(family, socktype, proto)
+            try:
+                sock.setblocking(False)
+                if family in (socket.AF_INET, socket.AF_INET6):
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                if local_addr is not None:
+                    sock.bind(local_addr)
+            except socket.error as e:
+                sock.close()
+                err = e
+                continue
+            connect = self.sock_connect(sock, address)
+            connect.add_done_callback(functools.partial(self._on_connect,
+                    future, protocol_factory, infos, local_addr, sock))
+            return
+        if err is None:
+            err = socket.error('getaddrinfo returns an empty list')
+        future.set_exception(err)
+
+    def _on_connect(self, future, protocol_factory, infos, local_addr, sock, connect):
+        if future.cancelled():
+            sock.close()
+            return
+        err = connect.exception()
+        if err is not None:
+            sock.close()
+            self._connect_next(future, protocol_factory, infos, local_addr, err)
+            return
+        self._connection_made(future, protocol_factory, sock)
+
+    def _connection_made(self, future, protocol_factory, sock):
+        try:
+            protocol = protocol_factory()
+            transport = _SocketTransport(self, sock, protocol)
+        except Exception as e:
+            sock.close()
+            future.set_exception(e)
+            return
+        # after connection_made()
+        self.call_soon(self._set_result, future, (transport, protocol))
+
+    def _set_result(self, future, result):
+        if not future.cancelled():
+            future.set_result(result)
+
+    def sock_accept(self, sock):
+        future = self.create_future()
+        self._sock_accept(future, False, sock)
+        return future
+
+    def _sock_accept(self, future, registered, sock):
+        fd = sock.fileno()
+        if registered:
+            self.remove_reader(fd)
+        if future.cancelled():
+            return
+        try:
+            conn, address = sock.accept()
+            conn.setblocking(False)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                self.add_reader(fd, self._sock_accept, future, True, sock)
+            else:
+                future.set_exception(e)
+        else:
+            future.set_result((conn, address))
+
+    # errors
+
+    def set_exception_handler(self, handler):
+        self._exception_handler = handler
+
+    def get_exception_handler(self):
+        return self._exception_handler
+
+    def default_exception_handler(self, context):
+        exc = context.get('exception')
+        sys.stderr.write('%s\n' % context.get('message', 'Unhandled exception in event loop'))
+        if exc is not None:
+            traceback.print_exception(type(exc), exc, None, file=sys.stderr)
+
+    def call_exception_handler(self, context):
+        if self._exception_handler is None:
+            self.default_exception_handler(context)
+            return
+        try:
+            self._exception_handler(self, context)
+        except Exception:
+            traceback.print_exc()
+
+
+class PicoevEventLoopPolicy(_AbstractEventLoopPolicy):
+
+    _loop = None
+
+    def get_event_loop(self):
+        if self._loop is None or self._loop.is_closed():
+            self._loop = PicoevEventLoop()
+        return self._loop
+
+    def set_event_loop(self, loop):
+        self._loop = loop
+
+    def new_event_loop(self):
+        return PicoevEventLoop()
+
+
+def install():
+    """set PicoevEventLoopPolicy as the trollius event loop policy"""
+    if trollius is None:
+        raise ImportError('No module named trollius')
+    policy = PicoevEventLoopPolicy()
+    trollius.set_event_loop_policy(policy)
+    return policy
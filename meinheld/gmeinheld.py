@@ -15,6 +15,9 @@ class MeinheldWorker(Worker):
         fd = self.socket.fileno()
         server.set_keepalive(self.cfg.keepalive)
         server.set_picoev_max_fd(self.cfg.worker_connections)
+        server.set_graceful_timeout(int(self.cfg.graceful_timeout))
+        if self.cfg.is_ssl:
+            server.set_ssl(self.cfg.certfile, self.cfg.keyfile, getattr(self.cfg, 'ciphers', None))
         
         server.set_fastwatchdog(self.tmp.fileno(), self.ppid)
         #server.set_watchdog(self.watchdog)
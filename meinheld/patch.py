@@ -8,6 +8,9 @@ __all__ = [
             'patch_werkzeug',
             'patch_socket',
             'patch_ssl',
+            'patch_select',
+            'patch_time',
+            'patch_subprocess',
           ]
 
 def patch_werkzeug():
@@ -56,7 +59,34 @@ def patch_ssl():
 
 
 
-def patch_all(werkzeug=True, socket=True, ssl=True, aggressive=True):
+def patch_select():
+    """Replace select.select, select.poll and select.epoll with meinheld's cooperative versions."""
+    from meinheld import select
+    _select = __import__('select')
+    _select.select = select.select
+    _select.poll = select.poll
+    if hasattr(select, 'epoll'):
+        _select.epoll = select.epoll
+
+
+def patch_time():
+    """Replace time.sleep with meinheld's sleep, it parks the greenlet on a loop timer."""
+    from meinheld import server
+    _time = __import__('time')
+    _time.sleep = server.sleep
+
+
+def patch_subprocess():
+    """Replace subprocess.Popen with meinheld's cooperative Popen.
+
+    call, check_call and check_output use it too.
+    """
+    from meinheld import subprocess
+    _subprocess = __import__('subprocess')
+    _subprocess.Popen = subprocess.Popen
+
+
+def patch_all(werkzeug=True, socket=True, ssl=True, select=True, time=True, subprocess=True, aggressive=True):
     """Do all of the default monkey patching (calls every other function in this module."""
     # order is important
     if werkzeug:
@@ -65,5 +95,11 @@ def patch_all(werkzeug=True, socket=True, ssl=True, aggressive=True):
         patch_socket(aggressive=aggressive)
     if ssl:
         patch_ssl()
+    if select:
+        patch_select()
+    if time:
+        patch_time()
+    if subprocess:
+        patch_subprocess()
 
 
@@ -0,0 +1,159 @@
+"""Cooperative select, poll and epoll.
+
+Waiting parks the greenlet on the meinheld loop until one of the fds
+is ready, the ready set is then taken from the original functions
+with a zero timeout.
+"""
+import time
+
+from meinheld import server
+
+__select__ = __import__('select')
+
+error = __select__.error
+
+# originals, patch_select replaces the module attributes
+_select = __select__.select
+_poll = __select__.poll
+_epoll = getattr(__select__, 'epoll', None)
+
+for _name in dir(__select__):
+    if _name.isupper():
+        globals()[_name] = getattr(__select__, _name)
+del _name
+
+__all__ = ['error', 'select', 'poll']
+
+_READ_MASK = __select__.POLLIN | __select__.POLLPRI
+_WRITE_MASK = __select__.POLLOUT
+
+
+def _fileno(fd):
+    if isinstance(fd, (int, long)):
+        return fd
+    return fd.fileno()
+
+
+def _deadline(timeout):
+    if timeout is None:
+        return None
+    return time.time() + timeout
+
+
+def _remaining(deadline):
+    if deadline is None:
+        return None
+    return max(0, deadline - time.time())
+
+
+def select(rlist, wlist, xlist, timeout=None):
+    ready = _select(rlist, wlist, xlist, 0)
+    if ready[0] or ready[1] or ready[2] or timeout == 0:
+        return ready
+    if xlist and not rlist and not wlist:
+        # exceptional conditions are not watched by the loop
+        return _select(rlist, wlist, xlist, timeout)
+
+    deadline = _deadline(timeout)
+    while True:
+        if not server.wait_fds(rlist, wlist, _remaining(deadline)):
+            return [], [], []
+        ready = _select(rlist, wlist, xlist, 0)
+        if ready[0] or ready[1] or ready[2]:
+            return ready
+
+
+class _Poller(object):
+    """registered fds are mirrored to the original poller"""
+
+    _read_mask = _READ_MASK
+    _write_mask = _WRITE_MASK
+
+    def __init__(self, poller):
+        self._poller = poller
+        self._fds = {}
+
+    def register(self, fd, eventmask=_READ_MASK | _WRITE_MASK):
+        fd = _fileno(fd)
+        self._poller.register(fd, eventmask)
+        self._fds[fd] = eventmask
+
+    def modify(self, fd, eventmask):
+        fd = _fileno(fd)
+        self._poller.modify(fd, eventmask)
+        self._fds[fd] = eventmask
+
+    def unregister(self, fd):
+        fd = _fileno(fd)
+        self._poller.unregister(fd)
+        del self._fds[fd]
+
+    def _wait(self, deadline):
+        rfds = [fd for fd, mask in self._fds.iteritems() if mask & self._read_mask]
+        wfds = [fd for fd, mask in self._fds.iteritems() if mask & self._write_mask]
+        return server.wait_fds(rfds, wfds, _remaining(deadline))
+
+
+class poll(_Poller):
+
+    def __init__(self):
+        super(poll, self).__init__(_poll())
+
+    def poll(self, timeout=None):
+        ready = self._poller.poll(0)
+        if ready or timeout == 0:
+            return ready
+        if timeout is not None and timeout < 0:
+            timeout = None
+        if timeout is not None:
+            timeout = timeout / 1000.0
+
+        deadline = _deadline(timeout)
+        while True:
+            if not self._wait(deadline):
+                return []
+            ready = self._poller.poll(0)
+            if ready:
+                return ready
+
+
+if _epoll is not None:
+
+    __all__.append('epoll')
+
+    class epoll(_Poller):
+
+        _read_mask = __select__.EPOLLIN | __select__.EPOLLPRI
+        _write_mask = __select__.EPOLLOUT
+
+        def __init__(self, sizehint=-1):
+            super(epoll, self).__init__(_epoll(sizehint))
+
+        def register(self, fd, eventmask=_read_mask | _write_mask):
+            super(epoll, self).register(fd, eventmask)
+
+        @property
+        def closed(self):
+            return self._poller.closed
+
+        def close(self):
+            self._poller.close()
+            self._fds.clear()
+
+        def fileno(self):
+            return self._poller.fileno()
+
+        def poll(self, timeout=-1, maxevents=-1):
+            ready = self._poller.poll(0, maxevents)
+            if ready or timeout == 0:
+                return ready
+            if timeout < 0:
+                timeout = None
+
+            deadline = _deadline(timeout)
+            while True:
+                if not self._wait(deadline):
+                    return []
+                ready = self._poller.poll(0, maxevents)
+                if ready:
+                    return ready
@@ -0,0 +1,74 @@
+#include "arena.h"
+
+#define ARENA_ALIGN(n) (((n) + 7) & ~((size_t)7))
+#define CHUNK_DATA(c) ((char *)(c) + ARENA_ALIGN(sizeof(arena_chunk)))
+
+inline void
+arena_init(arena *a, char *base, size_t size)
+{
+    a->base = base;
+    a->size = size;
+    a->used = 0;
+    a->chunks = NULL;
+}
+
+static inline arena_chunk *
+new_chunk(size_t size)
+{
+    arena_chunk *c;
+    if(size < ARENA_CHUNK_SIZE){
+        size = ARENA_CHUNK_SIZE;
+    }
+    c = (arena_chunk *)PyMem_Malloc(ARENA_ALIGN(sizeof(arena_chunk)) + size);
+    if(c == NULL){
+        return NULL;
+    }
+#ifdef DEBUG
+    printf("alloc arena chunk %p size %d \n", c, (int)size);
+#endif
+    c->next = NULL;
+    c->size = size;
+    c->used = 0;
+    return c;
+}
+
+inline void *
+arena_alloc(arena *a, size_t size)
+{
+    void *p;
+    arena_chunk *c;
+
+    size = ARENA_ALIGN(size);
+    if(a->size - a->used >= size){
+        p = a->base + a->used;
+        a->used += size;
+        return p;
+    }
+    c = a->chunks;
+    if(c == NULL || c->size - c->used < size){
+        c = new_chunk(size);
+        if(c == NULL){
+            return NULL;
+        }
+        c->next = a->chunks;
+        a->chunks = c;
+    }
+    p = CHUNK_DATA(c) + c->used;
+    c->used += size;
+    return p;
+}
+
+inline void
+arena_reset(arena *a)
+{
+    arena_chunk *c, *next;
+
+    c = a->chunks;
+    while(c){
+        next = c->next;
+        PyMem_Free(c);
+        c = next;
+    }
+    a->chunks = NULL;
+    a->used = 0;
+}
@@ -0,0 +1,33 @@
+#ifndef ARENA_H
+#define ARENA_H
+
+#include <Python.h>
+#include <stdlib.h>
+#include <string.h>
+#include <inttypes.h>
+
+#define ARENA_CHUNK_SIZE 1024 * 8
+
+typedef struct _arena_chunk {
+    struct _arena_chunk *next;
+    size_t size;
+    size_t used;
+} arena_chunk;
+
+typedef struct {
+    char *base;             // inline block
+    size_t size;
+    size_t used;
+    arena_chunk *chunks;    // overflow chunks
+} arena;
+
+inline void
+arena_init(arena *a, char *base, size_t size);
+
+inline void *
+arena_alloc(arena *a, size_t size);
+
+inline void
+arena_reset(arena *a);
+
+#endif
@@ -2,38 +2,36 @@
 
 #define LIMIT_MAX 1024 * 1024 * 1024
 
+#define MINFREELIST 1024
 #define MAXFREELIST 1024 * 16 * 2
 
-static buffer *buffer_free_list[MAXFREELIST];
-static int numfree = 0;
+static freelist buffer_free_list;
+
+static void *
+new_buffer_mem(void)
+{
+    return PyMem_Malloc(sizeof(buffer));
+}
 
 inline void
 buffer_list_fill(void)
 {
-    buffer *buf;
-	while (numfree < MAXFREELIST) {
-        buf = (buffer *)PyMem_Malloc(sizeof(buffer));
-		buffer_free_list[numfree++] = buf;
-	}
+    freelist_init(&buffer_free_list, "buffer", MINFREELIST, MAXFREELIST, new_buffer_mem, PyMem_Free);
+    freelist_fill(&buffer_free_list);
 }
 
 inline void
 buffer_list_clear(void)
 {
-	buffer *op;
-
-	while (numfree) {
-		op = buffer_free_list[--numfree];
-		PyMem_Free(op);
-	}
+    freelist_clear(&buffer_free_list);
 }
 
 static inline buffer*
 alloc_buffer(void)
 {
     buffer *buf;
-	if (numfree) {
-		buf = buffer_free_list[--numfree];
+    buf = (buffer *)freelist_pop(&buffer_free_list);
+	if (buf) {
 #ifdef DEBUG
         printf("use pooled buf %p\n", buf);
 #endif
@@ -50,11 +48,10 @@ alloc_buffer(void)
 static inline void
 dealloc_buffer(buffer *buf)
 {
-	if (numfree < MAXFREELIST){
+	if (freelist_push(&buffer_free_list, buf)){
 #ifdef DEBUG
         printf("back to buffer pool %p\n", buf);
 #endif
-		buffer_free_list[numfree++] = buf;
     }else{
 	    PyMem_Free(buf);
     }
@@ -113,11 +110,96 @@ new_buffer(size_t buf_size, size_t limit)
     return buf;
 }
 
+inline buffer *
+new_arena_buffer(arena *a, size_t buf_size, size_t limit)
+{
+    buffer *buf;
+
+    if(a == NULL){
+        return new_buffer(buf_size, limit);
+    }
+    buf = (buffer *)arena_alloc(a, sizeof(buffer) + buf_size);
+    if(buf == NULL){
+        return new_buffer(buf_size, limit);
+    }
+    buf->buf = (char *)(buf + 1);
+    buf->buf_size = buf_size;
+    buf->len = 0;
+    if(limit){
+        buf->limit = limit;
+    }else{
+        buf->limit = LIMIT_MAX;
+    }
+    buf->arena = a;
+    buf->view = 0;
+    return buf;
+}
+
+/*
+ * copy the viewed bytes into buffer owned storage of at least size bytes
+ */
+static inline buffer_result
+own_buffer(buffer *buf, size_t size)
+{
+    char *newbuf;
+
+    if(size > buf->limit + 1){
+        size = buf->limit + 1;
+    }
+    if(size < buf->len + 1){
+        size = buf->len + 1;
+    }
+    newbuf = (char*)arena_alloc(buf->arena, size);
+    if(!newbuf){
+        PyErr_SetString(PyExc_MemoryError,"out of memory");
+        return MEMORY_ERROR;
+    }
+    memcpy(newbuf, buf->buf, buf->len);
+    buf->buf = newbuf;
+    buf->buf_size = size;
+    buf->view = 0;
+    return WRITE_OK;
+}
+
+/*
+ * Point an empty arena buffer at c without copying. The bytes must stay
+ * alive until hold_buffer() is called or the buffer is consumed.
+ */
+inline buffer_result
+view2buf(buffer *buf, const char *c, size_t  l)
+{
+    if(buf->len || buf->view || buf->arena == NULL){
+        return write2buf(buf, c, l);
+    }
+    if(l > buf->limit){
+        return LIMIT_OVER;
+    }
+    buf->buf = (char *)c;
+    buf->buf_size = l;
+    buf->len = l;
+    buf->view = 1;
+    return WRITE_OK;
+}
+
+inline buffer_result
+hold_buffer(buffer *buf)
+{
+    if(buf->view){
+        return own_buffer(buf, buf->len + 1);
+    }
+    return WRITE_OK;
+}
+
 inline buffer_result
 write2buf(buffer *buf, const char *c, size_t  l) {
     size_t newl;
     char *newbuf;
     buffer_result ret = WRITE_OK;
+    if(buf->view){
+        if(own_buffer(buf, (buf->len + l) * 2) != WRITE_OK){
+            return MEMORY_ERROR;
+        }
+    }
     newl = buf->len + l;
     
     
@@ -129,10 +211,20 @@ write2buf(buffer *buf, const char *c, size_t  l) {
         if(buf->buf_size > buf->limit){
             buf->buf_size = buf->limit + 1;
         }
-        newbuf = (char*)PyMem_Realloc(buf->buf, buf->buf_size);
+        if(buf->arena){
+            //grow inside the arena, old block is released on reset
+            newbuf = (char*)arena_alloc(buf->arena, buf->buf_size);
+            if(newbuf){
+                memcpy(newbuf, buf->buf, buf->len);
+            }
+        }else{
+            newbuf = (char*)PyMem_Realloc(buf->buf, buf->buf_size);
+        }
         if (!newbuf) {
             PyErr_SetString(PyExc_MemoryError,"out of memory");
-            free(buf->buf);
+            if(!buf->arena){
+                PyMem_Free(buf->buf);
+            }
             buf->buf = 0;
             buf->buf_size = buf->len = 0;
             return MEMORY_ERROR;
@@ -151,6 +243,10 @@ write2buf(buffer *buf, const char *c, size_t  l) {
 inline void
 free_buffer(buffer *buf)
 {
+    if(buf->arena){
+        //released on arena reset
+        return;
+    }
     PyMem_Free(buf->buf);
     //PyMem_Free(buf);
     dealloc_buffer(buf);
@@ -169,7 +265,18 @@ inline PyObject *
 getPyStringAndDecode(buffer *buf)
 {
     PyObject *o;
-    int l = urldecode(buf->buf, buf->len);
+    int l;
+    if(buf->view){
+        if(memchr(buf->buf, '%', buf->len) == NULL){
+            //nothing to decode
+            return getPyString(buf);
+        }
+        //don't decode in the read buffer
+        if(hold_buffer(buf) != WRITE_OK){
+            return NULL;
+        }
+    }
+    l = urldecode(buf->buf, buf->len);
     o = PyString_FromStringAndSize(buf->buf, l);
     free_buffer(buf);
     return o;
@@ -179,6 +286,9 @@ getPyStringAndDecode(buffer *buf)
 inline char *
 getString(buffer *buf)
 {
+    if(buf->view && hold_buffer(buf) != WRITE_OK){
+        return NULL;
+    }
     buf->buf[buf->len] = '\0';
     return buf->buf;
 }
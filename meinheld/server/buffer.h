@@ -7,6 +7,9 @@
 #include <string.h>
 #include <inttypes.h>
 
+#include "arena.h"
+#include "freelist.h"
+
 typedef enum{
     WRITE_OK,
     MEMORY_ERROR,
@@ -18,14 +21,25 @@ typedef struct _buffer {
     size_t buf_size;
     size_t len;
     size_t limit;
+    arena *arena;   // allocated from connection arena
+    uint8_t view;   // buf points into the read buffer, not owned
 } buffer;
 
 inline buffer *
 new_buffer(size_t buf_size, size_t limit);
 
+inline buffer *
+new_arena_buffer(arena *a, size_t buf_size, size_t limit);
+
 inline buffer_result
 write2buf(buffer *buf, const char *c, size_t  l);
 
+inline buffer_result
+view2buf(buffer *buf, const char *c, size_t  l);
+
+inline buffer_result
+hold_buffer(buffer *buf);
+
 inline void
 free_buffer(buffer *buf);
 
@@ -0,0 +1,317 @@
+#include "channel.h"
+#include "structmember.h"
+#include "util.h"
+
+/*
+ * pub/sub channel for suspended clients.
+ * waiters are linked through the ClientObject, a publish moves them
+ * to the resume queue and the loop resumes channel_budget of them
+ * per iteration.
+ */
+
+int channel_budget = 256;
+
+/* clients to resume */
+static ClientObject *queue_head = NULL;
+static ClientObject *queue_tail = NULL;
+
+static inline void
+link_waiter(ChannelObject *self, ClientObject *pyclient)
+{
+    Py_INCREF(pyclient);
+    pyclient->channel = (PyObject *)self;
+    pyclient->chan_prev = self->tail;
+    pyclient->chan_next = NULL;
+    if(self->tail){
+        self->tail->chan_next = pyclient;
+    }else{
+        self->head = pyclient;
+    }
+    self->tail = pyclient;
+    self->waiters++;
+}
+
+/* return the reference of the channel */
+static inline ClientObject*
+unlink_waiter(ChannelObject *self, ClientObject *pyclient)
+{
+    if(pyclient->chan_prev){
+        pyclient->chan_prev->chan_next = pyclient->chan_next;
+    }else{
+        self->head = pyclient->chan_next;
+    }
+    if(pyclient->chan_next){
+        pyclient->chan_next->chan_prev = pyclient->chan_prev;
+    }else{
+        self->tail = pyclient->chan_prev;
+    }
+    pyclient->channel = NULL;
+    pyclient->chan_prev = NULL;
+    pyclient->chan_next = NULL;
+    self->waiters--;
+    return pyclient;
+}
+
+static inline void
+enqueue(ClientObject *pyclient)
+{
+    pyclient->chan_next = NULL;
+    if(queue_tail){
+        queue_tail->chan_next = pyclient;
+    }else{
+        queue_head = pyclient;
+    }
+    queue_tail = pyclient;
+}
+
+static inline ClientObject*
+dequeue(void)
+{
+    ClientObject *pyclient = queue_head;
+
+    if(pyclient){
+        queue_head = pyclient->chan_next;
+        if(queue_head == NULL){
+            queue_tail = NULL;
+        }
+        pyclient->chan_next = NULL;
+    }
+    return pyclient;
+}
+
+inline int
+channel_pending(void)
+{
+    return queue_head != NULL;
+}
+
+inline void
+channel_dispatch(picoev_loop *loop)
+{
+    ClientObject *pyclient;
+    int i;
+
+    for(i = 0; i < channel_budget; i++){
+        pyclient = dequeue();
+        if(pyclient == NULL){
+            break;
+        }
+#ifdef DEBUG
+        printf("channel_dispatch pyclient:%p client:%p \n", pyclient, pyclient->client);
+#endif
+        if(pyclient->client && pyclient->resumed){
+            switch_wsgi_app(loop, pyclient->client->fd, (PyObject *)pyclient);
+        }
+        Py_DECREF(pyclient);
+    }
+}
+
+inline void
+channel_clear(void)
+{
+    ClientObject *pyclient;
+
+    while((pyclient = dequeue()) != NULL){
+        Py_DECREF(pyclient);
+    }
+}
+
+static void
+channel_timeout_callback(picoev_loop* loop, int fd, int events, void* cb_arg)
+{
+    ClientObject *pyclient = (ClientObject *)(cb_arg);
+
+    if((events & PICOEV_TIMEOUT) == 0 || pyclient->resumed){
+        //published, wait for dispatch
+        return;
+    }
+    pyclient->suspended = 0;
+    pyclient->resumed = 1;
+    PyErr_SetString(timeout_error, "timeout");
+    set_so_keepalive(fd, 0);
+    switch_wsgi_app(loop, fd, (PyObject *)pyclient);
+}
+
+static void
+channel_alive_callback(picoev_loop* loop, int fd, int events, void* cb_arg)
+{
+    ClientObject *pyclient = (ClientObject *)(cb_arg);
+
+    if((events & PICOEV_TIMEOUT) == 0 || pyclient->resumed){
+        return;
+    }
+    //next intval 30sec
+    picoev_set_timeout(loop, fd, 30);
+    if(write(fd, "", 0) < 0){
+        pyclient->suspended = 0;
+        pyclient->resumed = 1;
+        PyErr_SetFromErrno(PyExc_IOError);
+        set_so_keepalive(fd, 0);
+        switch_wsgi_app(loop, fd, (PyObject *)pyclient);
+    }
+}
+
+static PyObject *
+ChannelObject_new(PyTypeObject *type, PyObject *args, PyObject *kwargs)
+{
+    ChannelObject *self;
+
+    self = (ChannelObject *)type->tp_alloc(type, 0);
+    if(self == NULL){
+        return NULL;
+    }
+    self->head = NULL;
+    self->tail = NULL;
+    self->waiters = 0;
+    return (PyObject *)self;
+}
+
+static void
+ChannelObject_dealloc(ChannelObject *self)
+{
+    ClientObject *pyclient;
+
+    while(self->head){
+        pyclient = unlink_waiter(self, self->head);
+        Py_DECREF(pyclient);
+    }
+    Py_TYPE(self)->tp_free((PyObject *)self);
+}
+
+static PyObject *
+ChannelObject_wait(ChannelObject *self, PyObject *args)
+{
+    ClientObject *pyclient;
+    client_t *client;
+    PyObject *res;
+    int timeout = 0;
+
+    if(!PyArg_ParseTuple(args, "|i:wait", &timeout)){
+        return NULL;
+    }
+
+    pyclient = (ClientObject *)current_client;
+    if(pyclient == NULL || pyclient->client == NULL){
+        PyErr_SetString(PyExc_ValueError, "not in a request");
+        return NULL;
+    }
+    client = pyclient->client;
+    if(!pyclient->greenlet){
+        mark_cooperative(client);
+        PyErr_SetString(PyExc_ValueError, "greenlet is not set");
+        return NULL;
+    }
+    if(pyclient->suspended || pyclient->channel){
+        PyErr_SetString(PyExc_Exception, "already suspended");
+        return NULL;
+    }
+
+    link_waiter(self, pyclient);
+    pyclient->suspended = 1;
+    set_so_keepalive(client->fd, 1);
+#ifdef DEBUG
+    printf("channel wait pyclient:%p client:%p fd:%d \n", pyclient, client, client->fd);
+#endif
+    //clear event
+    picoev_del(main_loop, client->fd);
+    if(timeout > 0){
+        picoev_add(main_loop, client->fd, PICOEV_TIMEOUT, timeout, channel_timeout_callback, (void *)pyclient);
+    }else{
+        picoev_add(main_loop, client->fd, PICOEV_TIMEOUT, 300, channel_alive_callback, (void *)pyclient);
+    }
+
+    res = switch_to_hub(pyclient);
+
+    if(pyclient->channel){
+        //timeout or error
+        ClientObject *o = unlink_waiter((ChannelObject *)pyclient->channel, pyclient);
+        Py_DECREF(o);
+    }
+    return res;
+}
+
+static PyObject *
+ChannelObject_publish(ChannelObject *self, PyObject *args)
+{
+    ClientObject *pyclient;
+    PyObject *value = NULL, *switch_args;
+    int cnt = 0;
+
+    if(!PyArg_ParseTuple(args, "|O:publish", &value)){
+        return NULL;
+    }
+    switch_args = PyTuple_Pack(1, value ? value : Py_None);
+    if(switch_args == NULL){
+        return NULL;
+    }
+
+    while(self->head){
+        pyclient = unlink_waiter(self, self->head);
+        if(!pyclient->suspended || pyclient->resumed){
+            //resumed by someone else
+            Py_DECREF(pyclient);
+            continue;
+        }
+        Py_INCREF(switch_args);
+        pyclient->args = switch_args;
+        pyclient->suspended = 0;
+        pyclient->resumed = 1;
+        enqueue(pyclient);
+        cnt++;
+    }
+    Py_DECREF(switch_args);
+    return Py_BuildValue("i", cnt);
+}
+
+static struct PyMethodDef ChannelObject_methods[] = {
+  {"wait",	(PyCFunction)ChannelObject_wait, METH_VARARGS, "suspend the current request until publish. return the published value"},
+  {"publish",	(PyCFunction)ChannelObject_publish, METH_VARARGS, "resume all waiting requests with value. return the number of resumed requests"},
+  {NULL,	NULL}
+};
+
+static PyMemberDef ChannelObject_members[] = {
+    {"waiters", T_INT, offsetof(ChannelObject, waiters), READONLY, "number of waiting requests"},
+    {NULL}
+};
+
+PyTypeObject ChannelObjectType = {
+	PyObject_HEAD_INIT(&PyType_Type)
+    0,
+    "meinheld.server.Channel",             /*tp_name*/
+    sizeof(ChannelObject), /*tp_basicsize*/
+    0,                         /*tp_itemsize*/
+    (destructor)ChannelObject_dealloc, /*tp_dealloc*/
+    0,                         /*tp_print*/
+    0,                         /*tp_getattr*/
+    0,                         /*tp_setattr*/
+    0,                         /*tp_compare*/
+    0,                         /*tp_repr*/
+    0,                         /*tp_as_number*/
+    0,                         /*tp_as_sequence*/
+    0,                         /*tp_as_mapping*/
+    0,                         /*tp_hash */
+    0,                         /*tp_call*/
+    0,                         /*tp_str*/
+    0,                         /*tp_getattro*/
+    0,                         /*tp_setattro*/
+    0,                         /*tp_as_buffer*/
+    Py_TPFLAGS_DEFAULT,        /*tp_flags*/
+    "pub/sub channel of suspended requests",      /* tp_doc */
+    0,		               /* tp_traverse */
+    0,		               /* tp_clear */
+    0,		               /* tp_richcompare */
+    0,		               /* tp_weaklistoffset */
+    0,		               /* tp_iter */
+    0,		               /* tp_iternext */
+    ChannelObject_methods,        /* tp_methods */
+    ChannelObject_members,        /* tp_members */
+    0,                         /* tp_getset */
+    0,                         /* tp_base */
+    0,                         /* tp_dict */
+    0,                         /* tp_descr_get */
+    0,                         /* tp_descr_set */
+    0,                         /* tp_dictoffset */
+    0,                      /* tp_init */
+    PyType_GenericAlloc,                         /* tp_alloc */
+    ChannelObject_new,                           /* tp_new */
+};
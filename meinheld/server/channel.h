@@ -0,0 +1,28 @@
+#ifndef CHANNEL_H
+#define CHANNEL_H
+
+#include <Python.h>
+#include "server.h"
+#include "client.h"
+
+typedef struct {
+    PyObject_HEAD
+    ClientObject *head;     // waiting clients
+    ClientObject *tail;
+    int waiters;
+} ChannelObject;
+
+extern PyTypeObject ChannelObjectType;
+
+extern int channel_budget; // max resumes per loop iteration
+
+inline int
+channel_pending(void);
+
+inline void
+channel_dispatch(picoev_loop *loop);
+
+inline void
+channel_clear(void);
+
+#endif
@@ -0,0 +1,241 @@
+#include "child.h"
+#include "fdwait.h"
+#include <signal.h>
+#include <fcntl.h>
+#include <sys/wait.h>
+#include <poll.h>
+
+#define WAITPID_POLL_MSEC 10
+
+/*
+ * SIGCHLD child reaper.
+ * the handler writes a byte to a self pipe watched on the main loop,
+ * the loop reaps the children waited by greenlets and wakes them up.
+ * installed by the first wait_child, children nobody waits are left alone.
+ */
+
+typedef struct _child_waiter {
+    pid_t pid;
+    pid_t ret;              // waitpid result
+    int status;
+    int err;                // errno if ret is -1
+    int done;
+    void *waiter;           // parked greenlet (wait_wakeup)
+    struct _child_waiter *next;
+} child_waiter;
+
+static int sigchld_pipe[2] = {-1, -1};
+static struct sigaction old_sigchld;
+static child_waiter *waiters = NULL;
+
+static void
+sigchld_handler(int sig)
+{
+    int old_errno = errno;
+
+    if(write(sigchld_pipe[1], "c", 1) == -1){
+        //pipe is full, the loop wakes up anyway
+    }
+    //the python handler
+    if(old_sigchld.sa_handler != SIG_DFL && old_sigchld.sa_handler != SIG_IGN){
+        old_sigchld.sa_handler(sig);
+    }
+    errno = old_errno;
+}
+
+static void
+reap_callback(picoev_loop* loop, int fd, int events, void* cb_arg)
+{
+    char buf[64];
+    child_waiter *c;
+    void *waiter;
+
+    while(read(fd, buf, sizeof(buf)) > 0){
+    }
+    for(c = waiters; c != NULL; c = c->next){
+        if(c->done){
+            continue;
+        }
+        c->ret = waitpid(c->pid, &c->status, WNOHANG);
+        if(c->ret == 0){
+            continue;
+        }
+        c->err = errno;
+        c->done = 1;
+#ifdef DEBUG
+        printf("reap_callback pid:%d status:%d \n", c->pid, c->status);
+#endif
+    }
+    //a woken greenlet removes its waiter, scan again from the head
+    c = waiters;
+    while(c != NULL){
+        if(c->done && c->waiter){
+            waiter = c->waiter;
+            c->waiter = NULL;
+            wakeup(waiter);
+            c = waiters;
+            continue;
+        }
+        c = c->next;
+    }
+}
+
+static inline int
+set_pipe_flags(int fd)
+{
+    if(fcntl(fd, F_SETFL, fcntl(fd, F_GETFL, 0) | O_NONBLOCK) == -1){
+        return -1;
+    }
+    return fcntl(fd, F_SETFD, FD_CLOEXEC);
+}
+
+static inline int
+child_install(void)
+{
+    struct sigaction context;
+
+    if(sigchld_pipe[0] != -1){
+        return 0;
+    }
+    if(pipe(sigchld_pipe) == -1){
+        PyErr_SetFromErrno(PyExc_OSError);
+        return -1;
+    }
+    if(set_pipe_flags(sigchld_pipe[0]) == -1 || set_pipe_flags(sigchld_pipe[1]) == -1){
+        goto error;
+    }
+    context.sa_handler = sigchld_handler;
+    sigemptyset(&context.sa_mask);
+    context.sa_flags = SA_RESTART | SA_NOCLDSTOP;
+    if(sigaction(SIGCHLD, &context, &old_sigchld) == -1){
+        goto error;
+    }
+    return 0;
+
+error:
+    PyErr_SetFromErrno(PyExc_OSError);
+    close(sigchld_pipe[0]);
+    close(sigchld_pipe[1]);
+    sigchld_pipe[0] = sigchld_pipe[1] = -1;
+    return -1;
+}
+
+/*
+ * watch the self pipe on the loop
+ */
+inline void
+child_start(picoev_loop *loop)
+{
+    int fd = sigchld_pipe[0];
+
+    if(fd == -1 || !PICOEV_IS_INITED_AND_FD_IN_RANGE(fd)){
+        return;
+    }
+    if(!picoev_is_active(loop, fd)){
+        picoev_add(loop, fd, PICOEV_READ, 0, reap_callback, NULL);
+    }
+}
+
+static inline void
+remove_waiter(child_waiter *target)
+{
+    child_waiter **p;
+
+    for(p = &waiters; *p != NULL; p = &(*p)->next){
+        if(*p == target){
+            *p = target->next;
+            break;
+        }
+    }
+    PyMem_Free(target);
+}
+
+/*
+ * fast path request, can't switch. polls the child on the hub stack,
+ * at most BLOCKING_WAIT_MSEC
+ */
+static inline pid_t
+waitpid_blocking(pid_t pid, int *status)
+{
+    pid_t ret;
+    int msec = 0;
+
+    while(1){
+        ret = waitpid(pid, status, WNOHANG);
+        if(ret == -1 && errno == EINTR){
+            if(PyErr_CheckSignals()){
+                return -1;
+            }
+            continue;
+        }
+        if(ret != 0){
+            break;
+        }
+        if(msec >= BLOCKING_WAIT_MSEC){
+            PyErr_SetString(timeout_error, "timeout");
+            return -1;
+        }
+        Py_BEGIN_ALLOW_THREADS
+        poll(NULL, 0, WAITPID_POLL_MSEC);
+        Py_END_ALLOW_THREADS
+        msec += WAITPID_POLL_MSEC;
+    }
+    if(ret == -1){
+        PyErr_SetFromErrno(PyExc_OSError);
+    }
+    return ret;
+}
+
+/*
+ * waitpid(pid, status, 0) parking the current greenlet until
+ * the child exits. return pid or -1 with an error set.
+ */
+inline pid_t
+wait_child(pid_t pid, int *status)
+{
+    child_waiter *c;
+    pid_t ret;
+
+    if(!can_suspend()){
+        return waitpid_blocking(pid, status);
+    }
+    if(child_install() == -1){
+        return -1;
+    }
+    child_start(main_loop);
+
+    ret = waitpid(pid, status, WNOHANG);
+    if(ret != 0){
+        if(ret == -1){
+            PyErr_SetFromErrno(PyExc_OSError);
+        }
+        return ret;
+    }
+
+    //the greenlet stack is swapped out while waiting, keep it on the heap
+    c = (child_waiter *)PyMem_Malloc(sizeof(child_waiter));
+    if(c == NULL){
+        PyErr_NoMemory();
+        return -1;
+    }
+    memset(c, 0, sizeof(child_waiter));
+    c->pid = pid;
+    c->next = waiters;
+    waiters = c;
+
+    //exited before the waiter was listed, the pipe is readable
+    while(!c->done){
+        if(wait_wakeup(&c->waiter, -1) == -1){
+            remove_waiter(c);
+            return -1;
+        }
+    }
+    ret = c->ret;
+    *status = c->status;
+    if(ret == -1){
+        errno = c->err;
+        PyErr_SetFromErrno(PyExc_OSError);
+    }
+    remove_waiter(c);
+    return ret;
+}
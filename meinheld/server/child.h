@@ -0,0 +1,13 @@
+#ifndef CHILD_H
+#define CHILD_H
+
+#include <Python.h>
+#include "server.h"
+
+inline void
+child_start(picoev_loop *loop);
+
+inline pid_t
+wait_child(pid_t pid, int *status);
+
+#endif
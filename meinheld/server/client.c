@@ -1,38 +1,44 @@
 #include "client.h"
 #include "greenlet.h"
+#include "sendqueue.h"
+#include "stream.h"
 
-#define CLIENT_MAXFREELIST 1024
+#define CLIENT_MINFREELIST 256
+#define CLIENT_MAXFREELIST 1024 * 16
 
-static ClientObject *client_free_list[CLIENT_MAXFREELIST];
-static int client_numfree = 0;
+static freelist client_free_list;
+
+static void *
+new_ClientObject(void)
+{
+    return PyObject_NEW(ClientObject, &ClientObjectType);
+}
+
+static void
+del_ClientObject(void *op)
+{
+    PyObject_DEL(op);
+}
 
 inline void
 ClientObject_list_fill(void)
 {
-    ClientObject *client;
-	while (client_numfree < CLIENT_MAXFREELIST) {
-        client = PyObject_NEW(ClientObject, &ClientObjectType);
-		client_free_list[client_numfree++] = client;
-	}
+    freelist_init(&client_free_list, "ClientObject", CLIENT_MINFREELIST, CLIENT_MAXFREELIST, new_ClientObject, del_ClientObject);
+    freelist_fill(&client_free_list);
 }
 
 inline void
 ClientObject_list_clear(void)
 {
-	ClientObject *op;
-
-	while (client_numfree) {
-		op = client_free_list[--client_numfree];
-        PyObject_DEL(op);
-	}
+    freelist_clear(&client_free_list);
 }
 
 static inline ClientObject*
 alloc_ClientObject(void)
 {
     ClientObject *client;
-	if (client_numfree) {
-		client = client_free_list[--client_numfree];
+    client = (ClientObject *)freelist_pop(&client_free_list);
+	if (client) {
 		_Py_NewReference((PyObject *)client);
 #ifdef DEBUG
         printf("use pooled ClientObject %p\n", client);
@@ -50,11 +56,10 @@ static inline void
 dealloc_ClientObject(ClientObject *client)
 {
     Py_CLEAR(client->greenlet);
-	if (client_numfree < CLIENT_MAXFREELIST){
+	if (freelist_push(&client_free_list, client)){
 #ifdef DEBUG
         printf("back to ClientObject pool %p\n", client);
 #endif
-		client_free_list[client_numfree++] = client;
     }else{
 	    PyObject_DEL(client);
     }
@@ -85,6 +90,9 @@ ClientObject_New(client_t* client)
     o->kwargs = NULL;
     o->suspended = 0;    
     o->resumed = 0;    
+    o->channel = NULL;
+    o->chan_prev = NULL;
+    o->chan_next = NULL;
 
 #ifdef DEBUG
     if(o->client){
@@ -151,9 +159,22 @@ ClientObject_get_greenlet(ClientObject *self, PyObject *args)
     Py_RETURN_NONE;
 }
 
+static inline int
+check_closed(ClientObject *self)
+{
+    if(self->client == NULL){
+        PyErr_SetString(PyExc_IOError, "client closed");
+        return 1;
+    }
+    return 0;
+}
+
 static inline PyObject *
 ClientObject_get_fd(ClientObject *self, PyObject *args)
 {
+    if(check_closed(self)){
+        return NULL;
+    }
     return Py_BuildValue("i", self->client->fd);
 }
 
@@ -165,15 +186,130 @@ ClientObject_set_closed(ClientObject *self, PyObject *args)
     if (!PyArg_ParseTuple(args, "i:set_closed", &closed)){
         return NULL;
     }
+    if(check_closed(self)){
+        return NULL;
+    }
     self->client->response_closed = closed;
     Py_RETURN_NONE;
 }
 
+static inline PyObject *
+ClientObject_queue_send(ClientObject *self, PyObject *args)
+{
+    PyObject *data;
+
+    if (!PyArg_ParseTuple(args, "O:queue_send", &data)){
+        return NULL;
+    }
+    if(check_closed(self)){
+        return NULL;
+    }
+    if(send_queue_push(self->client, data) == -1){
+        return NULL;
+    }
+    Py_RETURN_NONE;
+}
+
+static inline PyObject *
+ClientObject_send(ClientObject *self, PyObject *args)
+{
+    PyObject *data;
+
+    if (!PyArg_ParseTuple(args, "O:send", &data)){
+        return NULL;
+    }
+    if(check_closed(self)){
+        return NULL;
+    }
+    return send_queue_send(self, data);
+}
+
+static inline PyObject *
+ClientObject_get_queued(ClientObject *self, PyObject *args)
+{
+    if(self->client == NULL){
+        return Py_BuildValue("i", 0);
+    }
+    return Py_BuildValue("n", (Py_ssize_t)send_queue_bytes(self->client));
+}
+
+static inline PyObject *
+ClientObject_wait_sent(ClientObject *self, PyObject *args)
+{
+    Py_ssize_t mark = 0;
+
+    if (!PyArg_ParseTuple(args, "|n:wait_sent", &mark)){
+        return NULL;
+    }
+    if(check_closed(self)){
+        return NULL;
+    }
+    if(mark < 0){
+        PyErr_SetString(PyExc_ValueError, "mark value out of range ");
+        return NULL;
+    }
+    return send_queue_wait(self, (size_t)mark);
+}
+
+/*
+ * hand the connection to the app as a Stream.
+ * the server stops managing the fd when the app returns.
+ */
+static inline PyObject *
+ClientObject_detach(ClientObject *self, PyObject *args)
+{
+    client_t *client;
+    PyObject *input, *buffer = NULL, *stream;
+
+    if(check_closed(self)){
+        return NULL;
+    }
+    client = self->client;
+    if(client->detached){
+        PyErr_SetString(PyExc_IOError, "already detached");
+        return NULL;
+    }
+    if(send_queue_bytes(client) > 0){
+        PyErr_SetString(PyExc_IOError, "send queue is not empty");
+        return NULL;
+    }
+    if(!self->greenlet){
+        //Stream I/O would block the loop, retry the path in a greenlet
+        mark_cooperative(client);
+        PyErr_SetString(PyExc_ValueError, "greenlet is not set");
+        return NULL;
+    }
+    //read ahead bytes (upgrade) or the unread body
+    input = PyDict_GetItemString(client->environ, "wsgi.input");
+    if(input){
+        buffer = PyObject_CallMethod(input, "read", NULL);
+        if(buffer == NULL){
+            return NULL;
+        }
+    }
+    stream = StreamObject_New(client->fd, client->tls, buffer);
+    Py_XDECREF(buffer);
+    if(stream == NULL){
+        return NULL;
+    }
+    send_queue_free(client);
+    client->tls = NULL;
+    client->detached = 1;
+    client->keep_alive = 0;
+    client->response_closed = 1;
+    return stream;
+}
+
 static PyMethodDef ClientObject_method[] = {
     { "set_greenlet",      (PyCFunction)ClientObject_set_greenlet, METH_VARARGS, 0 },
     { "get_greenlet",      (PyCFunction)ClientObject_get_greenlet, METH_NOARGS, 0 },
     {"get_fd", (PyCFunction)ClientObject_get_fd, METH_VARARGS, "get fd"},
     {"set_closed", (PyCFunction)ClientObject_set_closed, METH_VARARGS, "set response closed"},
+    {"queue_send", (PyCFunction)ClientObject_queue_send, METH_VARARGS, "queue data, the loop writes it when the socket is writable"},
+    {"send", (PyCFunction)ClientObject_send, METH_VARARGS, "queue data, wait for the drain to the low watermark if over the high watermark"},
+    {"get_queued", (PyCFunction)ClientObject_get_queued, METH_VARARGS, "return queued bytes"},
+    {"wait_sent", (PyCFunction)ClientObject_wait_sent, METH_VARARGS, "wait until queued bytes <= mark (default 0)"},
+    {"detach", (PyCFunction)ClientObject_detach, METH_NOARGS, "return the connection as a Stream, the server doesn't write the response"},
     { NULL, NULL}
 };
 
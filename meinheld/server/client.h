@@ -3,6 +3,8 @@
 
 #include "server.h"
 #include "greenlet.h"
+#include "compress.h"
+#include "tls.h"
 
 typedef struct _client {
     int fd;
@@ -19,8 +21,14 @@ typedef struct _client {
     request_body_type body_type;    
     char upgrade;               // new protocol
     uint8_t complete;
+    uint8_t expect_continue;    // Expect: 100-continue, 100 not sent yet
+    uint8_t body_pending;       // app called before the body was read
+    uint8_t chunked_request;    // Transfer-Encoding: chunked
+    uint8_t body_stream;        // wsgi.input reads the chunks as they are decoded
+    PyObject *continue_input;   // lazy wsgi.input (borrowed)
 
     http_parser *http;          // http req parser
+    arena *arena;               // per connection arena
     PyObject *environ;          // wsgi environ
     int status_code;            // response status code
     
@@ -36,9 +44,17 @@ typedef struct _client {
     void *bucket;               //write_data
     uint8_t response_closed;    //response closed flag
     uint8_t use_cork;     // use TCP_CORK
+    uint8_t in_app;       // counted in in-flight requests
+    z_stream *zstream;    // gzip response body
+    char *content_encoding;   // precompressed file encoding (static string)
+    uint8_t vary_encoding;    // add Vary: Accept-Encoding
+    char length_buf[24];      // Content-Length set by the server, lives until the headers are sent
+    void *tls;            // TLS session (SSL *)
+    void *send_queue;     // queued writes of the upgraded connection
+    uint8_t detached;     // the app owns the fd (Stream)
 } client_t;
 
-typedef struct {
+typedef struct _ClientObject {
     PyObject_HEAD
     client_t *client;
     PyGreenlet *greenlet;
@@ -46,6 +62,9 @@ typedef struct {
     PyObject *kwargs;       //greenlet.switch value
     uint8_t suspended;
     uint8_t resumed;
+    PyObject *channel;      //waiting channel
+    struct _ClientObject *chan_prev; //channel waiters or resume queue
+    struct _ClientObject *chan_next;
 } ClientObject;
 
 extern PyTypeObject ClientObjectType;
@@ -65,5 +84,15 @@ ClientObject_list_fill(void);
 inline void
 ClientObject_list_clear(void);
 
+/* server.c */
+inline void
+mark_cooperative(client_t *cli);
+
+inline PyObject*
+switch_to_hub(ClientObject *pyclient);
+
+inline int
+wait_fd(int fd, int event, int timeout);
+
 
 #endif
@@ -0,0 +1,128 @@
+#include "compress.h"
+#include "freelist.h"
+
+#define GZIP_MINFREELIST 4
+#define GZIP_MAXFREELIST 1024
+
+#define GZIP_WBITS 15 + 16  // gzip header and trailer
+#define GZIP_MEMLEVEL 8
+
+typedef struct {
+    z_stream zs;        // must be first
+    int level;
+} gzip_stream;
+
+/* deflate states are expensive to set up, reuse them */
+static freelist gzip_free_list;
+
+static void
+del_gzip_stream(void *p)
+{
+    gzip_stream *gs = (gzip_stream *)p;
+    deflateEnd(&gs->zs);
+    PyMem_Free(gs);
+}
+
+static inline gzip_stream *
+new_gzip_stream(int level)
+{
+    gzip_stream *gs;
+
+    gs = (gzip_stream *)PyMem_Malloc(sizeof(gzip_stream));
+    if(gs == NULL){
+        return NULL;
+    }
+    memset(gs, 0, sizeof(gzip_stream));
+    if(deflateInit2(&gs->zs, level, Z_DEFLATED, GZIP_WBITS, GZIP_MEMLEVEL, Z_DEFAULT_STRATEGY) != Z_OK){
+        PyMem_Free(gs);
+        return NULL;
+    }
+    gs->level = level;
+#ifdef DEBUG
+    printf("new gzip stream %p level %d \n", gs, level);
+#endif
+    return gs;
+}
+
+inline z_stream *
+acquire_gzip_stream(int level)
+{
+    gzip_stream *gs;
+
+    if(gzip_free_list.items == NULL){
+        freelist_init(&gzip_free_list, "gzip", GZIP_MINFREELIST, GZIP_MAXFREELIST, NULL, del_gzip_stream);
+    }
+    gs = (gzip_stream *)freelist_pop(&gzip_free_list);
+    if(gs == NULL){
+        gs = new_gzip_stream(level);
+        if(gs == NULL){
+            //compression is optional, send it plain
+            gzip_free_list.used--;
+            return NULL;
+        }
+    }else if(gs->level != level){
+        deflateParams(&gs->zs, level, Z_DEFAULT_STRATEGY);
+        gs->level = level;
+    }
+    return &gs->zs;
+}
+
+inline void
+release_gzip_stream(z_stream *zs)
+{
+    gzip_stream *gs = (gzip_stream *)zs;
+
+    if(deflateReset(zs) != Z_OK || !freelist_push(&gzip_free_list, gs)){
+        del_gzip_stream(gs);
+    }
+}
+
+/*
+ * compress data, return new string (may be empty)
+ */
+inline PyObject *
+gzip_data(z_stream *zs, char *data, size_t len, int flush)
+{
+    PyObject *o;
+    size_t size, used = 0;
+    int ret;
+
+    size = deflateBound(zs, len) + 16;
+    o = PyString_FromStringAndSize(NULL, size);
+    if(o == NULL){
+        return NULL;
+    }
+    zs->next_in = (Bytef *)data;
+    zs->avail_in = len;
+    while(1){
+        zs->next_out = (Bytef *)PyString_AS_STRING(o) + used;
+        zs->avail_out = size - used;
+        ret = deflate(zs, flush);
+        if(ret != Z_OK && ret != Z_STREAM_END && ret != Z_BUF_ERROR){
+            Py_DECREF(o);
+            PyErr_SetString(PyExc_IOError, "deflate error");
+            return NULL;
+        }
+        used = size - zs->avail_out;
+        if(zs->avail_out != 0){
+            break;
+        }
+        //grow output
+        size *= 2;
+        if(_PyString_Resize(&o, size) == -1){
+            return NULL;
+        }
+    }
+    if(_PyString_Resize(&o, used) == -1){
+        return NULL;
+    }
+    return o;
+}
+
+inline void
+gzip_list_clear(void)
+{
+    if(gzip_free_list.items){
+        freelist_clear(&gzip_free_list);
+    }
+}
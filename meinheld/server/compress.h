@@ -0,0 +1,19 @@
+#ifndef COMPRESS_H
+#define COMPRESS_H
+
+#include <Python.h>
+#include <zlib.h>
+
+inline z_stream *
+acquire_gzip_stream(int level);
+
+inline void
+release_gzip_stream(z_stream *zs);
+
+inline PyObject *
+gzip_data(z_stream *zs, char *data, size_t len, int flush);
+
+inline void
+gzip_list_clear(void);
+
+#endif
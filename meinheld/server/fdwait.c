@@ -0,0 +1,294 @@
+#include "fdwait.h"
+#include "client.h"
+#include "protocol.h"
+#include "timer.h"
+#include <poll.h>
+
+/*
+ * wait for the first ready fd of a set (select/poll) in the app greenlet.
+ * every fd is registered on the main loop with the waiter, the first
+ * event or the timer removes them all and resumes the greenlet.
+ */
+
+typedef struct {
+    PyObject *pyclient;     // request greenlet
+    void *conn;             // protocol connection greenlet
+    int *fds;
+    int nfds;
+    loop_timer *timer;
+    int ready;              // 1: an fd is ready, 0: timeout
+} fds_waiter;
+
+static void
+fds_callback(picoev_loop* loop, int fd, int events, void* cb_arg);
+
+static inline int
+is_owner(fds_waiter *w, int fd)
+{
+    picoev_fd *target = picoev.fds + fd;
+
+    return picoev_is_active(main_loop, fd) &&
+        target->callback == fds_callback && target->cb_arg == (void *)w;
+}
+
+static inline void
+unwatch_fds(fds_waiter *w)
+{
+    int i;
+
+    for(i = 0; i < w->nfds; i++){
+        if(is_owner(w, w->fds[i])){
+            picoev_del(main_loop, w->fds[i]);
+        }
+    }
+    if(w->timer){
+        timer_cancel(w->timer);
+        w->timer = NULL;
+    }
+}
+
+static inline void
+free_waiter(fds_waiter *w)
+{
+    PyMem_Free(w->fds);
+    PyMem_Free(w);
+}
+
+static inline void
+wake(fds_waiter *w, int ready)
+{
+    PyObject *pyclient = w->pyclient;
+    void *conn = w->conn;
+
+    unwatch_fds(w);
+    w->ready = ready;
+    //the greenlet frees the waiter
+    if(conn){
+        protocol_resume(conn);
+    }else{
+        resume_app(pyclient);
+    }
+}
+
+static void
+fds_callback(picoev_loop* loop, int fd, int events, void* cb_arg)
+{
+#ifdef DEBUG
+    printf("fds_callback fd:%d events:%d \n", fd, events);
+#endif
+    wake((fds_waiter *)cb_arg, 1);
+}
+
+static void
+fds_timeout_callback(void *arg)
+{
+    fds_waiter *w = (fds_waiter *)arg;
+
+    //timer_run frees it
+    w->timer = NULL;
+    wake(w, 0);
+}
+
+/*
+ * fast path request, can't switch. blocks the loop,
+ * at most BLOCKING_WAIT_MSEC
+ */
+static inline int
+poll_blocking(int *fds, int *events, int nfds, int timeout_msec)
+{
+    struct pollfd *pfds;
+    int i, ret, capped = 0;
+
+    if(timeout_msec < 0 || timeout_msec > BLOCKING_WAIT_MSEC){
+        timeout_msec = BLOCKING_WAIT_MSEC;
+        capped = 1;
+    }
+
+    pfds = (struct pollfd *)PyMem_Malloc(sizeof(struct pollfd) * (nfds ? nfds : 1));
+    if(pfds == NULL){
+        PyErr_NoMemory();
+        return -1;
+    }
+    for(i = 0; i < nfds; i++){
+        pfds[i].fd = fds[i];
+        pfds[i].events = 0;
+        pfds[i].revents = 0;
+        if(events[i] & PICOEV_READ){
+            pfds[i].events |= POLLIN;
+        }
+        if(events[i] & PICOEV_WRITE){
+            pfds[i].events |= POLLOUT;
+        }
+    }
+    Py_BEGIN_ALLOW_THREADS
+    ret = poll(pfds, nfds, timeout_msec);
+    Py_END_ALLOW_THREADS
+    PyMem_Free(pfds);
+    if(ret < 0){
+        if(errno == EINTR){
+            return 1;
+        }
+        PyErr_SetFromErrno(PyExc_IOError);
+        return -1;
+    }
+    if(ret == 0 && capped){
+        PyErr_SetString(timeout_error, "timeout");
+        return -1;
+    }
+    return ret > 0 ? 1 : 0;
+}
+
+/*
+ * the current greenlet can switch to the hub.
+ * a fast path request runs in a greenlet from now on.
+ */
+inline int
+can_suspend(void)
+{
+    ClientObject *pyclient;
+
+    if(in_protocol()){
+        return 1;
+    }
+    pyclient = (ClientObject *)current_client;
+    if(pyclient && pyclient->greenlet){
+        return 1;
+    }
+    if(pyclient){
+        mark_cooperative(pyclient->client);
+    }
+    return 0;
+}
+
+static inline fds_waiter*
+new_waiter(int nfds)
+{
+    fds_waiter *w;
+
+    //the greenlet stack is swapped out while waiting, keep it on the heap
+    w = (fds_waiter *)PyMem_Malloc(sizeof(fds_waiter));
+    if(w == NULL){
+        PyErr_NoMemory();
+        return NULL;
+    }
+    memset(w, 0, sizeof(fds_waiter));
+    w->fds = (int *)PyMem_Malloc(sizeof(int) * (nfds ? nfds : 1));
+    if(w->fds == NULL){
+        PyMem_Free(w);
+        PyErr_NoMemory();
+        return NULL;
+    }
+    if(in_protocol()){
+        w->conn = protocol_current();
+    }else{
+        w->pyclient = current_client;
+    }
+    return w;
+}
+
+/*
+ * switch to the hub until wake, return 1 if woken by an fd or
+ * wakeup, 0 on timeout and -1 on error. frees the waiter.
+ */
+static inline int
+suspend(fds_waiter *w, int timeout_msec)
+{
+    PyObject *res;
+    int ret;
+
+    if(timeout_msec >= 0){
+        w->timer = timer_add(timeout_msec, fds_timeout_callback, (void *)w);
+        if(w->timer == NULL){
+            unwatch_fds(w);
+            free_waiter(w);
+            return -1;
+        }
+    }
+    if(w->conn){
+        ret = protocol_suspend();
+    }else{
+        res = switch_to_hub((ClientObject *)w->pyclient);
+        ret = res ? 0 : -1;
+        Py_XDECREF(res);
+    }
+    if(ret == -1){
+        unwatch_fds(w);
+    }else{
+        ret = w->ready;
+    }
+    free_waiter(w);
+    return ret;
+}
+
+/*
+ * wait until one of fds is ready for events (PICOEV_READ | PICOEV_WRITE)
+ * or timeout_msec (-1: no timeout) passed.
+ * return 1 if ready, 0 on timeout and -1 on error.
+ */
+inline int
+wait_fds(int *fds, int *events, int nfds, int timeout_msec)
+{
+    fds_waiter *w;
+    int i, fd;
+
+    if(!can_suspend()){
+        return poll_blocking(fds, events, nfds, timeout_msec);
+    }
+    for(i = 0; i < nfds; i++){
+        if(!PICOEV_IS_INITED_AND_FD_IN_RANGE(fds[i])){
+            PyErr_SetString(PyExc_ValueError, "fileno value out of range ");
+            return -1;
+        }
+    }
+    w = new_waiter(nfds);
+    if(w == NULL){
+        return -1;
+    }
+    for(i = 0; i < nfds; i++){
+        fd = fds[i];
+        if(is_owner(w, fd)){
+            //listed twice
+            picoev_set_events(main_loop, fd, picoev_get_events(main_loop, fd) | events[i]);
+            continue;
+        }
+        if(picoev_is_active(main_loop, fd)){
+            //like trampoline
+            picoev_del(main_loop, fd);
+        }
+        if(picoev_add(main_loop, fd, events[i], 0, fds_callback, (void *)w) == -1){
+            PyErr_SetFromErrno(PyExc_IOError);
+            unwatch_fds(w);
+            free_waiter(w);
+            return -1;
+        }
+        w->fds[w->nfds++] = fd;
+    }
+    return suspend(w, timeout_msec);
+}
+
+/*
+ * park the current greenlet (can_suspend) until wakeup(*slot) or
+ * timeout_msec (-1: no timeout) passed. *slot is the waiter while parked.
+ * return 1 if woken, 0 on timeout and -1 on error.
+ */
+inline int
+wait_wakeup(void **slot, int timeout_msec)
+{
+    fds_waiter *w;
+    int ret;
+
+    w = new_waiter(0);
+    if(w == NULL){
+        return -1;
+    }
+    *slot = w;
+    ret = suspend(w, timeout_msec);
+    *slot = NULL;
+    return ret;
+}
+
+inline void
+wakeup(void *waiter)
+{
+    wake((fds_waiter *)waiter, 1);
+}
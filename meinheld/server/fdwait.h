@@ -0,0 +1,19 @@
+#ifndef FDWAIT_H
+#define FDWAIT_H
+
+#include <Python.h>
+#include "server.h"
+
+inline int
+can_suspend(void);
+
+inline int
+wait_fds(int *fds, int *events, int nfds, int timeout_msec);
+
+inline int
+wait_wakeup(void **slot, int timeout_msec);
+
+inline void
+wakeup(void *waiter);
+
+#endif
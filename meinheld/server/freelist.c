@@ -0,0 +1,181 @@
+#include "freelist.h"
+
+#define MAX_FREELISTS 16
+
+static freelist *freelists[MAX_FREELISTS];
+static int freelists_size = 0;
+
+inline int
+freelist_init(freelist *fl, const char *name, int min_size, int max_size, freelist_alloc_func alloc, freelist_free_func free)
+{
+    int i;
+
+    if(fl->items == NULL){
+        fl->items = (void **)PyMem_Malloc(sizeof(void *) * min_size);
+        if(fl->items == NULL){
+            PyErr_NoMemory();
+            return -1;
+        }
+        fl->size = min_size;
+        fl->numfree = 0;
+    }
+    fl->name = name;
+    fl->min_size = min_size;
+    fl->max_size = max_size;
+    fl->alloc = alloc;
+    fl->free = free;
+    fl->used = 0;
+    fl->peak = 0;
+    fl->hits = fl->misses = fl->drops = 0;
+
+    for(i = 0; i < freelists_size; i++){
+        if(freelists[i] == fl){
+            return 0;
+        }
+    }
+    if(freelists_size < MAX_FREELISTS){
+        freelists[freelists_size++] = fl;
+    }
+    return 0;
+}
+
+inline void *
+freelist_pop(freelist *fl)
+{
+    fl->used++;
+    if(fl->used > fl->peak){
+        fl->peak = fl->used;
+    }
+    if(fl->numfree){
+        fl->hits++;
+        return fl->items[--fl->numfree];
+    }
+    fl->misses++;
+    return NULL;
+}
+
+static inline int
+grow_freelist(freelist *fl)
+{
+    void **items;
+    int size;
+
+    size = fl->size * 2;
+    if(size > fl->max_size){
+        size = fl->max_size;
+    }
+    if(size <= fl->size){
+        return -1;
+    }
+    items = (void **)PyMem_Realloc(fl->items, sizeof(void *) * size);
+    if(items == NULL){
+        return -1;
+    }
+#ifdef DEBUG
+    printf("grow freelist %s %d -> %d \n", fl->name, fl->size, size);
+#endif
+    fl->items = items;
+    fl->size = size;
+    return 0;
+}
+
+/*
+ * Return 1 if the item was pooled, 0 if the caller must release it.
+ * The list grows up to the observed high-water mark, bounded by max_size.
+ */
+inline int
+freelist_push(freelist *fl, void *item)
+{
+    if(fl->used > 0){
+        fl->used--;
+    }
+    if(fl->numfree == fl->size){
+        if(fl->numfree >= fl->peak || grow_freelist(fl) == -1){
+            fl->drops++;
+            return 0;
+        }
+    }
+    fl->items[fl->numfree++] = item;
+    return 1;
+}
+
+inline void
+freelist_fill(freelist *fl)
+{
+    void *item;
+    while(fl->numfree < fl->min_size){
+        item = fl->alloc();
+        if(item == NULL){
+            break;
+        }
+        fl->items[fl->numfree++] = item;
+    }
+}
+
+inline void
+freelist_clear(freelist *fl)
+{
+    while(fl->numfree){
+        fl->free(fl->items[--fl->numfree]);
+    }
+}
+
+/*
+ * Release pooled items above the high-water mark of the last period and
+ * start a new period.
+ */
+static inline void
+freelist_decay(freelist *fl)
+{
+    int keep;
+
+    keep = fl->peak - fl->used;
+    if(keep < fl->min_size){
+        keep = fl->min_size;
+    }
+    while(fl->numfree > keep){
+        fl->free(fl->items[--fl->numfree]);
+    }
+    fl->peak = fl->used;
+}
+
+inline void
+freelist_decay_all(void)
+{
+    int i;
+    for(i = 0; i < freelists_size; i++){
+        freelist_decay(freelists[i]);
+    }
+}
+
+inline PyObject *
+freelist_stats(void)
+{
+    int i;
+    freelist *fl;
+    PyObject *stats, *item;
+
+    stats = PyDict_New();
+    if(stats == NULL){
+        return NULL;
+    }
+    for(i = 0; i < freelists_size; i++){
+        fl = freelists[i];
+        item = Py_BuildValue("{s:K,s:K,s:K,s:i,s:i,s:i,s:i,s:i}",
+                "hits", (unsigned PY_LONG_LONG)fl->hits,
+                "misses", (unsigned PY_LONG_LONG)fl->misses,
+                "drops", (unsigned PY_LONG_LONG)fl->drops,
+                "free", fl->numfree,
+                "size", fl->size,
+                "max_size", fl->max_size,
+                "used", fl->used,
+                "peak", fl->peak);
+        if(item == NULL){
+            Py_DECREF(stats);
+            return NULL;
+        }
+        PyDict_SetItemString(stats, fl->name, item);
+        Py_DECREF(item);
+    }
+    return stats;
+}
@@ -0,0 +1,47 @@
+#ifndef FREELIST_H
+#define FREELIST_H
+
+#include <Python.h>
+#include <inttypes.h>
+
+typedef void *(*freelist_alloc_func)(void);
+typedef void (*freelist_free_func)(void *);
+
+typedef struct {
+    const char *name;
+    void **items;
+    int numfree;
+    int size;           // slots
+    int min_size;       // prefill size, never shrink below
+    int max_size;       // upper bound
+    int used;           // objects handed out
+    int peak;           // high-water mark of used objects
+    freelist_alloc_func alloc;
+    freelist_free_func free;
+    uint64_t hits;
+    uint64_t misses;
+    uint64_t drops;     // released because the list was full
+} freelist;
+
+inline int
+freelist_init(freelist *fl, const char *name, int min_size, int max_size, freelist_alloc_func alloc, freelist_free_func free);
+
+inline void *
+freelist_pop(freelist *fl);
+
+inline int
+freelist_push(freelist *fl, void *item);
+
+inline void
+freelist_fill(freelist *fl);
+
+inline void
+freelist_clear(freelist *fl);
+
+inline void
+freelist_decay_all(void);
+
+inline PyObject *
+freelist_stats(void);
+
+#endif
@@ -2,6 +2,8 @@
 #include "response.h"
 #include "client.h"
 
+#define CHUNKED_BODY_BUF_SIZE 1024 * 8
+
 
 /**
  * environ spec.
@@ -54,6 +56,7 @@ static PyObject *version_key;
 static PyObject *version_val;
 static PyObject *scheme_key;
 static PyObject *scheme_val;
+static PyObject *https_scheme_val;
 static PyObject *errors_key;
 static PyObject *errors_val;
 static PyObject *multithread_key;
@@ -112,7 +115,11 @@ new_environ(client_t *client)
 
     environ = PyDict_New();
     PyDict_SetItem(environ, version_key, version_val);
-    PyDict_SetItem(environ, scheme_key, scheme_val);
+    if(client->tls){
+        PyDict_SetItem(environ, scheme_key, https_scheme_val);
+    }else{
+        PyDict_SetItem(environ, scheme_key, scheme_val);
+    }
     PyDict_SetItem(environ, errors_key, errors_val);
     PyDict_SetItem(environ, multithread_key, multithread_val);
     PyDict_SetItem(environ, multiprocess_key, multiprocess_val);
@@ -168,7 +175,12 @@ static inline int
 write_body2mem(client_t *client, const char *buf, size_t buf_len)
 {
     buffer *body = (buffer *)client->body;
-    write2buf(body, buf, buf_len);
+    if(buf == body->buf + body->len){
+        //read in place (body_read_space)
+        body->len += buf_len;
+    }else{
+        write2buf(body, buf, buf_len);
+    }
 
     client->body_readed += buf_len;
 #ifdef DEBUG
@@ -177,6 +189,30 @@ write_body2mem(client_t *client, const char *buf, size_t buf_len)
     return client->body_readed;
 }
 
+/*
+ * move the in-memory chunked body to a tmpfile
+ */
+static inline int
+spill_body2file(client_t *client)
+{
+    buffer *body = (buffer *)client->body;
+    FILE *tmp = tmpfile();
+    if(tmp == NULL){
+        return -1;
+    }
+    if(body->len && fwrite(body->buf, 1, body->len, tmp) != body->len){
+        fclose(tmp);
+        return -1;
+    }
+#ifdef DEBUG
+    printf("spill chunked body %d bytes to tmpfile \n", (int)body->len);
+#endif
+    free_buffer(body);
+    client->body = tmp;
+    client->body_type = BODY_TYPE_TMPFILE;
+    return 0;
+}
+
 static inline int
 write_body(client_t *cli, const char *buffer, size_t buffer_len)
 {
@@ -246,13 +282,16 @@ message_begin_cb(http_parser *p)
 
     client_t *client = get_client(p);
     
-    client->req = new_request();
+    client->req = new_request(client->arena);
     client->environ = new_environ(client);
     client->complete = 0;
     client->bad_request_code = 0;
     client->body_type = BODY_TYPE_NONE;
     client->body_readed = 0;
     client->body_length = 0;
+    client->expect_continue = 0;
+    client->chunked_request = 0;
+    client->body_stream = 0;
     client->req->env = client->environ;
     push_request(client->request_queue, client->req);
     return 0;
@@ -282,7 +321,7 @@ header_field_cb (http_parser *p, const char *buf, size_t len, char partial)
     if(h){
         ret = write2buf(h->field, temp, len);
     }else{
-        req->headers[i] = h = new_header(128, LIMIT_REQUEST_FIELD_SIZE, 2048, LIMIT_REQUEST_FIELD_SIZE);
+        req->headers[i] = h = new_header(client->arena, 64, LIMIT_REQUEST_FIELD_SIZE, 0, LIMIT_REQUEST_FIELD_SIZE);
         wsgi_header_type type = check_header_type(temp);
         if(type == OTHER){
             ret = write2buf(h->field, "HTTP_", 5);
@@ -319,7 +358,7 @@ header_value_cb (http_parser *p, const char *buf, size_t len, char partial)
     h = req->headers[i];
 
     if(h){
-        ret = write2buf(h->value, buf, len);
+        ret = view2buf(h->value, buf, len);
     }
     switch(ret){
         case MEMORY_ERROR:
@@ -345,8 +384,8 @@ request_path_cb (http_parser *p, const char *buf, size_t len, char partial)
     if(req->path){
         ret = write2buf(req->path, buf, len);
     }else{
-        req->path = new_buffer(1024, LIMIT_PATH);
-        ret = write2buf(req->path, buf, len);
+        req->path = new_arena_buffer(client->arena, 0, LIMIT_PATH);
+        ret = view2buf(req->path, buf, len);
     }
     switch(ret){
         case MEMORY_ERROR:
@@ -373,8 +412,8 @@ request_uri_cb (http_parser *p, const char *buf, size_t len, char partial)
     if(req->uri){
         ret = write2buf(req->uri, buf, len);
     }else{
-        req->uri = new_buffer(1024, LIMIT_URI);
-        ret = write2buf(req->uri, buf, len);
+        req->uri = new_arena_buffer(client->arena, 0, LIMIT_URI);
+        ret = view2buf(req->uri, buf, len);
     }
     switch(ret){
         case MEMORY_ERROR:
@@ -401,8 +440,8 @@ query_string_cb (http_parser *p, const char *buf, size_t len, char partial)
     if(req->query_string){
         ret = write2buf(req->query_string, buf, len);
     }else{
-        req->query_string = new_buffer(1024*2, LIMIT_QUERY_STRING);
-        ret = write2buf(req->query_string, buf, len);
+        req->query_string = new_arena_buffer(client->arena, 0, LIMIT_QUERY_STRING);
+        ret = view2buf(req->query_string, buf, len);
     }
     switch(ret){
         case MEMORY_ERROR:
@@ -428,8 +467,8 @@ fragment_cb (http_parser *p, const char *buf, size_t len, char partial)
     if(req->fragment){
         ret = write2buf(req->fragment, buf, len);
     }else{
-        req->fragment = new_buffer(1024, LIMIT_FRAGMENT);
-        ret = write2buf(req->fragment, buf, len);
+        req->fragment = new_arena_buffer(client->arena, 0, LIMIT_FRAGMENT);
+        ret = view2buf(req->fragment, buf, len);
     }
     switch(ret){
         case MEMORY_ERROR:
@@ -446,6 +485,44 @@ fragment_cb (http_parser *p, const char *buf, size_t len, char partial)
 }
 
 
+/*
+ * set up the body destination by the request size
+ */
+static inline int
+init_body(client_t *client)
+{
+    if(client->body_length < 0){
+        //Transfer-Encoding: chunked, size unknown
+        client->body = new_buffer(CHUNKED_BODY_BUF_SIZE, 0);
+        client->body_type = BODY_TYPE_BUFFER;
+#ifdef DEBUG
+        printf("chunked BODY_TYPE_BUFFER \n");
+#endif
+    }else if(client->body_length > client_body_buffer_size){
+        //large size request
+        FILE *tmp = tmpfile();
+        if(tmp == NULL){
+            return -1;
+        }
+        client->body = tmp;
+        client->body_type = BODY_TYPE_TMPFILE;
+#ifdef DEBUG
+        printf("BODY_TYPE_TMPFILE \n");
+#endif
+    }else{
+        //default memory stream
+#ifdef DEBUG
+        printf("client->body_length %d \n", client->body_length);
+#endif
+        client->body = new_buffer(client->body_length, 0);
+        client->body_type = BODY_TYPE_BUFFER;
+#ifdef DEBUG
+        printf("BODY_TYPE_BUFFER \n");
+#endif
+    }
+    return 0;
+}
+
 int
 body_cb (http_parser *p, const char *buf, size_t len, char partial)
 {
@@ -464,34 +541,49 @@ body_cb (http_parser *p, const char *buf, size_t len, char partial)
             client->bad_request_code = 411;
             return -1;
         }
-        if(client->body_length > client_body_buffer_size){
-            //large size request
-            FILE *tmp = tmpfile();
-            if(tmp < 0){
-                client->bad_request_code = 500;
-                return -1;
-            }
-            client->body = tmp;
-            client->body_type = BODY_TYPE_TMPFILE;
-#ifdef DEBUG
-            printf("BODY_TYPE_TMPFILE \n");
-#endif
-        }else{
-            //default memory stream
-#ifdef DEBUG
-            printf("client->body_length %d \n", client->body_length);
-#endif
-            client->body = new_buffer(client->body_length, 0);
-            client->body_type = BODY_TYPE_BUFFER;
-#ifdef DEBUG
-            printf("BODY_TYPE_BUFFER \n");
-#endif
+        if(init_body(client) == -1){
+            client->bad_request_code = 500;
+            return -1;
+        }
+    }
+    //a streamed body is consumed by the app, it stays in memory
+    if(client->body_length < 0 && client->body_type == BODY_TYPE_BUFFER && !client->body_stream
+            && client->body_readed + len > client_body_buffer_size){
+        if(spill_body2file(client) == -1){
+            client->bad_request_code = 500;
+            return -1;
         }
     }
     write_body(client, buf, len);
     return 0;
 }
 
+/*
+ * return the free space of the in-memory body,
+ * the rest of a Content-Length body can be read there without copying.
+ */
+inline char *
+body_read_space(client_t *client, size_t *len)
+{
+    buffer *body;
+
+    if(client->complete || client->body_length <= 0 || client->body_readed >= client->body_length){
+        return NULL;
+    }
+    if(client->body_type == BODY_TYPE_NONE && init_body(client) == -1){
+        return NULL;
+    }
+    if(client->body_type != BODY_TYPE_BUFFER){
+        return NULL;
+    }
+    body = (buffer *)client->body;
+    if(body->buf_size - body->len < client->body_length - client->body_readed){
+        return NULL;
+    }
+    *len = client->body_length - client->body_readed;
+    return body->buf + body->len;
+}
+
 int
 headers_complete_cb (http_parser *p)
 {
@@ -629,6 +721,20 @@ headers_complete_cb (http_parser *p)
     //free_request(req);
     client->req = NULL;
     client->body_length = p->content_length;
+
+    if(p->http_minor == 1){
+        obj = PyDict_GetItemString(env, "HTTP_TRANSFER_ENCODING");
+        if(obj && !strcasecmp(PyString_AS_STRING(obj), "chunked")){
+            client->chunked_request = 1;
+        }
+    }
+    if(p->http_minor == 1 && p->content_length != 0){
+        obj = PyDict_GetItemString(env, "HTTP_EXPECT");
+        if(obj && !strcasecmp(PyString_AS_STRING(obj), "100-continue")){
+            //send 100 Continue when the app reads the body
+            client->expect_continue = 1;
+        }
+    }
     
     //keep client data
     obj = ClientObject_New(client);
@@ -648,12 +754,32 @@ message_complete_cb (http_parser *p)
     printf("message_complete_cb \n");
 #endif
     client_t *client = get_client(p);
+    PyObject *env;
+    int pending = client->body_pending;
     client->complete = 1;
+    client->expect_continue = 0;
     
-    request *req = client->request_queue->tail;
-    req->body = client->body;
-    req->body_type = client->body_type;
-    
+    if(pending){
+        //body of the running request, keep it in client
+        client->body_pending = 0;
+        env = client->environ;
+    }else{
+        request *req = client->request_queue->tail;
+        req->body = client->body;
+        req->body_type = client->body_type;
+        env = req->env;
+    }
+
+    if(client->body_length < 0 && client->body_type != BODY_TYPE_NONE){
+        //decoded chunked body
+        PyObject *length = PyString_FromFormat("%d", client->body_readed);
+        PyDict_SetItemString(env, "CONTENT_LENGTH", length);
+        Py_DECREF(length);
+    }
+    if(pending){
+        //stop, don't parse the next request into the running one
+        return -1;
+    }
     return 0;
 }
 
@@ -677,7 +803,7 @@ inline int
 init_parser(client_t *cli, const char *name, const short port)
 {
 
-    cli->http = (http_parser*)PyMem_Malloc(sizeof(http_parser));
+    //http_parser lives in the connection slab
     memset(cli->http, 0, sizeof(http_parser));
 
     http_parser_init(cli->http, HTTP_REQUEST);
@@ -689,6 +815,12 @@ inline size_t
 execute_parse(client_t *cli, const char *data, size_t len)
 {
     size_t ret = http_parser_execute(cli->http, &settings, data, len);
+    if(cli->req){
+        //request head continues in the next read, copy the viewed tokens
+        if(hold_request(cli->req) != WRITE_OK){
+            cli->bad_request_code = 500;
+        }
+    }
     //check new protocol
     cli->upgrade = cli->http->upgrade;
 
@@ -712,6 +844,7 @@ setup_static_env(char *name, int port)
     version_key = PyString_FromString("wsgi.version");
     
     scheme_val = PyString_FromString("http");
+    https_scheme_val = PyString_FromString("https");
     scheme_key = PyString_FromString("wsgi.url_scheme");
 
     errors_val = PySys_GetObject("stderr");
@@ -783,6 +916,7 @@ clear_static_env(void)
     Py_DECREF(version_val);
     Py_DECREF(scheme_key);
     Py_DECREF(scheme_val);
+    Py_DECREF(https_scheme_val);
     Py_DECREF(errors_key);
     Py_DECREF(errors_val);
     Py_DECREF(multithread_key);
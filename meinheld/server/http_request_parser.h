@@ -14,6 +14,9 @@ execute_parse(client_t *cli, const char *data, size_t len);
 inline int 
 parser_finish(client_t *cli);
 
+inline char *
+body_read_space(client_t *client, size_t *len);
+
 inline void 
 setup_static_env(char *name, int port);
 
@@ -0,0 +1,523 @@
+#include "http_response_parser.h"
+#include "structmember.h"
+#include <ctype.h>
+
+/*
+ * HTTP/1.1 response parser of meinheld.client.
+ * reads the connection fd into a reusable buffer and parses it with
+ * http_parser, waiting for the fd like trampoline. the decoded body is
+ * kept until read. parsing stops at the end of each response, the next
+ * pipelined response stays in the buffer.
+ */
+
+#define READ_BUF_SIZE (1024 * 64)
+
+#define HEADER_FIELD 1
+#define HEADER_VALUE 2
+
+static http_parser_settings settings;
+
+static inline ResponseParserObject *
+get_parser(http_parser *p)
+{
+    return (ResponseParserObject *)p->data;
+}
+
+static inline int
+append(char **buf, size_t *size, size_t *len, const char *data, size_t n)
+{
+    char *new_buf;
+    size_t new_size;
+
+    if(*len + n > *size){
+        new_size = *size ? *size : 256;
+        while(new_size < *len + n){
+            new_size *= 2;
+        }
+        new_buf = (char *)PyMem_Realloc(*buf, new_size);
+        if(new_buf == NULL){
+            PyErr_NoMemory();
+            return -1;
+        }
+        *buf = new_buf;
+        *size = new_size;
+    }
+    memcpy(*buf + *len, data, n);
+    *len += n;
+    return 0;
+}
+
+static inline int
+add_header(ResponseParserObject *self)
+{
+    PyObject *header;
+    int ret;
+
+    header = Py_BuildValue("(s#s#)", self->field, (int)self->field_len, self->value, (int)self->value_len);
+    if(header == NULL){
+        return -1;
+    }
+    ret = PyList_Append(self->headers, header);
+    Py_DECREF(header);
+    if(ret == -1){
+        return -1;
+    }
+    //chunked is the last transfer coding
+    if(self->field_len == 17 && !memcmp(self->field, "transfer-encoding", 17) &&
+            self->value_len >= 7 && !strncasecmp(self->value + self->value_len - 7, "chunked", 7)){
+        self->chunked = 1;
+    }
+    self->last_element = 0;
+    return 0;
+}
+
+static int
+header_field_cb(http_parser *p, const char *buf, size_t len, char partial)
+{
+    ResponseParserObject *self = get_parser(p);
+    size_t i;
+
+    if(self->headers_done){
+        //trailer
+        return 0;
+    }
+    if(self->last_element == HEADER_VALUE && add_header(self) == -1){
+        return -1;
+    }
+    if(self->last_element != HEADER_FIELD){
+        self->field_len = 0;
+    }
+    i = self->field_len;
+    if(append(&self->field, &self->field_size, &self->field_len, buf, len) == -1){
+        return -1;
+    }
+    for(; i < self->field_len; i++){
+        self->field[i] = tolower(self->field[i]);
+    }
+    self->last_element = HEADER_FIELD;
+    return 0;
+}
+
+static int
+header_value_cb(http_parser *p, const char *buf, size_t len, char partial)
+{
+    ResponseParserObject *self = get_parser(p);
+
+    if(self->headers_done){
+        return 0;
+    }
+    if(self->last_element != HEADER_VALUE){
+        self->value_len = 0;
+    }
+    if(append(&self->value, &self->value_size, &self->value_len, buf, len) == -1){
+        return -1;
+    }
+    self->last_element = HEADER_VALUE;
+    return 0;
+}
+
+static int
+headers_complete_cb(http_parser *p)
+{
+    ResponseParserObject *self = get_parser(p);
+
+    if(self->last_element == HEADER_VALUE && add_header(self) == -1){
+        return -1;
+    }
+    self->headers_done = 1;
+    self->keep_alive = http_should_keep_alive(p) && !p->upgrade;
+    if(self->head || p->status_code / 100 == 1 || p->status_code == 204 || p->status_code == 304){
+        //no body
+        return 1;
+    }
+    return 0;
+}
+
+static int
+body_cb(http_parser *p, const char *buf, size_t len, char partial)
+{
+    ResponseParserObject *self = get_parser(p);
+
+    if(self->direct){
+        return 0;
+    }
+    if(self->body_start == self->body_end){
+        self->body_start = self->body_end = 0;
+    }else if(self->body_start > 0 && self->body_end + len > self->body_size){
+        memmove(self->body, self->body + self->body_start, self->body_end - self->body_start);
+        self->body_end -= self->body_start;
+        self->body_start = 0;
+    }
+    //the error is checked after http_parser_execute
+    return append(&self->body, &self->body_size, &self->body_end, buf, len);
+}
+
+static int
+message_complete_cb(http_parser *p)
+{
+    ResponseParserObject *self = get_parser(p);
+
+    self->complete = 1;
+    //stop, the next pipelined response is read by the next read_head
+    return -1;
+}
+
+static inline int
+check_response(ResponseParserObject *self)
+{
+    if(!self->headers_done){
+        PyErr_SetString(PyExc_IOError, "no response");
+        return -1;
+    }
+    return 0;
+}
+
+/*
+ * read(2) the connection, wait while EAGAIN
+ */
+static inline ssize_t
+recv_wait(ResponseParserObject *self, char *buf, size_t len)
+{
+    ssize_t r;
+
+    while(1){
+        Py_BEGIN_ALLOW_THREADS
+        r = read(self->fd, buf, len);
+        Py_END_ALLOW_THREADS
+        if(r >= 0){
+            break;
+        }
+        if(errno == EINTR){
+            continue;
+        }
+        if(errno != EAGAIN && errno != EWOULDBLOCK){
+            PyErr_SetFromErrno(PyExc_IOError);
+            return -1;
+        }
+        if(wait_fd(self->fd, PICOEV_READ, self->timeout) == -1){
+            return -1;
+        }
+    }
+    if(r == 0){
+        self->eof = 1;
+    }
+    return r;
+}
+
+/*
+ * parse data, return -1 on a bad response
+ */
+static inline int
+execute(ResponseParserObject *self, const char *data, size_t len, size_t *consumed)
+{
+    size_t nread;
+
+    nread = http_parser_execute(&self->parser, &settings, data, len);
+    if(PyErr_Occurred()){
+        return -1;
+    }
+    if(self->complete){
+        //stopped at the last byte of the response
+        *consumed = len ? nread + 1 : 0;
+        return 0;
+    }
+    if(nread != len){
+        PyErr_SetString(PyExc_IOError, "bad response");
+        return -1;
+    }
+    *consumed = len;
+    return 0;
+}
+
+/*
+ * read and parse more of the response
+ */
+static inline int
+advance(ResponseParserObject *self)
+{
+    ssize_t r;
+    size_t consumed;
+
+    if(self->buf_start == self->buf_end){
+        self->buf_start = self->buf_end = 0;
+        r = recv_wait(self, self->buf, self->buf_size);
+        if(r == -1){
+            return -1;
+        }
+        if(r == 0){
+            //the body ends with the connection
+            if(execute(self, self->buf, 0, &consumed) == -1){
+                return -1;
+            }
+            if(!self->complete){
+                PyErr_SetString(PyExc_IOError, "connection closed");
+                return -1;
+            }
+            self->keep_alive = 0;
+            return 0;
+        }
+        self->buf_end = r;
+    }
+    if(execute(self, self->buf + self->buf_start, self->buf_end - self->buf_start, &consumed) == -1){
+        return -1;
+    }
+    self->buf_start += consumed;
+    return 0;
+}
+
+static PyObject *
+ResponseParserObject_new(PyTypeObject *type, PyObject *args, PyObject *kwargs)
+{
+    ResponseParserObject *self;
+    PyObject *fileno;
+    int fd;
+
+    if(!PyArg_ParseTuple(args, "O:ResponseParser", &fileno)){
+        return NULL;
+    }
+    fd = PyObject_AsFileDescriptor(fileno);
+    if(fd == -1){
+        return NULL;
+    }
+    self = (ResponseParserObject *)type->tp_alloc(type, 0);
+    if(self == NULL){
+        return NULL;
+    }
+    //tp_alloc zero fills
+    self->fd = fd;
+    self->buf = (char *)PyMem_Malloc(READ_BUF_SIZE);
+    if(self->buf == NULL){
+        Py_DECREF(self);
+        return PyErr_NoMemory();
+    }
+    self->buf_size = READ_BUF_SIZE;
+    self->headers = PyList_New(0);
+    if(self->headers == NULL){
+        Py_DECREF(self);
+        return NULL;
+    }
+    return (PyObject *)self;
+}
+
+static void
+ResponseParserObject_dealloc(ResponseParserObject *self)
+{
+    PyMem_Free(self->buf);
+    PyMem_Free(self->field);
+    PyMem_Free(self->value);
+    PyMem_Free(self->body);
+    Py_XDECREF(self->headers);
+    Py_TYPE(self)->tp_free((PyObject *)self);
+}
+
+static PyObject *
+ResponseParserObject_read_head(ResponseParserObject *self, PyObject *args)
+{
+    PyObject *head = Py_False, *headers;
+
+    if(!PyArg_ParseTuple(args, "|O:read_head", &head)){
+        return NULL;
+    }
+    if(self->headers_done && !self->complete){
+        PyErr_SetString(PyExc_IOError, "response body not read");
+        return NULL;
+    }
+    headers = PyList_New(0);
+    if(headers == NULL){
+        return NULL;
+    }
+    Py_XDECREF(self->headers);
+    self->headers = headers;
+
+    memset(&self->parser, 0, sizeof(http_parser));
+    http_parser_init(&self->parser, HTTP_RESPONSE);
+    self->parser.data = self;
+    self->body_start = self->body_end = 0;
+    self->last_element = 0;
+    self->head = PyObject_IsTrue(head) == 1;
+    self->headers_done = 0;
+    self->chunked = 0;
+    self->complete = 0;
+    self->keep_alive = 0;
+
+    while(!self->headers_done){
+        if(self->eof && self->buf_start == self->buf_end){
+            PyErr_SetString(PyExc_IOError, "connection closed");
+            return NULL;
+        }
+        if(advance(self) == -1){
+            self->keep_alive = 0;
+            return NULL;
+        }
+    }
+    return Py_BuildValue("(iiO)", self->parser.status_code,
+            self->parser.http_major * 10 + self->parser.http_minor, self->headers);
+}
+
+static PyObject *
+ResponseParserObject_read(ResponseParserObject *self, PyObject *args)
+{
+    Py_ssize_t size = -1, len;
+    PyObject *data;
+
+    if(!PyArg_ParseTuple(args, "|n:read", &size)){
+        return NULL;
+    }
+    if(check_response(self) == -1){
+        return NULL;
+    }
+    while(!self->complete && (size < 0 || (Py_ssize_t)(self->body_end - self->body_start) < size)){
+        if(advance(self) == -1){
+            self->keep_alive = 0;
+            return NULL;
+        }
+    }
+    len = self->body_end - self->body_start;
+    if(size >= 0 && size < len){
+        len = size;
+    }
+    data = PyString_FromStringAndSize(self->body + self->body_start, len);
+    if(data == NULL){
+        return NULL;
+    }
+    self->body_start += len;
+    return data;
+}
+
+/*
+ * the rest of a Content-Length body straight into the caller's buffer
+ */
+static inline Py_ssize_t
+read_direct(ResponseParserObject *self, char *buf, Py_ssize_t len)
+{
+    ssize_t r;
+    size_t consumed;
+    int ret;
+
+    if(len > self->parser.content_length){
+        len = (Py_ssize_t)self->parser.content_length;
+    }
+    r = recv_wait(self, buf, len);
+    if(r == -1){
+        return -1;
+    }
+    if(r == 0){
+        PyErr_SetString(PyExc_IOError, "connection closed");
+        return -1;
+    }
+    self->direct = 1;
+    ret = execute(self, buf, r, &consumed);
+    self->direct = 0;
+    return ret == -1 ? -1 : r;
+}
+
+static PyObject *
+ResponseParserObject_readinto(ResponseParserObject *self, PyObject *args)
+{
+    Py_buffer view;
+    Py_ssize_t len = 0;
+
+    if(!PyArg_ParseTuple(args, "w*:readinto", &view)){
+        return NULL;
+    }
+    if(check_response(self) == -1){
+        goto error;
+    }
+    while(view.len > 0 && self->body_start == self->body_end && !self->complete){
+        if(self->buf_start == self->buf_end && !self->chunked && self->parser.content_length > 0){
+            len = read_direct(self, (char *)view.buf, view.len);
+            if(len == -1){
+                goto error;
+            }
+            PyBuffer_Release(&view);
+            return Py_BuildValue("n", len);
+        }
+        if(advance(self) == -1){
+            goto error;
+        }
+    }
+    len = self->body_end - self->body_start;
+    if(len > view.len){
+        len = view.len;
+    }
+    memcpy(view.buf, self->body + self->body_start, len);
+    self->body_start += len;
+    PyBuffer_Release(&view);
+    return Py_BuildValue("n", len);
+
+error:
+    self->keep_alive = 0;
+    PyBuffer_Release(&view);
+    return NULL;
+}
+
+static PyObject *
+ResponseParserObject_fileno(ResponseParserObject *self, PyObject *args)
+{
+    return Py_BuildValue("i", self->fd);
+}
+
+static http_parser_settings settings =
+  {.on_header_field = header_field_cb
+  ,.on_header_value = header_value_cb
+  ,.on_headers_complete = headers_complete_cb
+  ,.on_body = body_cb
+  ,.on_message_complete = message_complete_cb
+  };
+
+static PyMethodDef ResponseParserObject_methods[] = {
+    {"read_head", (PyCFunction)ResponseParserObject_read_head, METH_VARARGS, "read_head(head=False). read the next response head, return (status, version, headers)"},
+    {"read", (PyCFunction)ResponseParserObject_read, METH_VARARGS, "read(size=-1). read the decoded body, '' at the end"},
+    {"readinto", (PyCFunction)ResponseParserObject_readinto, METH_VARARGS, "readinto(buffer). read the decoded body into the buffer, 0 at the end"},
+    {"fileno", (PyCFunction)ResponseParserObject_fileno, METH_NOARGS, "return fileno"},
+    {NULL, NULL}
+};
+
+static PyMemberDef ResponseParserObject_members[] = {
+    {"timeout", T_INT, offsetof(ResponseParserObject, timeout), 0, "io timeout secs (0: no timeout)"},
+    {"complete", T_BOOL, offsetof(ResponseParserObject, complete), READONLY, "the response is parsed to the end"},
+    {"keep_alive", T_BOOL, offsetof(ResponseParserObject, keep_alive), READONLY, "the connection can be reused after the response"},
+    {NULL}
+};
+
+PyTypeObject ResponseParserObjectType = {
+	PyObject_HEAD_INIT(&PyType_Type)
+    0,
+    "meinheld.server.ResponseParser",             /*tp_name*/
+    sizeof(ResponseParserObject), /*tp_basicsize*/
+    0,                         /*tp_itemsize*/
+    (destructor)ResponseParserObject_dealloc, /*tp_dealloc*/
+    0,                         /*tp_print*/
+    0,                         /*tp_getattr*/
+    0,                         /*tp_setattr*/
+    0,                         /*tp_compare*/
+    0,                         /*tp_repr*/
+    0,                         /*tp_as_number*/
+    0,                         /*tp_as_sequence*/
+    0,                         /*tp_as_mapping*/
+    0,                         /*tp_hash */
+    0,                         /*tp_call*/
+    0,                         /*tp_str*/
+    0,                         /*tp_getattro*/
+    0,                         /*tp_setattro*/
+    0,                         /*tp_as_buffer*/
+    Py_TPFLAGS_DEFAULT,        /*tp_flags*/
+    "HTTP response parser of a client connection",      /* tp_doc */
+    0,		               /* tp_traverse */
+    0,		               /* tp_clear */
+    0,		               /* tp_richcompare */
+    0,		               /* tp_weaklistoffset */
+    0,		               /* tp_iter */
+    0,		               /* tp_iternext */
+    ResponseParserObject_methods,        /* tp_methods */
+    ResponseParserObject_members,        /* tp_members */
+    0,                         /* tp_getset */
+    0,                         /* tp_base */
+    0,                         /* tp_dict */
+    0,                         /* tp_descr_get */
+    0,                         /* tp_descr_set */
+    0,                         /* tp_dictoffset */
+    0,                      /* tp_init */
+    PyType_GenericAlloc,                         /* tp_alloc */
+    ResponseParserObject_new,                           /* tp_new */
+};
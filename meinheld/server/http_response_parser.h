@@ -0,0 +1,41 @@
+#ifndef HTTP_RESPONSE_PARSER_H
+#define HTTP_RESPONSE_PARSER_H
+
+#include <Python.h>
+#include "server.h"
+#include "client.h"
+#include "http_parser.h"
+
+typedef struct {
+    PyObject_HEAD
+    http_parser parser;
+    int fd;
+    int timeout;            // io timeout secs (0: no timeout)
+    char *buf;              // read buffer, reused for every response
+    size_t buf_size;
+    size_t buf_start;       // parsed up to
+    size_t buf_end;
+    char *field;            // header in progress
+    size_t field_size;
+    size_t field_len;
+    char *value;
+    size_t value_size;
+    size_t value_len;
+    char *body;             // decoded body not read yet
+    size_t body_size;
+    size_t body_start;
+    size_t body_end;
+    PyObject *headers;      // [(lower name, value), ...]
+    uint8_t last_element;
+    uint8_t head;           // response to HEAD, no body
+    uint8_t headers_done;
+    uint8_t chunked;
+    uint8_t direct;         // readinto, the body is in the caller's buffer
+    uint8_t eof;
+    char complete;
+    char keep_alive;
+} ResponseParserObject;
+
+extern PyTypeObject ResponseParserObjectType;
+
+#endif
@@ -0,0 +1,314 @@
+#include "input.h"
+
+/*
+ * wsgi.input of a request sent with "Expect: 100-continue" or a
+ * chunked body. The body is not read until the app asks for it,
+ * a chunked body (body_stream) is read as far as the app reads and
+ * the consumed bytes are dropped.
+ */
+
+inline PyObject* 
+InputObject_New(client_t *client)
+{
+    InputObject *o = PyObject_NEW(InputObject, &InputObjectType);
+    if(o == NULL){
+        return NULL;
+    }
+    o->client = client;
+    o->input = NULL;
+    client->continue_input = (PyObject *)o;
+    return (PyObject *)o;
+}
+
+inline void
+InputObject_detach(PyObject *obj)
+{
+    InputObject *self = (InputObject *)obj;
+    self->client = NULL;
+}
+
+static inline void
+InputObject_dealloc(InputObject *self)
+{
+    if(self->client){
+        self->client->continue_input = NULL;
+    }
+    Py_CLEAR(self->input);
+    PyObject_DEL(self);
+}
+
+static inline client_t*
+get_client(InputObject *self)
+{
+    if(self->client == NULL){
+        PyErr_SetString(PyExc_IOError, "closed");
+    }
+    return self->client;
+}
+
+/*
+ * read chunks until size bytes (-1: all) or a line are decoded
+ * or the body is complete.
+ */
+static inline int
+fill_stream(InputObject *self, Py_ssize_t size, int line)
+{
+    client_t *client;
+    buffer *body;
+    size_t scanned = 0;
+
+    while(1){
+        client = get_client(self);
+        if(client == NULL){
+            return -1;
+        }
+        if(!client->body_pending){
+            return 0;
+        }
+        body = (buffer *)client->body;
+        if(body){
+            if(size >= 0 && body->len >= (size_t)size){
+                return 0;
+            }
+            if(line && memchr(body->buf + scanned, '\n', body->len - scanned)){
+                return 0;
+            }
+            scanned = body->len;
+        }
+        if(read_pending_body(client) == -1){
+            return -1;
+        }
+    }
+}
+
+/*
+ * remove n bytes (-1: all) from the head of the decoded body
+ */
+static inline PyObject*
+take_stream(client_t *client, Py_ssize_t n)
+{
+    buffer *body = (buffer *)client->body;
+    PyObject *s;
+
+    if(body == NULL){
+        return PyString_FromStringAndSize(NULL, 0);
+    }
+    if(n < 0 || (size_t)n > body->len){
+        n = body->len;
+    }
+    s = PyString_FromStringAndSize(body->buf, n);
+    if(s == NULL){
+        return NULL;
+    }
+    body->len -= n;
+    memmove(body->buf, body->buf + n, body->len);
+    return s;
+}
+
+static inline PyObject*
+stream_read(InputObject *self, Py_ssize_t size)
+{
+    if(fill_stream(self, size, 0) == -1){
+        return NULL;
+    }
+    return take_stream(self->client, size);
+}
+
+static inline PyObject*
+stream_readline(InputObject *self, Py_ssize_t size)
+{
+    buffer *body;
+    char *end;
+    Py_ssize_t n = -1;
+
+    if(fill_stream(self, size, 1) == -1){
+        return NULL;
+    }
+    body = (buffer *)self->client->body;
+    if(body){
+        end = memchr(body->buf, '\n', body->len);
+        if(end){
+            n = end - body->buf + 1;
+        }
+    }
+    if(size >= 0 && (n < 0 || size < n)){
+        n = size;
+    }
+    return take_stream(self->client, n);
+}
+
+static inline int
+load_input(InputObject *self)
+{
+    if(self->input){
+        return 0;
+    }
+    if(self->client == NULL){
+        PyErr_SetString(PyExc_IOError, "closed");
+        return -1;
+    }
+    self->input = read_continue_body(self->client);
+    if(self->input == NULL){
+        return -1;
+    }
+    return 0;
+}
+
+static inline PyObject*
+call_input(InputObject *self, const char *name, PyObject *args)
+{
+    PyObject *method, *res;
+
+    if(load_input(self) == -1){
+        return NULL;
+    }
+    method = PyObject_GetAttrString(self->input, name);
+    if(method == NULL){
+        return NULL;
+    }
+    res = PyObject_Call(method, args, NULL);
+    Py_DECREF(method);
+    return res;
+}
+
+static inline int
+is_stream(InputObject *self)
+{
+    return self->input == NULL && self->client && self->client->body_stream;
+}
+
+static inline PyObject*
+InputObject_read(InputObject *self, PyObject *args)
+{
+    Py_ssize_t n = -1;
+
+    if(!is_stream(self)){
+        return call_input(self, "read", args);
+    }
+    if (!PyArg_ParseTuple(args, "|n:read", &n)){
+        return NULL;
+    }
+    return stream_read(self, n);
+}
+
+static inline PyObject*
+InputObject_readline(InputObject *self, PyObject *args)
+{
+    Py_ssize_t size = -1;
+
+    if(!is_stream(self)){
+        return call_input(self, "readline", args);
+    }
+    if (!PyArg_ParseTuple(args, "|n:readline", &size)){
+        return NULL;
+    }
+    return stream_readline(self, size);
+}
+
+static inline PyObject*
+InputObject_readlines(InputObject *self, PyObject *args)
+{
+    PyObject *result, *line;
+    Py_ssize_t sizehint = 0, length = 0;
+
+    if(!is_stream(self)){
+        return call_input(self, "readlines", args);
+    }
+    if (!PyArg_ParseTuple(args, "|n:readlines", &sizehint)){
+        return NULL;
+    }
+    result = PyList_New(0);
+    if(result == NULL){
+        return NULL;
+    }
+    while(1){
+        line = stream_readline(self, -1);
+        if(line == NULL){
+            Py_DECREF(result);
+            return NULL;
+        }
+        if(PyString_GET_SIZE(line) == 0){
+            Py_DECREF(line);
+            break;
+        }
+        length += PyString_GET_SIZE(line);
+        if(PyList_Append(result, line) == -1){
+            Py_DECREF(line);
+            Py_DECREF(result);
+            return NULL;
+        }
+        Py_DECREF(line);
+        if(sizehint > 0 && length >= sizehint){
+            break;
+        }
+    }
+    return result;
+}
+
+static inline PyObject*
+InputObject_iternext(InputObject *self)
+{
+    PyObject *line;
+
+    if(is_stream(self)){
+        line = stream_readline(self, -1);
+        if(line && PyString_GET_SIZE(line) == 0){
+            Py_DECREF(line);
+            return NULL;
+        }
+        return line;
+    }
+    if(load_input(self) == -1){
+        return NULL;
+    }
+    return PyIter_Next(self->input);
+}
+
+static struct PyMethodDef InputObject_methods[] = {
+  {"read",	(PyCFunction)InputObject_read,     METH_VARARGS, ""},
+  {"readline",	(PyCFunction)InputObject_readline, METH_VARARGS, ""},
+  {"readlines",	(PyCFunction)InputObject_readlines,METH_VARARGS, ""},
+  {NULL,	NULL}
+};
+
+PyTypeObject InputObjectType = {
+	PyObject_HEAD_INIT(&PyType_Type)
+    0,
+    "meinheld.input",             /*tp_name*/
+    sizeof(InputObject), /*tp_basicsize*/
+    0,                         /*tp_itemsize*/
+    (destructor)InputObject_dealloc, /*tp_dealloc*/
+    0,                         /*tp_print*/
+    0,                         /*tp_getattr*/
+    0,                         /*tp_setattr*/
+    0,                         /*tp_compare*/
+    0,                         /*tp_repr*/
+    0,                         /*tp_as_number*/
+    0,                         /*tp_as_sequence*/
+    0,                         /*tp_as_mapping*/
+    0,                         /*tp_hash */
+    0,                         /*tp_call*/
+    0,                         /*tp_str*/
+    0,                         /*tp_getattro*/
+    0,                         /*tp_setattro*/
+    0,                         /*tp_as_buffer*/
+    Py_TPFLAGS_DEFAULT,        /*tp_flags*/
+    "100-continue or chunked input", /* tp_doc */
+    0,		               /* tp_traverse */
+    0,		               /* tp_clear */
+    0,		               /* tp_richcompare */
+    0,		               /* tp_weaklistoffset */
+    PyObject_SelfIter,		/*tp_iter */
+    (iternextfunc)InputObject_iternext,		/* tp_iternext */
+    InputObject_methods,        /* tp_methods */
+    0,                         /* tp_members */
+    0,                         /* tp_getset */
+    0,                         /* tp_base */
+    0,                         /* tp_dict */
+    0,                         /* tp_descr_get */
+    0,                         /* tp_descr_set */
+    0,                         /* tp_dictoffset */
+    0,                      /* tp_init */
+    0,                         /* tp_alloc */
+    0,                           /* tp_new */
+};
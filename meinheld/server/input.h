@@ -0,0 +1,27 @@
+#ifndef INPUT_H
+#define INPUT_H
+
+#include <Python.h>
+#include "client.h"
+
+typedef struct {
+    PyObject_HEAD
+    client_t *client;   // NULL after the connection is cleaned
+    PyObject *input;    // StringIO or file of the received body
+} InputObject;
+
+extern PyTypeObject InputObjectType;
+
+inline PyObject* 
+InputObject_New(client_t *client);
+
+inline void
+InputObject_detach(PyObject *obj);
+
+inline int
+read_pending_body(client_t *client);
+
+inline PyObject*
+read_continue_body(client_t *client);
+
+#endif
@@ -125,7 +125,7 @@ extern "C" {
   int picoev_update_events_internal(picoev_loop* loop, int fd, int events);
   
   /* internal: poll once and call the handlers (defined by each backend) */
-  int picoev_poll_once_internal(picoev_loop* loop, int max_wait);
+  int picoev_poll_once_internal(picoev_loop* loop, int max_wait_msec);
   
   /* internal, aligned allocator with address scrambling to avoid cache
      line contention */
@@ -378,23 +378,29 @@ extern "C" {
     }
   }
   
-  /* loop once */
+  /* loop once, waits up to max_wait_msec milliseconds */
   PICOEV_INLINE
-  int picoev_loop_once(picoev_loop* loop, int max_wait) {
+  int picoev_loop_once_msec(picoev_loop* loop, int max_wait_msec) {
     loop->now = time(NULL);
-    if (max_wait > loop->timeout.resolution) {
-      max_wait = loop->timeout.resolution;
+    if (max_wait_msec > loop->timeout.resolution * 1000) {
+      max_wait_msec = loop->timeout.resolution * 1000;
     }
-    if (picoev_poll_once_internal(loop, max_wait) != 0) {
+    if (picoev_poll_once_internal(loop, max_wait_msec) != 0) {
       return -1;
     }
-    if (max_wait != 0) {
+    if (max_wait_msec != 0) {
       loop->now = time(NULL);
     }
     picoev_handle_timeout_internal(loop);
     return 0;
   }
   
+  /* loop once */
+  PICOEV_INLINE
+  int picoev_loop_once(picoev_loop* loop, int max_wait) {
+    return picoev_loop_once_msec(loop, max_wait * 1000);
+  }
+  
 #undef PICOEV_INLINE
 
 #ifdef __cplusplus
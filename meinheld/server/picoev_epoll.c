@@ -134,7 +134,7 @@ int picoev_update_events_internal(picoev_loop* _loop, int fd, int events)
   return 0;
 }
 
-int picoev_poll_once_internal(picoev_loop* _loop, int max_wait)
+int picoev_poll_once_internal(picoev_loop* _loop, int max_wait_msec)
 {
   picoev_loop_epoll* loop = (picoev_loop_epoll*)_loop;
   int i, nevents;
@@ -142,7 +142,7 @@ int picoev_poll_once_internal(picoev_loop* _loop, int max_wait)
   Py_BEGIN_ALLOW_THREADS
   nevents = epoll_wait(loop->epfd, loop->events,
 		       sizeof(loop->events) / sizeof(loop->events[0]),
-		       max_wait * 1000);
+		       max_wait_msec);
   Py_END_ALLOW_THREADS
 
   if (nevents == -1) {
@@ -155,6 +155,10 @@ int picoev_poll_once_internal(picoev_loop* _loop, int max_wait)
 	&& (target->events & PICOEV_READWRITE) != 0) {
       int revents = ((event->events & EPOLLIN) != 0 ? PICOEV_READ : 0)
 	| ((event->events & EPOLLOUT) != 0 ? PICOEV_WRITE : 0);
+      if ((event->events & (EPOLLHUP | EPOLLERR)) != 0) {
+	/* a closed pipe reports only EPOLLHUP, read/write gets EOF or the error */
+	revents |= target->events & PICOEV_READWRITE;
+      }
       if (revents != 0) {
 	(*target->callback)(&loop->loop, event->data.fd, revents,
 			    target->cb_arg);
@@ -164,7 +164,7 @@ int picoev_update_events_internal(picoev_loop* _loop, int fd, int events)
   return 0;
 }
 
-int picoev_poll_once_internal(picoev_loop* _loop, int max_wait)
+int picoev_poll_once_internal(picoev_loop* _loop, int max_wait_msec)
 {
   picoev_loop_kqueue* loop = (picoev_loop_kqueue*)_loop;
   struct timespec ts;
@@ -173,8 +173,8 @@ int picoev_poll_once_internal(picoev_loop* _loop, int max_wait)
   /* apply pending changes, with last changes stored to loop->changelist */
   cl_off = apply_pending_changes(loop, 0);
   
-  ts.tv_sec = max_wait;
-  ts.tv_nsec = 0;
+  ts.tv_sec = max_wait_msec / 1000;
+  ts.tv_nsec = (max_wait_msec % 1000) * 1000000;
 
   Py_BEGIN_ALLOW_THREADS
   nevents = kevent(loop->kq, loop->changelist, cl_off, loop->events,
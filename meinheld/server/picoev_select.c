@@ -118,7 +118,7 @@ int picoev_update_events_internal(picoev_loop* loop, int fd, int events)
   return 0;
 }
 
-int picoev_poll_once_internal(picoev_loop* loop, int max_wait)
+int picoev_poll_once_internal(picoev_loop* loop, int max_wait_msec)
 {
   fd_set readfds, writefds, errorfds;
   struct timeval tv;
@@ -147,8 +147,8 @@ int picoev_poll_once_internal(picoev_loop* loop, int max_wait)
   }
   
   /* select and handle if any */
-  tv.tv_sec = max_wait;
-  tv.tv_usec = 0;
+  tv.tv_sec = max_wait_msec / 1000;
+  tv.tv_usec = (max_wait_msec % 1000) * 1000;
 
   Py_BEGIN_ALLOW_THREADS
   r = select(maxfd + 1, &readfds, &writefds, &errorfds, &tv);
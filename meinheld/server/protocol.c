@@ -0,0 +1,263 @@
+#include "protocol.h"
+#include "client.h"
+#include "stream.h"
+#include "log.h"
+#include "util.h"
+#include <arpa/inet.h>
+
+/*
+ * generic TCP protocol server.
+ * each accepted connection runs handler_factory(stream, (addr, port))
+ * in its own greenlet on the main loop, the Stream waits for the fd
+ * like trampoline. the stream is closed when the handler returns.
+ */
+
+typedef struct _proto_server {
+    int fd;
+    PyObject *handler_factory;
+    struct _proto_server *next;
+} proto_server;
+
+typedef struct {
+    PyGreenlet *greenlet;
+    PyObject *stream;
+} proto_conn;
+
+static proto_server *servers = NULL;
+
+/* the connection running in the current greenlet */
+static proto_conn *current_conn = NULL;
+
+static inline void
+free_conn(proto_conn *conn)
+{
+    PyObject *res;
+
+#ifdef DEBUG
+    printf("protocol close conn:%p \n", conn);
+#endif
+    res = PyObject_CallMethod(conn->stream, "close", NULL);
+    Py_XDECREF(res);
+    Py_DECREF(conn->stream);
+    Py_DECREF(conn->greenlet);
+    PyMem_Free(conn);
+}
+
+/*
+ * switch to the connection greenlet, args NULL throws the current error
+ */
+static inline void
+resume_conn(proto_conn *conn, PyObject *args)
+{
+    PyObject *res;
+    PyObject *err_type, *err_val, *err_tb;
+    PyObject *old_client = current_client;
+
+    //not in a request
+    current_client = NULL;
+    current_conn = conn;
+    if(args == NULL){
+        PyErr_Fetch(&err_type, &err_val, &err_tb);
+        res = PyGreenlet_Throw(conn->greenlet, err_type, err_val, err_tb);
+    }else{
+        res = PyGreenlet_Switch(conn->greenlet, args, NULL);
+    }
+    current_conn = NULL;
+    current_client = old_client;
+
+    if(res == NULL){
+        write_error_log(__FILE__, __LINE__);
+    }
+    Py_XDECREF(res);
+    if(PyGreenlet_STARTED(conn->greenlet) && !PyGreenlet_ACTIVE(conn->greenlet)){
+        //handler returned or raised
+        free_conn(conn);
+    }
+}
+
+static void
+wait_callback(picoev_loop* loop, int fd, int events, void* cb_arg)
+{
+    proto_conn *conn = (proto_conn *)cb_arg;
+
+    picoev_del(loop, fd);
+    if((events & PICOEV_TIMEOUT) != 0){
+        PyErr_SetString(timeout_error, "timeout");
+        resume_conn(conn, NULL);
+    }else{
+        resume_conn(conn, hub_switch_value);
+    }
+}
+
+/*
+ * numeric host and port of an IPv4/IPv6 peer, "" and 0 for a unix socket
+ */
+static inline void
+get_peer_name(struct sockaddr *addr, socklen_t len, char *host, size_t host_len, int *port)
+{
+    char serv[NI_MAXSERV];
+
+    host[0] = '\0';
+    *port = 0;
+    if(addr->sa_family != AF_INET && addr->sa_family != AF_INET6){
+        return;
+    }
+    if(getnameinfo(addr, len, host, host_len, serv, sizeof(serv), NI_NUMERICHOST | NI_NUMERICSERV) != 0){
+        host[0] = '\0';
+        return;
+    }
+    *port = atoi(serv);
+}
+
+static void
+protocol_accept_callback(picoev_loop* loop, int fd, int events, void* cb_arg)
+{
+    proto_server *server = (proto_server *)cb_arg;
+    proto_conn *conn;
+    PyObject *args;
+    struct sockaddr_storage client_addr;
+    socklen_t client_len = sizeof(client_addr);
+    char host[NI_MAXHOST];
+    int client_fd, port;
+
+    if((events & PICOEV_READ) == 0){
+        return;
+    }
+    Py_BEGIN_ALLOW_THREADS
+    client_fd = accept(fd, (struct sockaddr *)&client_addr, &client_len);
+    Py_END_ALLOW_THREADS
+    if(client_fd == -1){
+        if(errno != EAGAIN && errno != EWOULDBLOCK){
+            PyErr_SetFromErrno(PyExc_IOError);
+            write_error_log(__FILE__, __LINE__);
+        }
+        return;
+    }
+#ifdef DEBUG
+    printf("protocol accept fd %d \n", client_fd);
+#endif
+    setup_sock(client_fd);
+
+    conn = (proto_conn *)PyMem_Malloc(sizeof(proto_conn));
+    if(conn == NULL){
+        close(client_fd);
+        return;
+    }
+    conn->stream = StreamObject_New(client_fd, NULL, NULL);
+    if(conn->stream == NULL){
+        close(client_fd);
+        PyMem_Free(conn);
+        write_error_log(__FILE__, __LINE__);
+        return;
+    }
+    conn->greenlet = PyGreenlet_New(server->handler_factory, NULL);
+    if(conn->greenlet == NULL){
+        Py_DECREF(conn->stream);
+        PyMem_Free(conn);
+        write_error_log(__FILE__, __LINE__);
+        return;
+    }
+    get_peer_name((struct sockaddr *)&client_addr, client_len, host, sizeof(host), &port);
+    args = Py_BuildValue("(O(si))", conn->stream, host, port);
+    if(args == NULL){
+        free_conn(conn);
+        write_error_log(__FILE__, __LINE__);
+        return;
+    }
+    resume_conn(conn, args);
+    Py_DECREF(args);
+}
+
+inline int
+protocol_add_server(int fd, PyObject *handler_factory)
+{
+    proto_server *server;
+
+    server = (proto_server *)PyMem_Malloc(sizeof(proto_server));
+    if(server == NULL){
+        PyErr_NoMemory();
+        return -1;
+    }
+    if(_PyGreenlet_API == NULL){
+        PyGreenlet_Import();
+    }
+    Py_INCREF(handler_factory);
+    server->fd = fd;
+    server->handler_factory = handler_factory;
+    server->next = servers;
+    servers = server;
+    return 0;
+}
+
+/*
+ * watch the listen sockets on the loop
+ */
+inline void
+protocol_start(picoev_loop *loop)
+{
+    proto_server *server;
+
+    for(server = servers; server != NULL; server = server->next){
+        if(!picoev_is_active(loop, server->fd)){
+            picoev_add(loop, server->fd, PICOEV_READ, 0, protocol_accept_callback, (void *)server);
+        }
+    }
+}
+
+inline void
+protocol_stop(picoev_loop *loop)
+{
+    proto_server *server;
+
+    for(server = servers; server != NULL; server = server->next){
+        if(picoev_is_active(loop, server->fd)){
+            picoev_del(loop, server->fd);
+        }
+    }
+}
+
+inline int
+in_protocol(void)
+{
+    return current_conn != NULL;
+}
+
+inline void*
+protocol_current(void)
+{
+    return current_conn;
+}
+
+/*
+ * switch the current connection greenlet to the hub
+ * until protocol_resume
+ */
+inline int
+protocol_suspend(void)
+{
+    PyObject *res;
+
+    res = PyGreenlet_Switch(PyGreenlet_GET_PARENT(current_conn->greenlet), hub_switch_value, NULL);
+    if(res == NULL){
+        return -1;
+    }
+    Py_DECREF(res);
+    return 0;
+}
+
+inline void
+protocol_resume(void *conn)
+{
+    resume_conn((proto_conn *)conn, hub_switch_value);
+}
+
+/*
+ * suspend the connection greenlet until the fd is ready
+ */
+inline int
+protocol_wait(int fd, int event, int timeout)
+{
+    picoev_del(main_loop, fd);
+    picoev_add(main_loop, fd, event, timeout, wait_callback, (void *)current_conn);
+    return protocol_suspend();
+}
@@ -0,0 +1,31 @@
+#ifndef PROTOCOL_H
+#define PROTOCOL_H
+
+#include <Python.h>
+#include "server.h"
+
+inline int
+protocol_add_server(int fd, PyObject *handler_factory);
+
+inline void
+protocol_start(picoev_loop *loop);
+
+inline void
+protocol_stop(picoev_loop *loop);
+
+inline int
+in_protocol(void);
+
+inline void*
+protocol_current(void);
+
+inline int
+protocol_suspend(void);
+
+inline void
+protocol_resume(void *conn);
+
+inline int
+protocol_wait(int fd, int event, int timeout);
+
+#endif
@@ -2,43 +2,41 @@
 #include "client.h"
 
 /* use free_list */
-#define REQUEST_MAXFREELIST 1024
+#define REQUEST_MINFREELIST 64
+#define REQUEST_MAXFREELIST 1024 * 16
 
-static request *request_free_list[REQUEST_MAXFREELIST];
-static int request_numfree = 0;
+static freelist request_free_list;
 
-#define HEADER_MAXFREELIST 1024 * 16
+#define HEADER_MINFREELIST 64
+#define HEADER_MAXFREELIST 1024 * 64
 
-static header *header_free_list[HEADER_MAXFREELIST];
-static int header_numfree = 0;
+static freelist header_free_list;
+
+static void *
+new_request_mem(void)
+{
+    return PyMem_Malloc(sizeof(request));
+}
 
 inline void
 request_list_fill(void)
 {
-    request *req;
-	while (request_numfree < REQUEST_MAXFREELIST) {
-        req = (request *)PyMem_Malloc(sizeof(request));
-		request_free_list[request_numfree++] = req;
-	}
+    freelist_init(&request_free_list, "request", REQUEST_MINFREELIST, REQUEST_MAXFREELIST, new_request_mem, PyMem_Free);
+    freelist_fill(&request_free_list);
 }
 
 inline void
 request_list_clear(void)
 {
-	request *op;
-
-	while (request_numfree) {
-		op = request_free_list[--request_numfree];
-		PyMem_Free(op);
-	}
+    freelist_clear(&request_free_list);
 }
 
 static inline request*
 alloc_request(void)
 {
     request *req;
-	if (request_numfree) {
-		req = request_free_list[--request_numfree];
+    req = (request *)freelist_pop(&request_free_list);
+	if (req) {
 #ifdef DEBUG
         printf("use pooled req %p\n", req);
 #endif
@@ -55,11 +53,10 @@ alloc_request(void)
 inline void
 dealloc_request(request *req)
 {
-	if (request_numfree < REQUEST_MAXFREELIST){
+	if (freelist_push(&request_free_list, req)){
 #ifdef DEBUG
         printf("back to request pool %p\n", req);
 #endif
-		request_free_list[request_numfree++] = req;
     }else{
 	    PyMem_Free(req);
     }
@@ -76,7 +73,7 @@ new_request_queue(void)
 }
 
 inline void
-free_request_queue(request_queue *q)
+clear_request_queue(request_queue *q)
 {
     request *req, *temp_req;
     req = q->head;
@@ -85,7 +82,13 @@ free_request_queue(request_queue *q)
         req = (request *)temp_req->next;
         free_request(temp_req);
     }
+    memset(q, 0, sizeof(request_queue));
+}
 
+inline void
+free_request_queue(request_queue *q)
+{
+    clear_request_queue(q);
     PyMem_Free(q);
 }
 
@@ -120,42 +123,49 @@ shift_request(request_queue *q)
 
 
 inline request *
-new_request(void)
+new_request(arena *a)
 {
-    request *req = alloc_request();
+    request *req;
+    if(a){
+        req = (request *)arena_alloc(a, sizeof(request));
+        if(req){
+            memset(req, 0, sizeof(request));
+            req->arena = a;
+            return req;
+        }
+    }
+    req = alloc_request();
     //request *req = (request *)PyMem_Malloc(sizeof(request));
 
     memset(req, 0, sizeof(request));
     return req;
 }
 
+static void *
+new_header_mem(void)
+{
+    return PyMem_Malloc(sizeof(header));
+}
+
 inline void
 header_list_fill(void)
 {
-    header *h;
-	while (header_numfree < HEADER_MAXFREELIST) {
-        h = (header *)PyMem_Malloc(sizeof(header));
-		header_free_list[header_numfree++] = h;
-	}
+    freelist_init(&header_free_list, "header", HEADER_MINFREELIST, HEADER_MAXFREELIST, new_header_mem, PyMem_Free);
+    freelist_fill(&header_free_list);
 }
 
 inline void
 header_list_clear(void)
 {
-	header *op;
-
-	while (header_numfree) {
-		op = header_free_list[--header_numfree];
-		PyMem_Free(op);
-	}
+    freelist_clear(&header_free_list);
 }
 
 static inline header*
 alloc_header(void)
 {
     header *h;
-	if (header_numfree) {
-		h = header_free_list[--header_numfree];
+    h = (header *)freelist_pop(&header_free_list);
+	if (h) {
 #ifdef DEBUG
         printf("use pooled header %p\n", h);
 #endif
@@ -172,34 +182,74 @@ alloc_header(void)
 inline void
 dealloc_header(header *h)
 {
-	if (header_numfree < HEADER_MAXFREELIST){
+	if (freelist_push(&header_free_list, h)){
 #ifdef DEBUG
         printf("back to header pool %p\n", h);
 #endif
-		header_free_list[header_numfree++] = h;
     }else{
 	    PyMem_Free(h);
     }
 }
 
 inline header *
-new_header(size_t fsize, size_t flimit, size_t vsize, size_t vlimit)
+new_header(arena *a, size_t fsize, size_t flimit, size_t vsize, size_t vlimit)
 {
     header *h;
-    //h = PyMem_Malloc(sizeof(header));
-    h = alloc_header();
-    h->field = new_buffer(fsize, flimit);
-    h->value = new_buffer(vsize, vlimit);
+    h = NULL;
+    if(a){
+        h = (header *)arena_alloc(a, sizeof(header));
+        if(h){
+            h->arena = a;
+        }
+    }
+    if(h == NULL){
+        //h = PyMem_Malloc(sizeof(header));
+        h = alloc_header();
+    }
+    h->field = new_arena_buffer(a, fsize, flimit);
+    h->value = new_arena_buffer(a, vsize, vlimit);
     return h;
 }
 
 inline void
 free_header(header *h)
 {
+    if(h->arena){
+        //released on arena reset
+        return;
+    }
     //PyMem_Free(h);
     dealloc_header(h);
 }
 
+inline buffer_result
+hold_request(request *req)
+{
+    uint32_t i;
+    header *h;
+    buffer_result ret = WRITE_OK;
+
+    if(req->path && ret == WRITE_OK){
+        ret = hold_buffer(req->path);
+    }
+    if(req->uri && ret == WRITE_OK){
+        ret = hold_buffer(req->uri);
+    }
+    if(req->query_string && ret == WRITE_OK){
+        ret = hold_buffer(req->query_string);
+    }
+    if(req->fragment && ret == WRITE_OK){
+        ret = hold_buffer(req->fragment);
+    }
+    for(i = 0; i < req->num_headers+1 && ret == WRITE_OK; i++){
+        h = req->headers[i];
+        if(h){
+            ret = hold_buffer(h->value);
+        }
+    }
+    return ret;
+}
+
 inline void
 free_request(request *req)
 {
@@ -230,6 +280,10 @@ free_request(request *req)
             req->headers[i] = NULL;
         }
     }
+    if(req->arena){
+        //released on arena reset
+        return;
+    }
     dealloc_request(req);
     //PyMem_Free(req);
 }
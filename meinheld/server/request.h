@@ -29,6 +29,7 @@ typedef enum {
 typedef struct {
     buffer *field;
     buffer *value;
+    arena *arena;   // allocated from connection arena
 } header;
 
 typedef struct {
@@ -47,6 +48,7 @@ typedef struct {
     int bad_request_code;
     void *body;
     request_body_type body_type;
+    arena *arena;   // allocated from connection arena
 
 } request;
 
@@ -66,14 +68,17 @@ shift_request(request_queue *q);
 inline request_queue*
 new_request_queue(void);
 
+inline void
+clear_request_queue(request_queue *q);
+
 inline void
 free_request_queue(request_queue *q);
 
 inline request *
-new_request(void);
+new_request(arena *a);
 
 inline header *
-new_header(size_t fsize, size_t flimit, size_t vsize, size_t vlimit);
+new_header(arena *a, size_t fsize, size_t flimit, size_t vsize, size_t vlimit);
 
 inline void
 free_header(header *h);
@@ -81,6 +86,9 @@ free_header(header *h);
 inline void
 free_request(request *req);
 
+inline buffer_result
+hold_request(request *req);
+
 inline void
 dealloc_request(request *req);
 
@@ -30,7 +30,11 @@ blocking_write(client_t *client, char *data, size_t len)
              send_len = len;
         }
         Py_BEGIN_ALLOW_THREADS
-        r = write(client->fd, data, send_len);
+        if(client->tls){
+            r = tls_write(client->tls, data, send_len);
+        }else{
+            r = write(client->fd, data, send_len);
+        }
         Py_END_ALLOW_THREADS
         switch(r){
             case 0:
@@ -117,13 +121,14 @@ send_error_page(client_t *client)
 
 
 static inline write_bucket *
-new_write_bucket(int fd, int cnt){
+new_write_bucket(client_t *client, int cnt){
 
     write_bucket *bucket;
     bucket = PyMem_Malloc(sizeof(write_bucket));
     memset(bucket, 0, sizeof(write_bucket));
     
-    bucket->fd = fd;
+    bucket->fd = client->fd;
+    bucket->tls = client->tls;
     bucket->iov = (iovec_t *)PyMem_Malloc(sizeof(iovec_t) * cnt);
     bucket->iov_size = cnt;
     return bucket;
@@ -132,6 +137,7 @@ new_write_bucket(int fd, int cnt){
 static inline void
 free_write_bucket(write_bucket *bucket)
 {
+    Py_XDECREF(bucket->temp1);
     PyMem_Free(bucket->iov);
     PyMem_Free(bucket);
 }
@@ -148,9 +154,14 @@ set2bucket(write_bucket *bucket, char *buf, size_t len)
 }
 
 static inline void
-set_chunked_data(write_bucket *bucket, char *lendata, size_t lenlen, char *data, size_t datalen)
+set_chunked_data(write_bucket *bucket, char *data, size_t datalen)
 {
-    set2bucket(bucket, lendata, lenlen);
+    int lenlen;
+    lenlen = snprintf(bucket->chunk_size, sizeof(bucket->chunk_size), "%zx", datalen);
+#ifdef DEBUG
+    printf("Transfer-Encoding chunk_size %s \n", bucket->chunk_size);
+#endif
+    set2bucket(bucket, bucket->chunk_size, lenlen);
     set2bucket(bucket, CRLF, 2);
     set2bucket(bucket, data, datalen);
     set2bucket(bucket, CRLF, 2);
@@ -181,7 +192,11 @@ writev_bucket(write_bucket *data)
     size_t w;
     register int i = 0;
     Py_BEGIN_ALLOW_THREADS
-    w = writev(data->fd, data->iov, data->iov_cnt);
+    if(data->tls){
+        w = tls_writev(data->tls, data->iov, data->iov_cnt);
+    }else{
+        w = writev(data->fd, data->iov, data->iov_cnt);
+    }
     Py_END_ALLOW_THREADS
     if(w == -1){
         //error
@@ -262,6 +277,134 @@ set_content_length(client_t *client, write_bucket *bucket, char *data, size_t da
     }
 }
 
+static char *gzip_types[] = {
+    "text/",
+    "application/json",
+    "application/javascript",
+    "application/x-javascript",
+    "application/xml",
+    "application/xhtml+xml",
+    "application/rss+xml",
+    "application/atom+xml",
+    "image/svg+xml",
+    NULL
+};
+
+static inline int
+is_gzip_type(char *content_type)
+{
+    char **type;
+    for(type = gzip_types; *type; type++){
+        if(!strncasecmp(content_type, *type, strlen(*type))){
+            return 1;
+        }
+    }
+    return 0;
+}
+
+static inline int
+accept_encoding(client_t *client, char *encoding)
+{
+    PyObject *o;
+    char *p, *end, *q;
+    size_t len, enclen;
+
+    if(client->environ == NULL){
+        return 0;
+    }
+    enclen = strlen(encoding);
+    o = PyDict_GetItemString(client->environ, "HTTP_ACCEPT_ENCODING");
+    if(o == NULL || !PyString_Check(o)){
+        return 0;
+    }
+    p = PyString_AS_STRING(o);
+    while(*p){
+        while(*p == ' ' || *p == ','){
+            p++;
+        }
+        end = p;
+        while(*end && *end != ',' && *end != ';' && *end != ' '){
+            end++;
+        }
+        len = end - p;
+        if(len == enclen && !strncasecmp(p, encoding, enclen)){
+            //gzip;q=0 means not acceptable
+            q = end;
+            while(*q == ' ' || *q == ';'){
+                q++;
+            }
+            if(!strncasecmp(q, "q=", 2) && strtod(q + 2, NULL) <= 0){
+                return 0;
+            }
+            return 1;
+        }
+        while(*end && *end != ','){
+            end++;
+        }
+        p = end;
+    }
+    return 0;
+}
+
+/*
+ * decide whether to gzip the response body, return 1 and set client->zstream
+ */
+static inline int
+check_gzip(client_t *client, PyObject *headers, uint32_t hlen, char *data, size_t datalen)
+{
+    uint32_t i;
+    PyObject *tuple, *name, *value;
+    int compressible = 0, single;
+
+    if(gzip_level <= 0 || data == NULL || client->environ == NULL){
+        return 0;
+    }
+    if(client->status_code < 200 || client->status_code == 204 || client->status_code == 304){
+        return 0;
+    }
+    for(i = 0; i < hlen; i++){
+        tuple = PySequence_Fast_GET_ITEM(headers, i);
+        if(!PyTuple_Check(tuple) || PyTuple_GET_SIZE(tuple) != 2){
+            return 0;
+        }
+        name = PyTuple_GET_ITEM(tuple, 0);
+        value = PyTuple_GET_ITEM(tuple, 1);
+        if(!PyString_Check(name) || !PyString_Check(value)){
+            return 0;
+        }
+        if(!strcasecmp(PyString_AS_STRING(name), "Content-Encoding")){
+            //already encoded
+            return 0;
+        }else if(!strcasecmp(PyString_AS_STRING(name), "Content-Type")){
+            compressible = is_gzip_type(PyString_AS_STRING(value));
+        }else if(!strcasecmp(PyString_AS_STRING(name), "Content-Length")){
+            if(atol(PyString_AS_STRING(value)) < gzip_min_length){
+                return 0;
+            }
+        }
+    }
+    if(!compressible){
+        return 0;
+    }
+    single = get_len(client->response) == 1;
+    if(single && datalen < gzip_min_length){
+        return 0;
+    }
+    if(!single && client->http->http_minor != 1){
+        //can't stream without chunked encoding
+        return 0;
+    }
+    value = PyDict_GetItemString(client->environ, "REQUEST_METHOD");
+    if(value && PyString_Check(value) && !strcmp(PyString_AS_STRING(value), "HEAD")){
+        return 0;
+    }
+    if(!accept_encoding(client, "gzip")){
+        return 0;
+    }
+    client->zstream = acquire_gzip_stream(gzip_level);
+    return client->zstream != NULL;
+}
+
 static inline int
 write_headers(client_t *client, char *data, size_t datalen)
 {
@@ -276,13 +419,32 @@ write_headers(client_t *client, char *data, size_t datalen)
     Py_ssize_t namelen;
     char *value = NULL;
     Py_ssize_t valuelen;
+    PyObject *gzdata = NULL;
+    int len;
 
     if(client->headers){
         headers = PySequence_Fast(client->headers, "header must be list");
         hlen = PySequence_Fast_GET_SIZE(headers);
         Py_DECREF(headers);
     }
-    bucket = new_write_bucket(client->fd, (hlen * 4) + 40 );
+    bucket = new_write_bucket(client, (hlen * 4) + 40 );
+
+    if(check_gzip(client, headers, hlen, data, datalen)){
+        if(get_len(client->response) == 1){
+            //whole body, send with Content-Length
+            gzdata = gzip_data(client->zstream, data, datalen, Z_FINISH);
+            release_gzip_stream(client->zstream);
+            client->zstream = NULL;
+        }else{
+            gzdata = gzip_data(client->zstream, data, datalen, Z_SYNC_FLUSH);
+        }
+        if(gzdata == NULL){
+            goto error;
+        }
+        bucket->temp1 = gzdata;
+        data = PyString_AS_STRING(gzdata);
+        datalen = PyString_GET_SIZE(gzdata);
+    }
     
     object = client->http_status;
     if(object){
@@ -362,6 +524,10 @@ write_headers(client_t *client, char *data, size_t datalen)
             
             if (!strcasecmp(name, "Content-Length")) {
                 char *v = value;
+                if(gzdata || client->content_encoding){
+                    //length of the plain body
+                    continue;
+                }
                 long l = 0;
 
                 errno = 0;
@@ -380,6 +546,28 @@ write_headers(client_t *client, char *data, size_t datalen)
         
     }
     //header done 
+
+    if(gzdata){
+        add_header(bucket, "Content-Encoding", 16, "gzip", 4);
+        add_header(bucket, "Vary", 4, "Accept-Encoding", 15);
+        if(client->zstream == NULL){
+            client->content_length_set = 1;
+            client->content_length = datalen;
+            //the app's header list may be shared, keep the length in client
+            len = snprintf(client->length_buf, sizeof(client->length_buf), "%zu", datalen);
+            add_header(bucket, "Content-Length", 14, client->length_buf, len);
+        }
+    }else if(client->content_encoding){
+        //precompressed file, content_length is the compressed size
+        client->content_length_set = 1;
+        len = snprintf(client->length_buf, sizeof(client->length_buf), "%d", client->content_length);
+        add_header(bucket, "Content-Length", 14, client->length_buf, len);
+        add_header(bucket, "Content-Encoding", 16, client->content_encoding, strlen(client->content_encoding));
+        add_header(bucket, "Vary", 4, "Accept-Encoding", 15);
+    }else if(client->vary_encoding){
+        //a precompressed sibling exists, caches must key on Accept-Encoding
+        add_header(bucket, "Vary", 4, "Accept-Encoding", 15);
+    }
     
     // check content_length_set
     if(data && !client->content_length_set && client->http->http_minor == 1){
@@ -388,6 +576,10 @@ write_headers(client_t *client, char *data, size_t datalen)
         client->chunked_response = 1;
     }
 
+    if(draining || client->body_pending){
+        //graceful shutdown or unread request body, close after this response
+        client->keep_alive = 0;
+    }
     if(client->keep_alive == 1){
         //Keep-Alive
         add_header(bucket, "Connection", 10, "Keep-Alive", 10);
@@ -399,13 +591,7 @@ write_headers(client_t *client, char *data, size_t datalen)
     
     if(data){
         if(client->chunked_response){
-            char lendata[32];
-            int i = 0;
-            i = snprintf(lendata, 32, "%zx", datalen);
-#ifdef DEBUG
-            printf("Transfer-Encoding chunk_size %s \n", lendata);
-#endif
-            set_chunked_data(bucket, lendata, i, data, datalen);  
+            set_chunked_data(bucket, data, datalen);  
         }else{
             set2bucket(bucket, data, datalen);
         }
@@ -572,6 +758,7 @@ processs_write(register client_t *client)
     char *buf;
     Py_ssize_t buflen;
     register write_bucket *bucket;
+    PyObject *gzdata = NULL;
     int ret;
 
     iterator = client->response_iter;
@@ -579,21 +766,31 @@ processs_write(register client_t *client)
         while((item =  PyIter_Next(iterator))){
             if(PyString_Check(item)){
                 PyString_AsStringAndSize(item, &buf, &buflen);
+                gzdata = NULL;
+                if(client->zstream){
+                    gzdata = gzip_data(client->zstream, buf, buflen, Z_SYNC_FLUSH);
+                    if(gzdata == NULL){
+                        Py_DECREF(item);
+                        write_error_log(__FILE__, __LINE__);
+                        return -1;
+                    }
+                    if(PyString_GET_SIZE(gzdata) == 0){
+                        Py_DECREF(gzdata);
+                        Py_DECREF(item);
+                        continue;
+                    }
+                    buf = PyString_AS_STRING(gzdata);
+                    buflen = PyString_GET_SIZE(gzdata);
+                }
                 //write
                 if(client->chunked_response){
-                    bucket = new_write_bucket(client->fd, 4);
-                    
-                    char lendata[32];
-                    int i = 0;
-                    i = snprintf(lendata, 32, "%zx", buflen);
-#ifdef DEBUG
-                    printf("Transfer-Encoding chunk_size %s \n", lendata);
-#endif
-                    set_chunked_data(bucket, lendata, i, buf, buflen);  
+                    bucket = new_write_bucket(client, 4);
+                    set_chunked_data(bucket, buf, buflen);  
                 }else{
-                    bucket = new_write_bucket(client->fd, 1);
+                    bucket = new_write_bucket(client, 1);
                     set2bucket(bucket, buf, buflen);
                 }
+                bucket->temp1 = gzdata;
                 ret = writev_bucket(bucket);
                 if(ret <= 0){
                     client->bucket = bucket;
@@ -624,7 +821,19 @@ processs_write(register client_t *client)
         }
 
         if(client->chunked_response){
-            bucket = new_write_bucket(client->fd, 3);
+            bucket = new_write_bucket(client, 7);
+            if(client->zstream){
+                //gzip trailer
+                gzdata = gzip_data(client->zstream, NULL, 0, Z_FINISH);
+                release_gzip_stream(client->zstream);
+                client->zstream = NULL;
+                if(gzdata && PyString_GET_SIZE(gzdata) > 0){
+                    bucket->temp1 = gzdata;
+                    set_chunked_data(bucket, PyString_AS_STRING(gzdata), PyString_GET_SIZE(gzdata));
+                }else{
+                    Py_XDECREF(gzdata);
+                }
+            }
             set_last_chunked_data(bucket);
             writev_bucket(bucket);
             free_write_bucket(bucket);
@@ -656,7 +865,7 @@ process_body(client_t *client)
 
     }
 
-    if (CheckFileWrapper(client->response)) {
+    if (CheckFileWrapper(client->response) && !client->tls) {
         ret = processs_sendfile(client);
     }else{
         ret = processs_write(client);
@@ -665,6 +874,138 @@ process_body(client_t *client)
     return ret;
 }
 
+/*
+ * path -> (mtime, has .br, has .gz)
+ */
+static PyObject *precompressed_cache = NULL;
+
+#define PRECOMPRESSED_CACHE_SIZE 1024
+
+static inline int
+has_sidecar(char *path, char *ext, time_t mtime)
+{
+    char name[PATH_MAX];
+    struct stat info;
+
+    if(snprintf(name, sizeof(name), "%s%s", path, ext) >= sizeof(name)){
+        return 0;
+    }
+    if(stat(name, &info) == -1){
+        return 0;
+    }
+    //ignore stale sidecar
+    return S_ISREG(info.st_mode) && info.st_mtime >= mtime;
+}
+
+static inline PyObject *
+lookup_precompressed(PyObject *name, time_t mtime)
+{
+    PyObject *entry;
+    char *path;
+
+    if(precompressed_cache == NULL){
+        precompressed_cache = PyDict_New();
+        if(precompressed_cache == NULL){
+            return NULL;
+        }
+    }
+    entry = PyDict_GetItem(precompressed_cache, name);
+    if(entry && PyInt_AS_LONG(PyTuple_GET_ITEM(entry, 0)) == (long)mtime){
+        return entry;
+    }
+    if(PyDict_Size(precompressed_cache) >= PRECOMPRESSED_CACHE_SIZE){
+        PyDict_Clear(precompressed_cache);
+    }
+    path = PyString_AS_STRING(name);
+    entry = Py_BuildValue("(lii)", (long)mtime, has_sidecar(path, ".br", mtime), has_sidecar(path, ".gz", mtime));
+    if(entry == NULL){
+        return NULL;
+    }
+    PyDict_SetItem(precompressed_cache, name, entry);
+    Py_DECREF(entry);
+    return entry;
+}
+
+/*
+ * swap the file for a precompressed sibling (name.br, name.gz)
+ */
+static inline int
+open_precompressed(client_t *client, FileWrapperObject *filewrap, int in_fd)
+{
+    PyObject *name, *entry, *file, *tuple;
+    char *ext, *encoding, path[PATH_MAX];
+    struct stat info;
+    Py_ssize_t i;
+    FILE *fp;
+
+    if(client->status_code != 200 || client->headers == NULL || !PyList_Check(client->headers)){
+        return 0;
+    }
+    for(i = 0; i < PyList_GET_SIZE(client->headers); i++){
+        tuple = PyList_GET_ITEM(client->headers, i);
+        if(PyTuple_Check(tuple) && PyTuple_GET_SIZE(tuple) == 2 && PyString_Check(PyTuple_GET_ITEM(tuple, 0))
+                && !strcasecmp(PyString_AS_STRING(PyTuple_GET_ITEM(tuple, 0)), "Content-Encoding")){
+            return 0;
+        }
+    }
+    name = PyObject_GetAttrString(filewrap->filelike, "name");
+    if(name == NULL){
+        PyErr_Clear();
+        return 0;
+    }
+    if(!PyString_Check(name) || fstat(in_fd, &info) == -1){
+        Py_DECREF(name);
+        return 0;
+    }
+    entry = lookup_precompressed(name, info.st_mtime);
+    if(entry == NULL){
+        PyErr_Clear();
+        Py_DECREF(name);
+        return 0;
+    }
+    if(PyInt_AS_LONG(PyTuple_GET_ITEM(entry, 1)) || PyInt_AS_LONG(PyTuple_GET_ITEM(entry, 2))){
+        client->vary_encoding = 1;
+    }
+    if(PyInt_AS_LONG(PyTuple_GET_ITEM(entry, 1)) && accept_encoding(client, "br")){
+        ext = ".br";
+        encoding = "br";
+    }else if(PyInt_AS_LONG(PyTuple_GET_ITEM(entry, 2)) && accept_encoding(client, "gzip")){
+        ext = ".gz";
+        encoding = "gzip";
+    }else{
+        Py_DECREF(name);
+        return 0;
+    }
+    snprintf(path, sizeof(path), "%s%s", PyString_AS_STRING(name), ext);
+    fp = fopen(path, "rb");
+    if(fp == NULL || fstat(fileno(fp), &info) == -1){
+        //gone, look up again next time
+        if(fp){
+            fclose(fp);
+        }
+        PyDict_DelItem(precompressed_cache, name);
+        PyErr_Clear();
+        Py_DECREF(name);
+        return 0;
+    }
+    Py_DECREF(name);
+#ifdef DEBUG
+    printf("use precompressed %s \n", path);
+#endif
+    file = PyFile_FromFile(fp, path, "rb", fclose);
+    if(file == NULL){
+        PyErr_Clear();
+        return 0;
+    }
+    Py_DECREF(filewrap->filelike);
+    filewrap->filelike = file;
+
+    //write_headers replaces Content-Length, the app's header list is left alone
+    client->content_encoding = encoding;
+    client->content_length = (int)info.st_size;
+    return 1;
+}
+
 static inline int
 start_response_file(client_t *client)
 {
@@ -684,6 +1025,13 @@ start_response_file(client_t *client)
 #endif
         return -1;
     }
+    if(precompressed && open_precompressed(client, filewrap, in_fd)){
+        in_fd = PyObject_AsFileDescriptor(filewrap->filelike);
+        if (in_fd == -1) {
+            PyErr_Clear();
+            return -1;
+        }
+    }
     ret = write_headers(client, NULL, 0);
     if(!client->content_length_set){
         if (fstat(in_fd, &info) == -1){
@@ -752,7 +1100,8 @@ response_start(client_t *client)
         return write_headers(client, NULL, 0);
     }
     enable_cork(client);
-    if (CheckFileWrapper(client->response)) {
+    if (CheckFileWrapper(client->response) && !client->tls) {
+        //no sendfile over TLS, iterate the file_wrapper
 #ifdef DEBUG
         printf("use sendfile \n");
 #endif 
@@ -783,6 +1132,7 @@ setup_start_response(void)
 inline void
 clear_start_response(void)
 {
+    Py_CLEAR(precompressed_cache);
     Py_DECREF(start_response);
 }
 
@@ -14,12 +14,15 @@ typedef struct iovec iovec_t;
 
 typedef struct {
     int fd;
+    void *tls;          // TLS session of the client
     iovec_t *iov;
     uint32_t iov_cnt;
     uint32_t iov_size;
     uint32_t total;
     uint32_t total_size;
     uint8_t sended;
+    char chunk_size[32];    // chunk size line
+    PyObject *temp1;        // keep alive data (compressed body)
 } write_bucket;
 
 
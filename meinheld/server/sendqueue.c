@@ -0,0 +1,313 @@
+#include "sendqueue.h"
+#include <sys/uio.h>
+
+/*
+ * outbound queue of an upgraded connection.
+ * writes are queued as string objects and the loop drains them
+ * with writev when the socket is writable, so one string can be
+ * queued on many connections without copying.
+ */
+
+#define SEND_QUEUE_INIT_SIZE 16
+#define SEND_QUEUE_IOV_SIZE 64
+
+size_t send_queue_high = 1024 * 64;
+size_t send_queue_low = 1024 * 16;
+
+static void
+send_queue_callback(picoev_loop* loop, int fd, int events, void* cb_arg);
+
+static inline send_queue*
+get_send_queue(client_t *client)
+{
+    send_queue *q = (send_queue *)client->send_queue;
+
+    if(q){
+        return q;
+    }
+    q = (send_queue *)PyMem_Malloc(sizeof(send_queue));
+    if(q == NULL){
+        PyErr_NoMemory();
+        return NULL;
+    }
+    memset(q, 0, sizeof(send_queue));
+    q->items = (PyObject **)PyMem_Malloc(sizeof(PyObject *) * SEND_QUEUE_INIT_SIZE);
+    if(q->items == NULL){
+        PyMem_Free(q);
+        PyErr_NoMemory();
+        return NULL;
+    }
+    q->size = SEND_QUEUE_INIT_SIZE;
+    client->send_queue = q;
+    return q;
+}
+
+static inline int
+grow_send_queue(send_queue *q)
+{
+    PyObject **items;
+    uint32_t i, size = q->size * 2;
+
+    items = (PyObject **)PyMem_Malloc(sizeof(PyObject *) * size);
+    if(items == NULL){
+        PyErr_NoMemory();
+        return -1;
+    }
+    for(i = 0; i < q->cnt; i++){
+        items[i] = q->items[(q->head + i) % q->size];
+    }
+    PyMem_Free(q->items);
+    q->items = items;
+    q->size = size;
+    q->head = 0;
+    return 0;
+}
+
+static inline void
+pop_item(send_queue *q)
+{
+    PyObject *item = q->items[q->head];
+
+    q->head = (q->head + 1) % q->size;
+    q->cnt--;
+    q->offset = 0;
+    Py_DECREF(item);
+}
+
+/*
+ * 1: all sent, 0: EAGAIN, -1: error
+ */
+static inline int
+flush_send_queue(client_t *client, send_queue *q)
+{
+    struct iovec iov[SEND_QUEUE_IOV_SIZE];
+    PyObject *item;
+    ssize_t w;
+    size_t len;
+    uint32_t i, n;
+
+    while(q->cnt > 0){
+        n = q->cnt < SEND_QUEUE_IOV_SIZE ? q->cnt : SEND_QUEUE_IOV_SIZE;
+        for(i = 0; i < n; i++){
+            item = q->items[(q->head + i) % q->size];
+            iov[i].iov_base = PyString_AS_STRING(item);
+            iov[i].iov_len = PyString_GET_SIZE(item);
+        }
+        iov[0].iov_base += q->offset;
+        iov[0].iov_len -= q->offset;
+
+        Py_BEGIN_ALLOW_THREADS
+        if(client->tls){
+            w = tls_writev(client->tls, iov, n);
+        }else{
+            w = writev(client->fd, iov, n);
+        }
+        Py_END_ALLOW_THREADS
+#ifdef DEBUG
+        printf("flush_send_queue fd:%d items:%d write:%d \n", client->fd, n, (int)w);
+#endif
+        if(w < 0){
+            if(errno == EAGAIN || errno == EWOULDBLOCK){
+                return 0;
+            }
+            q->error = errno;
+            return -1;
+        }
+        q->bytes -= w;
+        while(w > 0){
+            len = PyString_GET_SIZE(q->items[q->head]) - q->offset;
+            if((size_t)w < len){
+                q->offset += w;
+                break;
+            }
+            w -= len;
+            pop_item(q);
+        }
+    }
+    return 1;
+}
+
+/*
+ * resume the greenlet waiting in send_queue_wait.
+ * the greenlet registers the queue again if it is not empty.
+ */
+static inline void
+wake_waiter(client_t *client, send_queue *q)
+{
+    PyObject *waiter = q->waiter;
+
+    if(waiter == NULL){
+        return;
+    }
+    if(!q->error && q->bytes > q->wait_mark){
+        return;
+    }
+    q->waiter = NULL;
+    q->writing = 0;
+    if(q->error){
+        errno = q->error;
+        PyErr_SetFromErrno(PyExc_IOError);
+    }
+    switch_wsgi_app(main_loop, client->fd, waiter);
+    Py_DECREF(waiter);
+}
+
+static inline void
+watch_send_queue(client_t *client, send_queue *q)
+{
+    if(q->cnt > 0 && !q->writing && !q->error){
+        q->writing = 1;
+        picoev_del(main_loop, client->fd);
+        picoev_add(main_loop, client->fd, PICOEV_WRITE, 0, send_queue_callback, (void *)client);
+    }
+}
+
+static void
+send_queue_callback(picoev_loop* loop, int fd, int events, void* cb_arg)
+{
+    client_t *client = (client_t *)cb_arg;
+    send_queue *q = (send_queue *)client->send_queue;
+
+    if((events & PICOEV_WRITE) == 0 || q == NULL){
+        return;
+    }
+    if(flush_send_queue(client, q) != 0){
+        //empty or dead
+        q->writing = 0;
+        picoev_del(loop, fd);
+    }
+    wake_waiter(client, q);
+}
+
+inline int
+send_queue_push(client_t *client, PyObject *data)
+{
+    send_queue *q;
+
+    if(!PyString_Check(data)){
+        PyErr_SetString(PyExc_TypeError, "must be string");
+        return -1;
+    }
+    q = get_send_queue(client);
+    if(q == NULL){
+        return -1;
+    }
+    if(q->error){
+        errno = q->error;
+        PyErr_SetFromErrno(PyExc_IOError);
+        return -1;
+    }
+    if(PyString_GET_SIZE(data) == 0){
+        return 0;
+    }
+    if(q->cnt == q->size && grow_send_queue(q) == -1){
+        return -1;
+    }
+    Py_INCREF(data);
+    q->items[(q->head + q->cnt) % q->size] = data;
+    q->cnt++;
+    q->bytes += PyString_GET_SIZE(data);
+
+    if(!q->writing){
+        //try now, wait for the socket if it's full
+        if(flush_send_queue(client, q) == -1){
+            errno = q->error;
+            PyErr_SetFromErrno(PyExc_IOError);
+            return -1;
+        }
+        watch_send_queue(client, q);
+    }
+    return 0;
+}
+
+inline size_t
+send_queue_bytes(client_t *client)
+{
+    send_queue *q = (send_queue *)client->send_queue;
+
+    if(q == NULL){
+        return 0;
+    }
+    return q->bytes;
+}
+
+/*
+ * suspend the app greenlet until queued bytes <= mark
+ */
+inline PyObject*
+send_queue_wait(ClientObject *pyclient, size_t mark)
+{
+    client_t *client = pyclient->client;
+    send_queue *q = (send_queue *)client->send_queue;
+    PyObject *res;
+
+    if(q == NULL || q->bytes <= mark){
+        Py_RETURN_NONE;
+    }
+    if(q->error){
+        errno = q->error;
+        PyErr_SetFromErrno(PyExc_IOError);
+        return NULL;
+    }
+    if(q->waiter){
+        PyErr_SetString(PyExc_Exception, "already waiting");
+        return NULL;
+    }
+    if(!pyclient->greenlet){
+        mark_cooperative(client);
+        PyErr_SetString(PyExc_ValueError, "greenlet is not set");
+        return NULL;
+    }
+    Py_INCREF(pyclient);
+    q->waiter = (PyObject *)pyclient;
+    q->wait_mark = mark;
+    watch_send_queue(client, q);
+
+    res = switch_to_hub(pyclient);
+    if(res == NULL){
+        if(q->waiter){
+            Py_CLEAR(q->waiter);
+        }
+        return NULL;
+    }
+    Py_DECREF(res);
+    //switch_wsgi_app removed the event
+    watch_send_queue(client, q);
+    Py_RETURN_NONE;
+}
+
+/*
+ * queue data, wait for the drain to the low watermark
+ * only if the queue is over the high watermark
+ */
+inline PyObject*
+send_queue_send(ClientObject *pyclient, PyObject *data)
+{
+    if(send_queue_push(pyclient->client, data) == -1){
+        return NULL;
+    }
+    if(send_queue_bytes(pyclient->client) > send_queue_high){
+        return send_queue_wait(pyclient, send_queue_low);
+    }
+    Py_RETURN_NONE;
+}
+
+inline void
+send_queue_free(client_t *client)
+{
+    send_queue *q = (send_queue *)client->send_queue;
+
+    if(q == NULL){
+        return;
+    }
+    if(q->writing){
+        picoev_del(main_loop, client->fd);
+    }
+    while(q->cnt > 0){
+        pop_item(q);
+    }
+    Py_CLEAR(q->waiter);
+    PyMem_Free(q->items);
+    PyMem_Free(q);
+    client->send_queue = NULL;
+}
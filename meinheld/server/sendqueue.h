@@ -0,0 +1,39 @@
+#ifndef SENDQUEUE_H
+#define SENDQUEUE_H
+
+#include <Python.h>
+#include "server.h"
+#include "client.h"
+
+typedef struct {
+    PyObject **items;   // queued strings (ring)
+    uint32_t size;
+    uint32_t head;
+    uint32_t cnt;
+    size_t offset;      // sent bytes of the head item
+    size_t bytes;       // queued bytes
+    uint8_t writing;    // waiting for PICOEV_WRITE
+    int error;          // errno of the failed write
+    size_t wait_mark;   // resume the waiter at or below
+    PyObject *waiter;   // ClientObject waiting for the drain
+} send_queue;
+
+extern size_t send_queue_high; // send() waits above
+extern size_t send_queue_low;  // until queued bytes <= low
+
+inline int
+send_queue_push(client_t *client, PyObject *data);
+
+inline size_t
+send_queue_bytes(client_t *client);
+
+inline PyObject*
+send_queue_send(ClientObject *pyclient, PyObject *data);
+
+inline PyObject*
+send_queue_wait(ClientObject *pyclient, size_t mark);
+
+inline void
+send_queue_free(client_t *client);
+
+#endif
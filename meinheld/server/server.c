@@ -9,6 +9,7 @@
 
 #include <sys/un.h>
 #include <sys/stat.h>
+#include <poll.h>
 
 #include "http_request_parser.h"
 #include "response.h"
@@ -16,19 +17,49 @@
 #include "client.h"
 #include "util.h"
 #include "stringio.h"
+#include "input.h"
+#include "channel.h"
+#include "sendqueue.h"
+#include "stream.h"
+#include "protocol.h"
+#include "watcher.h"
+#include "timer.h"
+#include "fdwait.h"
+#include "child.h"
+#include "http_response_parser.h"
 
 #define ACCEPT_TIMEOUT_SECS 1
 #define READ_TIMEOUT_SECS 30 
 
+#define LISTEN_FD_ENV "MEINHELD_LISTEN_FD"
+
+#define FREELIST_DECAY_SECS 60
+
 #define MAX_BUFSIZE 1024 * 8
 #define INPUT_BUF_SIZE 1024 * 8
+#define MAX_INPUT_BUF_SIZE 1024 * 512
 
 static char *server_name = "127.0.0.1";
 static short server_port = 8000;
 static int listen_sock;  // listen socket
+static int own_listen_sock = 0;  // listen socket created by listen()
 
 static int loop_done; // main loop flag
 
+static int activecnt = 0; // active connections
+static int max_connections = 0; // max active connections (0: unlimited)
+
+static int inflight = 0; // requests running in the wsgi app
+static int max_requests = 0; // max in-flight requests (0: unlimited)
+
+int draining = 0; // graceful shutdown in progress
+static time_t drain_deadline = 0;
+static int graceful_timeout = 0; // graceful shutdown timeout (SIGTERM)
+
+static volatile sig_atomic_t shutdown_requested = 0;
+static volatile sig_atomic_t reexec_requested = 0;
+static int reexeced = 0;
+
 picoev_loop* main_loop; //main loop
 
 static PyObject *wsgi_app = NULL; //wsgi app
@@ -46,6 +77,10 @@ static int keep_alive_timeout = 5;
 int max_content_length = 1024 * 1024 * 16; //max_content_length
 int client_body_buffer_size = 1024 * 500;  //client_body_buffer_size
 
+int gzip_level = 0; //gzip response compression level (0: off)
+int gzip_min_length = 1024; //gzip minimum body size
+int precompressed = 0; //use precompressed file (name.br, name.gz)
+
 static char *unix_sock_name = NULL;
 
 static int backlog = 1024 * 4; // backlog size
@@ -59,6 +94,7 @@ PyObject* timeout_error;
 /* reuse object */
 static PyObject *client_key = NULL; //meinheld.client
 static PyObject *wsgi_input_key = NULL; //wsgi.input key
+static PyObject *path_info_key = NULL; //PATH_INFO key
 static PyObject *empty_string = NULL; //""
 
 /* gunicorn */
@@ -66,10 +102,44 @@ static int spinner = 0;
 static int tempfile_fd = 0;
 static int ppid = 0;
 
-#define CLIENT_MAXFREELIST 1024
-
-static client_t *client_free_list[CLIENT_MAXFREELIST];
-static int client_numfree = 0;
+/* fast path */
+static int fast_path = 0; // call the app without a greenlet
+static PyObject *cooperative_paths = NULL; // PATH_INFO -> True, learned on suspend
+static PyObject *cooperative_prefixes = NULL; // tuple of PATH_INFO prefixes
+#define MAX_COOPERATIVE_PATHS 1024
+
+/* greenlet pool */
+static PyGreenlet **greenlet_pool = NULL; // parked worker greenlets
+static int greenlet_pool_size = 0; // 0: disable
+static int greenlet_pool_cnt = 0;
+static long greenlet_max_stack = 1024 * 64; // discard if saved stack is larger
+static PyObject *greenlet_worker_func = NULL;
+static uint64_t greenlet_created = 0;
+static uint64_t greenlet_reused = 0;
+static uint64_t greenlet_discarded = 0;
+static uint64_t greenlet_dropped = 0;
+
+static char *read_buf = NULL; // shared read buffer
+static size_t read_buf_size = 0;
+
+/* heartbeat */
+static int heartbeat_interval = 1000; // msec
+static uintptr_t next_heartbeat = 0;
+
+#define CLIENT_MINFREELIST 64
+#define CLIENT_MAXFREELIST 1024 * 4
+#define CLIENT_ARENA_SIZE 1024 * 4
+
+/* per connection state carved from one block */
+typedef struct {
+    client_t client;
+    http_parser http;
+    request_queue request_queue;
+    arena arena;
+    char arena_block[CLIENT_ARENA_SIZE];
+} client_slab;
+
+static freelist client_free_list;
 
 static void
 r_callback(picoev_loop* loop, int fd, int events, void* cb_arg);
@@ -77,6 +147,9 @@ r_callback(picoev_loop* loop, int fd, int events, void* cb_arg);
 static void
 w_callback(picoev_loop* loop, int fd, int events, void* cb_arg);
 
+static void
+accept_callback(picoev_loop* loop, int fd, int events, void* cb_arg);
+
 static inline void
 resume_wsgi_app(ClientObject *pyclient, picoev_loop* loop);
 
@@ -99,52 +172,56 @@ setsig(int sig, void* handler)
     return sigaction(sig, &context, &ocontext);
 }
 
+static void *
+new_client_slab(void)
+{
+    return PyMem_Malloc(sizeof(client_slab));
+}
+
 static inline void
 client_t_list_fill(void)
 {
-    client_t *client;
-	while (client_numfree < CLIENT_MAXFREELIST) {
-        client = (client_t *)PyMem_Malloc(sizeof(client_t));
-		client_free_list[client_numfree++] = client;
-	}
+    freelist_init(&client_free_list, "client_t", CLIENT_MINFREELIST, CLIENT_MAXFREELIST, new_client_slab, PyMem_Free);
+    freelist_fill(&client_free_list);
 }
 
 static inline void
 client_t_list_clear(void)
 {
-	client_t *op;
-
-	while (client_numfree) {
-		op = client_free_list[--client_numfree];
-		PyMem_Free(op);
-	}
+    freelist_clear(&client_free_list);
 }
 
 static inline client_t*
 alloc_client_t(void)
 {
     client_t *client;
-	if (client_numfree) {
-		client = client_free_list[--client_numfree];
+    client_slab *slab;
+    client = (client_t *)freelist_pop(&client_free_list);
+	if (client) {
 #ifdef DEBUG
         printf("use pooled client %p\n", client);
 #endif
     }else{
-        client = (client_t *)PyMem_Malloc(sizeof(client_t));
+        client = (client_t *)PyMem_Malloc(sizeof(client_slab));
 #ifdef DEBUG
         printf("alloc client %p\n", client);
 #endif
     }
+    slab = (client_slab *)client;
     memset(client, 0, sizeof(client_t));
+    memset(&slab->request_queue, 0, sizeof(request_queue));
+    arena_init(&slab->arena, slab->arena_block, CLIENT_ARENA_SIZE);
+    client->http = &slab->http;
+    client->request_queue = &slab->request_queue;
+    client->arena = &slab->arena;
     return client;
 }
 
 static inline void
 dealloc_client(client_t *client)
 {
-	if (client_numfree < CLIENT_MAXFREELIST){
-		client_free_list[client_numfree++] = client;
-    }else{
+    arena_reset(client->arena);
+	if (!freelist_push(&client_free_list, client)){
 	    PyMem_Free(client);
     }
 }
@@ -159,16 +236,60 @@ new_client_t(int client_fd, char *remote_addr, uint32_t remote_port){
     //memset(client, 0, sizeof(client_t));
 
     client->fd = client_fd;
-    client->request_queue = new_request_queue();    
     client->remote_addr = remote_addr;
     client->remote_port = remote_port;
     client->body_type = BODY_TYPE_NONE;
     return client;
 }
 
+/*
+ * read destination. the in-memory body when Content-Length is known,
+ * else the shared read buffer, grown for large bodies.
+ */
+static inline char *
+get_read_buffer(client_t *client, size_t *len)
+{
+    char *buf;
+    size_t size = INPUT_BUF_SIZE, remain;
+
+    buf = body_read_space(client, len);
+    if(buf){
+        return buf;
+    }
+    if(!client->complete && client->body_type != BODY_TYPE_NONE){
+        //large body (tmpfile or chunked)
+        remain = client->body_length > 0 ? client->body_length - client->body_readed : MAX_INPUT_BUF_SIZE;
+        while(size < remain && size < MAX_INPUT_BUF_SIZE){
+            size <<= 1;
+        }
+    }
+    if(size > read_buf_size){
+        buf = PyMem_Realloc(read_buf, size);
+        if(buf == NULL){
+            size = read_buf_size;
+        }else{
+            read_buf = buf;
+            read_buf_size = size;
+        }
+    }
+    *len = size;
+    return read_buf;
+}
+
+static inline ssize_t
+read_client(client_t *client, char *buf, size_t len)
+{
+    if(client->tls){
+        return tls_read(client->tls, buf, len);
+    }
+    return read(client->fd, buf, len);
+}
+
 static inline void
 clean_cli(client_t *client)
 {
+    ClientObject *pyclient;
+
     write_access_log(client, log_fd, log_path);
     if(client->req){
         free_request(client->req);
@@ -182,7 +303,17 @@ clean_cli(client_t *client)
 #ifdef DEBUG
     printf("clean_cli environ status_code %d address %p \n", client->status_code, client->environ);
 #endif
+    if(client->continue_input){
+        InputObject_detach(client->continue_input);
+        client->continue_input = NULL;
+    }
+    send_queue_free(client);
     if(client->environ){ 
+        pyclient = (ClientObject *)PyDict_GetItem(client->environ, client_key);
+        if(pyclient){
+            //the app may keep it
+            pyclient->client = NULL;
+        }
         PyDict_Clear(client->environ);
         Py_DECREF(client->environ);
     }
@@ -194,23 +325,86 @@ clean_cli(client_t *client)
         }
         client->body = NULL;
     }
+    if(client->zstream){
+        release_gzip_stream(client->zstream);
+        client->zstream = NULL;
+    }
     client->header_done = 0;
     client->response_closed = 0;
     client->chunked_response = 0;
     client->content_length_set = 0;
     client->content_length = 0;
     client->write_bytes = 0;
+    client->content_encoding = NULL;
+    client->vary_encoding = 0;
+}
+
+static inline void
+pause_accept(picoev_loop* loop)
+{
+    if(picoev_is_active(loop, listen_sock)){
+#ifdef DEBUG
+        printf("pause accept active:%d \n", activecnt);
+#endif
+        picoev_del(loop, listen_sock);
+    }
+}
+
+static inline void
+resume_accept(picoev_loop* loop)
+{
+    if(draining || !loop_done){
+        return;
+    }
+    if(max_connections > 0 && activecnt >= max_connections){
+        return;
+    }
+    if(!picoev_is_active(loop, listen_sock)){
+#ifdef DEBUG
+        printf("resume accept active:%d \n", activecnt);
+#endif
+        picoev_add(loop, listen_sock, PICOEV_READ, ACCEPT_TIMEOUT_SECS, accept_callback, NULL);
+    }
+}
+
+static inline void
+check_max_requests(client_t *client)
+{
+    request *req;
+    if(max_requests > 0 && inflight >= max_requests){
+        req = client->request_queue->head;
+        if(req->bad_request_code <= 200){
+#ifdef DEBUG
+            printf("too many requests fd %d inflight %d \n", client->fd, inflight);
+#endif
+            //overload
+            req->bad_request_code = 503;
+        }
+    }
 }
 
 static inline void 
 close_conn(client_t *cli, picoev_loop* loop)
 {
     client_t *new_client;
+    char *remote_addr;
+    int fd, remote_port;
+    void *tls;
+    if(cli->in_app){
+        cli->in_app = 0;
+        inflight--;
+    }
+    if(cli->body_pending){
+        //the app didn't read the body
+        cli->keep_alive = 0;
+    }
     if(!cli->response_closed){
         close_response(cli);
     }
 
-    picoev_del(loop, cli->fd);
+    if(!cli->detached){
+        picoev_del(loop, cli->fd);
+    }
     clean_cli(cli);
 
 #ifdef DEBUG
@@ -219,7 +413,8 @@ close_conn(client_t *cli, picoev_loop* loop)
     printf("remain http pipeline size :%d \n", cli->request_queue->size);
 #endif
     
-    if(cli->request_queue->size > 0){
+    if(cli->request_queue->size > 0 && !cli->detached){
+        check_max_requests(cli);
         if(check_status_code(cli) > 0){
             //process pipeline 
             prepare_call_wsgi(cli);
@@ -228,22 +423,35 @@ close_conn(client_t *cli, picoev_loop* loop)
         return ;
     }
 
-    if(cli->http != NULL){
-        PyMem_Free(cli->http);
-    }
-
-    free_request_queue(cli->request_queue);
-    if(!cli->keep_alive){
-        close(cli->fd);
+    clear_request_queue(cli->request_queue);
+    if(!cli->keep_alive || draining){
+        //a detached fd is owned by the Stream
+        if(!cli->detached){
+            if(cli->tls){
+                tls_free(cli->tls, 1);
+                cli->tls = NULL;
+            }
+            close(cli->fd);
+        }
+        activecnt--;
+        resume_accept(loop);
 #ifdef DEBUG
         printf("close client:%p fd:%d status_code %d \n", cli, cli->fd, cli->status_code);
 #endif
     }else{
         disable_cork(cli);
-        new_client = new_client_t(cli->fd, cli->remote_addr, cli->remote_port);
+        fd = cli->fd;
+        remote_addr = cli->remote_addr;
+        remote_port = cli->remote_port;
+        tls = cli->tls;
+        //reset and reuse the slab for next request
+        dealloc_client(cli);
+        new_client = new_client_t(fd, remote_addr, remote_port);
+        new_client->tls = tls;
         new_client->keep_alive = 1;
         init_parser(new_client, server_name, server_port);
         picoev_add(main_loop, new_client->fd, PICOEV_READ, keep_alive_timeout, r_callback, (void *)new_client);
+        return;
     }
     //PyMem_Free(cli);
     dealloc_client(cli);
@@ -294,6 +502,110 @@ check_status_code(client_t *client)
     
 }
 
+/*
+ * run loop of the pooled greenlet.
+ * call the app, hand the result to the hub and park
+ * until the hub switches the next (environ, start_response) in.
+ */
+static PyObject *
+greenlet_worker(PyObject *self, PyObject *args)
+{
+    PyObject *res, *value;
+    PyGreenlet *current;
+
+    Py_INCREF(args);
+    while(1){
+        res = PyObject_CallObject(wsgi_app, args);
+        Py_DECREF(args);
+        if(res == NULL){
+            //die, the hub gets the error
+            return NULL;
+        }
+        value = PyTuple_Pack(1, res);
+        Py_DECREF(res);
+        if(value == NULL){
+            return NULL;
+        }
+        current = PyGreenlet_GetCurrent();
+        args = PyGreenlet_Switch(PyGreenlet_GET_PARENT(current), value, NULL);
+        Py_DECREF(current);
+        Py_DECREF(value);
+        if(args == NULL){
+            //killed in the pool
+            return NULL;
+        }
+        if(!PyTuple_Check(args) || PyTuple_GET_SIZE(args) != 2){
+            //switched by someone else, finish
+            return args;
+        }
+    }
+}
+
+static PyMethodDef greenlet_worker_def = {
+    "greenlet_worker", greenlet_worker, METH_VARARGS, "run loop of the pooled greenlet"
+};
+
+static inline PyGreenlet*
+get_greenlet(void)
+{
+    if(greenlet_pool_size <= 0){
+        return PyGreenlet_New(wsgi_app, NULL);
+    }
+    if(greenlet_pool_cnt > 0){
+        greenlet_reused++;
+        return greenlet_pool[--greenlet_pool_cnt];
+    }
+    if(greenlet_worker_func == NULL){
+        greenlet_worker_func = PyCFunction_New(&greenlet_worker_def, NULL);
+        if(greenlet_worker_func == NULL){
+            return NULL;
+        }
+    }
+    greenlet_created++;
+    return PyGreenlet_New(greenlet_worker_func, NULL);
+}
+
+/*
+ * the request of the greenlet finished, park it for the next request
+ */
+static inline void
+release_greenlet(ClientObject *pyclient)
+{
+    PyGreenlet *greenlet = pyclient->greenlet;
+
+    if(greenlet_pool_size <= 0 || greenlet == NULL){
+        return;
+    }
+    pyclient->greenlet = NULL;
+    if(!PyGreenlet_ACTIVE(greenlet)){
+        //dead, not a parked worker
+        Py_DECREF(greenlet);
+        return;
+    }
+    if(greenlet->stack_saved > greenlet_max_stack){
+        greenlet_discarded++;
+        Py_DECREF(greenlet);
+        return;
+    }
+    if(greenlet_pool_cnt >= greenlet_pool_size){
+        greenlet_dropped++;
+        Py_DECREF(greenlet);
+        return;
+    }
+    greenlet_pool[greenlet_pool_cnt++] = greenlet;
+}
+
+static inline void
+greenlet_pool_clear(void)
+{
+    PyGreenlet *greenlet;
+
+    while(greenlet_pool_cnt > 0){
+        greenlet = greenlet_pool[--greenlet_pool_cnt];
+        Py_DECREF(greenlet);
+    }
+}
+
 static inline int
 process_resume_wsgi_app(ClientObject *pyclient)
 {
@@ -338,6 +650,7 @@ process_resume_wsgi_app(ClientObject *pyclient)
             return 0;
         }
     }
+    release_greenlet(pyclient);
 
     client->response = res;
     //next send response 
@@ -345,6 +658,128 @@ process_resume_wsgi_app(ClientObject *pyclient)
     
 }
 
+/*
+ * the request needs a greenlet (can suspend)
+ */
+static inline int
+is_cooperative(client_t *cli)
+{
+    PyObject *path, *prefix;
+    Py_ssize_t i, len;
+
+    if(!fast_path || cli->upgrade){
+        return 1;
+    }
+    path = PyDict_GetItem(cli->environ, path_info_key);
+    if(path == NULL){
+        return 0;
+    }
+    if(cooperative_paths && PyDict_GetItem(cooperative_paths, path)){
+        return 1;
+    }
+    if(cooperative_prefixes){
+        len = PyTuple_GET_SIZE(cooperative_prefixes);
+        for(i = 0; i < len; i++){
+            prefix = PyTuple_GET_ITEM(cooperative_prefixes, i);
+            if(PyString_GET_SIZE(path) >= PyString_GET_SIZE(prefix) &&
+                    !memcmp(PyString_AS_STRING(path), PyString_AS_STRING(prefix), PyString_GET_SIZE(prefix))){
+                return 1;
+            }
+        }
+    }
+    return 0;
+}
+
+/*
+ * hand the chunked body to the app as it is decoded.
+ * only in a greenlet, waiting for the chunks on the hub would block the loop
+ */
+static inline int
+can_stream_body(client_t *cli)
+{
+    return cli->chunked_request && cli->body_type != BODY_TYPE_TMPFILE && is_cooperative(cli);
+}
+
+/*
+ * the app tried to suspend without a greenlet,
+ * run this path in a greenlet from now on
+ */
+inline void
+mark_cooperative(client_t *cli)
+{
+    PyObject *path;
+
+    if(cli == NULL || cli->environ == NULL){
+        return;
+    }
+    path = PyDict_GetItem(cli->environ, path_info_key);
+    if(path == NULL){
+        return;
+    }
+    if(cooperative_paths == NULL){
+        cooperative_paths = PyDict_New();
+        if(cooperative_paths == NULL){
+            PyErr_Clear();
+            return;
+        }
+    }
+    if(PyDict_Size(cooperative_paths) < MAX_COOPERATIVE_PATHS){
+        PyDict_SetItem(cooperative_paths, path, Py_True);
+    }
+}
+
+/*
+ * suspend the app greenlet, return the value of the resume
+ */
+inline PyObject*
+switch_to_hub(ClientObject *pyclient)
+{
+    PyGreenlet *parent;
+
+    parent = PyGreenlet_GET_PARENT(pyclient->greenlet);
+    return PyGreenlet_Switch(parent, hub_switch_value, NULL);
+}
+
+/*
+ * wait fd on the hub stack, blocks the loop.
+ * gives up after BLOCKING_WAIT_MSEC, the path runs in a greenlet next time
+ */
+static inline int
+wait_blocking(int fd, int event, int timeout)
+{
+    struct pollfd pfd;
+    int ret, msec, capped = 0;
+
+    if(timeout <= 0 || timeout > BLOCKING_WAIT_MSEC / 1000){
+        msec = BLOCKING_WAIT_MSEC;
+        capped = 1;
+    }else{
+        msec = timeout * 1000;
+    }
+
+    pfd.fd = fd;
+    pfd.events = 0;
+    pfd.revents = 0;
+    if(event & PICOEV_READ){
+        pfd.events |= POLLIN;
+    }
+    if(event & PICOEV_WRITE){
+        pfd.events |= POLLOUT;
+    }
+    Py_BEGIN_ALLOW_THREADS
+    ret = poll(&pfd, pfd.events ? 1 : 0, msec);
+    Py_END_ALLOW_THREADS
+    if(ret < 0){
+        PyErr_SetFromErrno(PyExc_IOError);
+        return -1;
+    }
+    if(ret == 0 && (pfd.events || capped)){
+        PyErr_SetString(timeout_error, "timeout");
+        return -1;
+    }
+    return 0;
+}
+
 static inline int
 process_wsgi_app(client_t *cli)
 {
@@ -366,16 +801,25 @@ process_wsgi_app(client_t *cli)
     printf("start environ %p \n", cli->environ);
 #endif
 
-    //new greenlet
-    greenlet = PyGreenlet_New(wsgi_app, NULL);
-    // set_greenlet
-    pyclient->greenlet = greenlet;
-    Py_INCREF(pyclient->greenlet);
+    if(!is_cooperative(cli)){
+        //fast path, call on the hub stack
+        res = PyObject_CallObject(wsgi_app, args);
+        Py_DECREF(args);
+    }else{
+        greenlet = get_greenlet();
+        if(greenlet == NULL){
+            Py_DECREF(args);
+            write_error_log(__FILE__, __LINE__);
+            return -1;
+        }
+        // set_greenlet
+        pyclient->greenlet = greenlet;
+        Py_INCREF(pyclient->greenlet);
 
-    res = PyGreenlet_Switch(greenlet, args, NULL);
-    //res = PyObject_CallObject(wsgi_app, args);
-    Py_DECREF(args);
-    Py_DECREF(greenlet);
+        res = PyGreenlet_Switch(greenlet, args, NULL);
+        Py_DECREF(args);
+        Py_DECREF(greenlet);
+    }
     
 
     //check response & PyErr_Occurred
@@ -394,6 +838,7 @@ process_wsgi_app(client_t *cli)
             return 0;
         }
     }
+    release_greenlet(pyclient);
 
     //next send response 
     cli->response = res;
@@ -414,6 +859,18 @@ switch_wsgi_app(picoev_loop* loop, int fd, PyObject *obj)
     pyclient->resumed = 0;
 }
 
+/*
+ * resume the app greenlet waiting on a timer or some fds
+ */
+inline void
+resume_app(PyObject *obj)
+{
+    ClientObject *pyclient = (ClientObject *)obj;
+
+    resume_wsgi_app(pyclient, main_loop);
+    pyclient->resumed = 0;
+}
+
 static void
 resume_callback(picoev_loop* loop, int fd, int events, void* cb_arg)
 {
@@ -563,6 +1020,8 @@ static inline void
 call_wsgi_app(client_t *client, picoev_loop* loop)
 {
     int ret;
+    client->in_app = 1;
+    inflight++;
     ret = process_wsgi_app(client);
 
 #ifdef DEBUG
@@ -617,6 +1076,27 @@ call_wsgi_app(client_t *client, picoev_loop* loop)
     
 }
 
+static inline PyObject *
+create_input(client_t *client)
+{
+    PyObject *input = NULL;
+
+    if(client->body_type == BODY_TYPE_TMPFILE){
+        FILE *tmp = (FILE *)client->body;
+        fflush(tmp);
+        rewind(tmp);
+        input = PyFile_FromFile(tmp, "<tmpfile>", "r", fclose);
+    }else{
+        if(client->body){
+            input = StringIOObject_New((buffer *)client->body);
+        }else{
+            input = StringIOObject_New(new_buffer(0, 0));
+        }
+    }
+    client->body = NULL;
+    return input;
+}
+
 static inline void
 prepare_call_wsgi(client_t *client)
 {
@@ -630,50 +1110,23 @@ prepare_call_wsgi(client_t *client)
         c = PyDict_GetItemString(client->environ, "HTTP_EXPECT");
         if(c){
             val = PyString_AS_STRING(c);
-            if(!strcasecmp(val, "100-continue")){
-                int ret = write(client->fd, "HTTP/1.1 100 Continue\r\n\r\n", 25);
-                if(ret < 0){
-                    PyErr_SetFromErrno(PyExc_IOError);
-                    write_error_log(__FILE__, __LINE__); 
-                    client->keep_alive = 0;
-                    client->status_code = 500;
-                    send_error_page(client);
-                    close_conn(client, main_loop);
-                    return;
-                }
-            }else{
+            if(strcasecmp(val, "100-continue")){
                 //417
                 client->keep_alive = 0;
-                client->status_code = 417;
+                client->bad_request_code = 417;
                 send_error_page(client);
                 close_conn(client, main_loop);
                 return;
             }
         }
     }
-    if(client->body_type == BODY_TYPE_TMPFILE){
-        FILE *tmp = (FILE *)client->body;
-        fflush(tmp);
-        rewind(tmp);
-        input = PyFile_FromFile(tmp, "<tmpfile>", "r", fclose);
-        PyDict_SetItem((PyObject *)client->environ, wsgi_input_key, input);
-        Py_DECREF(input);
-        client->body = NULL;
+    if(client->body_pending){
+        input = InputObject_New(client);
     }else{
-        if(client->body_type == BODY_TYPE_BUFFER){
-            input = StringIOObject_New((buffer *)client->body);
-            PyDict_SetItem((PyObject *)client->environ, wsgi_input_key, input);
-        }else{
-            if(client->body){
-                input = StringIOObject_New((buffer *)client->body);
-            }else{
-                input = StringIOObject_New(new_buffer(0, 0));
-            }
-            PyDict_SetItem((PyObject *)client->environ, wsgi_input_key, input);
-        }
-        client->body = NULL;;
-        Py_DECREF(input);
+        input = create_input(client);
     }
+    PyDict_SetItem((PyObject *)client->environ, wsgi_input_key, input);
+    Py_DECREF(input);
 
     if(is_keep_alive){
         //support keep-alive
@@ -726,124 +1179,147 @@ r_callback(picoev_loop* loop, int fd, int events, void* cb_arg)
             set_bad_request_code(cli, 408);
             finish = 1;
         }else{
+            //cli is freed
             close_conn(cli, loop);
+            return;
         }
     
-    } else if ((events & PICOEV_READ) != 0) {
-        char buf[INPUT_BUF_SIZE];
+    } else if ((events & (PICOEV_READ | PICOEV_WRITE)) != 0) {
+        char *buf;
+        size_t size;
         ssize_t r;
         if(!cli->keep_alive){
             picoev_set_timeout(loop, cli->fd, READ_TIMEOUT_SECS);
         }
-        Py_BEGIN_ALLOW_THREADS
-        r = read(cli->fd, buf, sizeof(buf));
-        Py_END_ALLOW_THREADS
-        switch (r) {
-            case 0: 
-                cli->keep_alive = 0;
-                //503??
-                if(cli->request_queue->size > 0){
-                    //piplining
-                    set_bad_request_code(cli, 503);
-                    finish = 1;
-                }else{
-                    cli->status_code = 503;
-                    send_error_page(cli);
-                    close_conn(cli, loop);
-                    return;
-                }
-            case -1: /* error */
-                if (errno == EAGAIN || errno == EWOULDBLOCK) { /* try again later */
-                    break;
-                } else { /* fatal error */
+        if((events & PICOEV_WRITE) != 0){
+            //TLS handshake wrote, read again
+            picoev_set_events(loop, cli->fd, PICOEV_READ);
+        }
+        //decrypted data left in the TLS record is read while cli is alive
+        do{
+            buf = get_read_buffer(cli, &size);
+            Py_BEGIN_ALLOW_THREADS
+            r = read_client(cli, buf, size);
+            Py_END_ALLOW_THREADS
+            switch (r) {
+                case 0: 
+                    cli->keep_alive = 0;
+                    //503??
                     if(cli->request_queue->size > 0){
                         //piplining
-                        set_bad_request_code(cli, 500);
-                        if(errno != ECONNRESET){
-                            PyErr_SetFromErrno(PyExc_IOError);
-                            write_error_log(__FILE__, __LINE__); 
-                        }
+                        set_bad_request_code(cli, 503);
                         finish = 1;
                     }else{
-                        if(cli->keep_alive && errno == ECONNRESET){
-                        
-                            cli->keep_alive = 0;
-                            cli->status_code = 500;
-                            cli->header_done = 1;
-                            cli->response_closed = 1;
-                        
-                        }else{
-                            PyErr_SetFromErrno(PyExc_IOError);
-                            write_error_log(__FILE__, __LINE__); 
-                            cli->keep_alive = 0;
-                            cli->status_code = 500;
+                        cli->status_code = 503;
+                        send_error_page(cli);
+                        close_conn(cli, loop);
+                        return;
+                    }
+                case -1: /* error */
+                    if (errno == EAGAIN || errno == EWOULDBLOCK) { /* try again later */
+                        if(cli->tls && tls_want_write(cli->tls)){
+                            picoev_set_events(loop, cli->fd, PICOEV_READ | PICOEV_WRITE);
+                        }
+                        break;
+                    } else { /* fatal error */
+                        if(cli->request_queue->size > 0){
+                            //piplining
+                            set_bad_request_code(cli, 500);
                             if(errno != ECONNRESET){
-                                send_error_page(cli);
-                            }else{
+                                PyErr_SetFromErrno(PyExc_IOError);
+                                write_error_log(__FILE__, __LINE__); 
+                            }
+                            finish = 1;
+                        }else{
+                            if(cli->keep_alive && errno == ECONNRESET){
+                        
+                                cli->keep_alive = 0;
+                                cli->status_code = 500;
                                 cli->header_done = 1;
                                 cli->response_closed = 1;
+                        
+                            }else{
+                                PyErr_SetFromErrno(PyExc_IOError);
+                                write_error_log(__FILE__, __LINE__); 
+                                cli->keep_alive = 0;
+                                cli->status_code = 500;
+                                if(errno != ECONNRESET){
+                                    send_error_page(cli);
+                                }else{
+                                    cli->header_done = 1;
+                                    cli->response_closed = 1;
+                                }
                             }
+                            close_conn(cli, loop);
+                            return;
                         }
-                        close_conn(cli, loop);
-                        return;
                     }
-                }
-                break;
-            default:
-#ifdef DEBUG
-                printf("********************\n%s\n", buf);
-#endif
-                nread = execute_parse(cli, buf, r);
-#ifdef DEBUG
-                printf("read request fd %d readed %d nread %d \n", cli->fd, r, nread);
-#endif
-                
-                if(cli->bad_request_code > 0){
-#ifdef DEBUG
-                    printf("fd %d bad_request code %d \n",cli->fd,  cli->bad_request_code);
-#endif
-                    set_bad_request_code(cli, cli->bad_request_code);
-                    ///force end
-                    finish = 1;
                     break;
-                }
+                default:
+    #ifdef DEBUG
+                    printf("********************\n%s\n", buf);
+    #endif
+                    nread = execute_parse(cli, buf, r);
+    #ifdef DEBUG
+                    printf("read request fd %d readed %d nread %d \n", cli->fd, r, nread);
+    #endif
+                
+                    if(cli->bad_request_code > 0){
+    #ifdef DEBUG
+                        printf("fd %d bad_request code %d \n",cli->fd,  cli->bad_request_code);
+    #endif
+                        set_bad_request_code(cli, cli->bad_request_code);
+                        ///force end
+                        finish = 1;
+                        break;
+                    }
 
-                if(!cli->upgrade && nread != r){
-                    // parse error
-#ifdef DEBUG
-                    printf("fd %d parse error Bad Request %d \n", cli->fd, cli->bad_request_code);
-#endif
-                    set_bad_request_code(cli, 400);
-                    ///force end
-                    finish = 1;
-                    break;
-                }
+                    if(!cli->upgrade && nread != r){
+                        // parse error
+    #ifdef DEBUG
+                        printf("fd %d parse error Bad Request %d \n", cli->fd, cli->bad_request_code);
+    #endif
+                        set_bad_request_code(cli, 400);
+                        ///force end
+                        finish = 1;
+                        break;
+                    }
                 
-#ifdef DEBUG
-                printf("parse ok, fd %d %d nread \n", cli->fd, nread);
-#endif
+    #ifdef DEBUG
+                    printf("parse ok, fd %d %d nread \n", cli->fd, nread);
+    #endif
                
-                if(parser_finish(cli) > 0){
-                    if(cli->upgrade){
-                        //WebSocket Key
-#ifdef DEBUG
-                        printf("upgrade websocket %d \n", cli->fd);
-#endif
-                        key = buf + nread + 1;
-                        buffer *b = new_buffer(r - nread -1, r - nread -1);
-                        if(write2buf(b, key, r - nread -1) == WRITE_OK){
-                            cli->request_queue->tail->body = b;
-                        }else{
-                            free_buffer(b);
+                    if(parser_finish(cli) > 0){
+                        if(cli->upgrade){
+                            //WebSocket Key
+    #ifdef DEBUG
+                            printf("upgrade websocket %d \n", cli->fd);
+    #endif
+                            key = buf + nread + 1;
+                            buffer *b = new_buffer(r - nread -1, r - nread -1);
+                            if(write2buf(b, key, r - nread -1) == WRITE_OK){
+                                cli->request_queue->tail->body = b;
+                            }else{
+                                free_buffer(b);
+                            }
                         }
-                    }
-                    finish = 1;
-                }
-                break;
-        }
+                        finish = 1;
+                    }else if(cli->request_queue->size == 1 && (cli->expect_continue || can_stream_body(cli))){
+                        //call the app now, the body is read when wsgi.input is read
+                        cli->body_pending = 1;
+                        cli->body_stream = can_stream_body(cli);
+                        //keep the part of the body already read
+                        cli->request_queue->tail->body = cli->body;
+                        cli->request_queue->tail->body_type = cli->body_type;
+                        finish = 1;
+                    }
+                    break;
+            }
+        }while(finish == 0 && r > 0 && cli->tls && tls_pending(cli->tls) > 0);
     }
     if(finish == 1){
         picoev_del(loop, cli->fd);
+        check_max_requests(cli);
         if(check_status_code(cli) > 0){
             //current request ok
             prepare_call_wsgi(cli);
@@ -882,8 +1358,21 @@ accept_callback(picoev_loop* loop, int fd, int events, void* cb_arg)
             remote_addr = inet_ntoa (client_addr.sin_addr);
             remote_port = ntohs(client_addr.sin_port);
             client = new_client_t(client_fd, remote_addr, remote_port);
+            if(tls_enabled()){
+                client->tls = tls_new(client_fd);
+                if(client->tls == NULL){
+                    close(client_fd);
+                    dealloc_client(client);
+                    return;
+                }
+            }
             init_parser(client, server_name, server_port);
             picoev_add(loop, client_fd, PICOEV_READ, keep_alive_timeout, r_callback, (void *)client);
+            activecnt++;
+            if(max_connections > 0 && activecnt >= max_connections){
+                //backpressure, leave connections in the kernel backlog
+                pause_accept(loop);
+            }
         }else{
             if (errno != EAGAIN && errno != EWOULDBLOCK) {
                 PyErr_SetFromErrno(PyExc_IOError);
@@ -896,6 +1385,113 @@ accept_callback(picoev_loop* loop, int fd, int events, void* cb_arg)
     }
 }
 
+static inline void
+close_idle_connections(picoev_loop* loop)
+{
+    int fd = -1;
+    void *cb_arg;
+    client_t *client;
+
+    while((fd = picoev_next_fd(loop, fd)) != -1){
+        if(picoev_get_callback(loop, fd, &cb_arg) != r_callback){
+            continue;
+        }
+        client = (client_t *)cb_arg;
+        if(client->keep_alive && client->request_queue->size == 0){
+            //idle keep-alive connection
+#ifdef DEBUG
+            printf("close idle connection fd:%d \n", fd);
+#endif
+            r_callback(loop, fd, PICOEV_TIMEOUT, cb_arg);
+        }
+    }
+}
+
+static inline void
+start_graceful_shutdown(int timeout)
+{
+    if(draining){
+        return;
+    }
+#ifdef DEBUG
+    printf("start graceful shutdown timeout:%d active:%d \n", timeout, activecnt);
+#endif
+    draining = 1;
+    drain_deadline = time(NULL) + timeout;
+    //stop accept
+    if(picoev_is_active(main_loop, listen_sock)){
+        picoev_del(main_loop, listen_sock);
+    }
+    protocol_stop(main_loop);
+    close_idle_connections(main_loop);
+}
+
+static inline void
+reexec_server(void)
+{
+    PyObject *executable, *argv, *item;
+    char **exec_argv;
+    char fd_str[16];
+    Py_ssize_t i, argc;
+    int fd;
+    pid_t pid;
+
+    executable = PySys_GetObject("executable");
+    argv = PySys_GetObject("argv");
+    if(executable == NULL || !PyString_Check(executable) || argv == NULL || !PyList_Check(argv)){
+        PyErr_SetString(PyExc_RuntimeError, "can't get sys.executable or sys.argv");
+        write_error_log(__FILE__, __LINE__);
+        return;
+    }
+
+    argc = PyList_GET_SIZE(argv);
+    exec_argv = (char **)PyMem_Malloc(sizeof(char *) * (argc + 2));
+    if(exec_argv == NULL){
+        PyErr_NoMemory();
+        write_error_log(__FILE__, __LINE__);
+        return;
+    }
+    exec_argv[0] = PyString_AS_STRING(executable);
+    for(i = 0; i < argc; i++){
+        item = PyList_GET_ITEM(argv, i);
+        if(!PyString_Check(item)){
+            PyMem_Free(exec_argv);
+            PyErr_SetString(PyExc_TypeError, "sys.argv item must be a string");
+            write_error_log(__FILE__, __LINE__);
+            return;
+        }
+        exec_argv[i + 1] = PyString_AS_STRING(item);
+    }
+    exec_argv[argc + 1] = NULL;
+    snprintf(fd_str, sizeof(fd_str), "%d", listen_sock);
+
+    pid = fork();
+    if(pid < 0){
+        PyMem_Free(exec_argv);
+        PyErr_SetFromErrno(PyExc_OSError);
+        write_error_log(__FILE__, __LINE__);
+        return;
+    }
+    if(pid == 0){
+        //child, hand over the listen socket
+        for(fd = 3; fd < max_fd; fd++){
+            if(fd != listen_sock){
+                close(fd);
+            }
+        }
+        fcntl(listen_sock, F_SETFD, 0);
+        setenv(LISTEN_FD_ENV, fd_str, 1);
+        execv(exec_argv[0], exec_argv);
+        _exit(127);
+    }
+    PyMem_Free(exec_argv);
+#ifdef DEBUG
+    printf("reexec new server pid:%d \n", pid);
+#endif
+    reexeced = 1;
+    start_graceful_shutdown(graceful_timeout);
+}
+
 static inline void
 setup_server_env(void)
 {
@@ -917,6 +1513,7 @@ setup_server_env(void)
     hub_switch_value = Py_BuildValue("(i)", -1);
     client_key = PyString_FromString("meinheld.client");
     wsgi_input_key = PyString_FromString("wsgi.input");
+    path_info_key = PyString_FromString("PATH_INFO");
     empty_string = PyString_FromString("");
 }
 
@@ -933,20 +1530,46 @@ clear_server_env(void)
     header_list_clear();
     buffer_list_clear();
     StringIOObject_list_clear();
+    gzip_list_clear();
+    greenlet_pool_clear();
+    channel_clear();
+    PyMem_Free(read_buf);
+    read_buf = NULL;
+    read_buf_size = 0;
 
     Py_DECREF(hub_switch_value);
     Py_DECREF(client_key);
     Py_DECREF(wsgi_input_key);
+    Py_DECREF(path_info_key);
     Py_DECREF(empty_string);
 }
 
 
-static inline int 
-inet_listen(void)
+static inline int
+inherit_listen_sock(void)
+{
+    char *fd_str;
+    fd_str = getenv(LISTEN_FD_ENV);
+    if(fd_str == NULL){
+        return 0;
+    }
+    listen_sock = atoi(fd_str);
+    unsetenv(LISTEN_FD_ENV);
+#ifdef DEBUG
+    printf("inherit listen socket fd:%d \n", listen_sock);
+#endif
+    return 1;
+}
+
+/*
+ * return a listening socket bound to name:port, -1 on error
+ */
+static inline int
+inet_bind(char *name, int port)
 {
     struct addrinfo hints, *servinfo, *p;
     int flag = 1;
-    int res;
+    int res, fd = -1;
     char strport[7];
 
     
@@ -955,33 +1578,33 @@ inet_listen(void)
     hints.ai_socktype = SOCK_STREAM;
     hints.ai_flags = AI_PASSIVE; 
     
-    snprintf(strport, sizeof (strport), "%d", server_port);
+    snprintf(strport, sizeof (strport), "%d", port);
     
-    if ((res = getaddrinfo(server_name, strport, &hints, &servinfo)) == -1) {
+    if ((res = getaddrinfo(name, strport, &hints, &servinfo)) == -1) {
         PyErr_SetFromErrno(PyExc_IOError);
         return -1;
     }
 
     // loop through all the results and bind to the first we can
     for(p = servinfo; p != NULL; p = p->ai_next) {
-        if ((listen_sock = socket(p->ai_family, p->ai_socktype,
+        if ((fd = socket(p->ai_family, p->ai_socktype,
                 p->ai_protocol)) == -1) {
             //perror("server: socket");
             continue;
         }
 
-        if (setsockopt(listen_sock, SOL_SOCKET, SO_REUSEADDR, &flag,
+        if (setsockopt(fd, SOL_SOCKET, SO_REUSEADDR, &flag,
                 sizeof(int)) == -1) {
-            close(listen_sock);
+            close(fd);
             PyErr_SetFromErrno(PyExc_IOError);
             return -1;
         }
 
         Py_BEGIN_ALLOW_THREADS
-        res = bind(listen_sock, p->ai_addr, p->ai_addrlen);
+        res = bind(fd, p->ai_addr, p->ai_addrlen);
         Py_END_ALLOW_THREADS
         if (res == -1) {
-            close(listen_sock);
+            close(fd);
             PyErr_SetFromErrno(PyExc_IOError);
             return -1;
         }
@@ -990,7 +1613,7 @@ inet_listen(void)
     }
 
     if (p == NULL)  {
-        close(listen_sock);
+        close(fd);
         PyErr_SetString(PyExc_IOError,"server: failed to bind\n");
         return -1;
     }
@@ -999,13 +1622,23 @@ inet_listen(void)
     
     // BACKLOG 
     Py_BEGIN_ALLOW_THREADS
-    res = listen(listen_sock, backlog);
+    res = listen(fd, backlog);
     Py_END_ALLOW_THREADS
     if (res == -1) {
-        close(listen_sock);
+        close(fd);
         PyErr_SetFromErrno(PyExc_IOError);
         return -1;
     }
+    return fd;
+}
+
+static inline int 
+inet_listen(void)
+{
+    listen_sock = inet_bind(server_name, server_port);
+    if(listen_sock == -1){
+        return -1;
+    }
     return 1;
 }
 
@@ -1086,6 +1719,29 @@ fast_notify(void)
     }
 }
 
+static inline void
+heartbeat(void)
+{
+    PyObject *watchdog_result;
+
+    cache_time_update();
+    if(current_mono_msec < next_heartbeat){
+        return;
+    }
+    next_heartbeat = current_mono_msec + heartbeat_interval;
+
+    if(watchdog){
+        watchdog_result = PyObject_CallFunction(watchdog, NULL);
+        if(PyErr_Occurred()){
+            PyErr_Print();
+            PyErr_Clear();
+        }
+        Py_XDECREF(watchdog_result);
+    }else if(tempfile_fd){
+        fast_notify();
+    }
+}
+
 static PyObject *
 meinheld_listen(PyObject *self, PyObject *args)
 {
@@ -1104,10 +1760,19 @@ meinheld_listen(PyObject *self, PyObject *args)
         //inet 
         if(!PyArg_ParseTuple(o, "si:listen", &server_name, &server_port))
             return NULL;
-        ret = inet_listen();
+        if(inherit_listen_sock()){
+            ret = 1;
+        }else{
+            ret = inet_listen();
+        }
     }else if(PyString_Check(o)){
         // unix domain 
-        ret = unix_listen(PyString_AS_STRING(o));
+        if(inherit_listen_sock()){
+            unix_sock_name = PyString_AS_STRING(o);
+            ret = 1;
+        }else{
+            ret = unix_listen(PyString_AS_STRING(o));
+        }
     }else{
         PyErr_SetString(PyExc_TypeError, "args tuple or string(path)");
         return NULL;
@@ -1117,7 +1782,82 @@ meinheld_listen(PyObject *self, PyObject *args)
         listen_sock = -1;
         return NULL;
     }
+    own_listen_sock = 1;
+
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+meinheld_serve_protocol(PyObject *self, PyObject *args)
+{
+    PyObject *handler_factory;
+    char *name;
+    int port, fd;
+
+    if (!PyArg_ParseTuple(args, "(si)O:serve_protocol", &name, &port, &handler_factory)){
+        return NULL;
+    }
+    if(!PyCallable_Check(handler_factory)){
+        PyErr_SetString(PyExc_TypeError, "handler_factory must be callable");
+        return NULL;
+    }
+    fd = inet_bind(name, port);
+    if(fd == -1){
+        return NULL;
+    }
+    if(fcntl(fd, F_SETFL, O_NONBLOCK) == -1 || protocol_add_server(fd, handler_factory) == -1){
+        if(!PyErr_Occurred()){
+            PyErr_SetFromErrno(PyExc_IOError);
+        }
+        close(fd);
+        return NULL;
+    }
+    if(loop_done && main_loop){
+        //running
+        protocol_start(main_loop);
+    }
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+meinheld_watch_fd(PyObject *self, PyObject *args)
+{
+    int fd, events;
+
+    if (!PyArg_ParseTuple(args, "ii:_watch_fd", &fd, &events)){
+        return NULL;
+    }
+    if(fd < 0){
+        PyErr_SetString(PyExc_ValueError, "fileno value out of range ");
+        return NULL;
+    }
+    if(events & ~PICOEV_READWRITE){
+        PyErr_SetString(PyExc_ValueError, "events value out of range ");
+        return NULL;
+    }
+    if(watcher_watch(loop_done ? main_loop : NULL, fd, events) == -1){
+        return NULL;
+    }
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+meinheld_is_running(PyObject *self, PyObject *args)
+{
+    return PyBool_FromLong(loop_done && main_loop);
+}
+
+static PyObject *
+meinheld_set_loop_hooks(PyObject *self, PyObject *args)
+{
+    PyObject *fd_callback, *tick;
 
+    if (!PyArg_ParseTuple(args, "OO:_set_loop_hooks", &fd_callback, &tick)){
+        return NULL;
+    }
+    if(watcher_set_hooks(fd_callback, tick) == -1){
+        return NULL;
+    }
     Py_RETURN_NONE;
 }
 
@@ -1130,6 +1870,28 @@ sigint_cb(int signum)
     loop_done = 0;
 }
 
+static void 
+sigterm_cb(int signum)
+{
+#ifdef DEBUG
+    printf("call SIGTERM");
+#endif
+    if(graceful_timeout > 0){
+        shutdown_requested = 1;
+    }else{
+        loop_done = 0;
+    }
+}
+
+static void 
+sigusr2_cb(int signum)
+{
+#ifdef DEBUG
+    printf("call SIGUSR2");
+#endif
+    reexec_requested = 1;
+}
+
 static void 
 sigpipe_cb(int signum)
 {
@@ -1190,16 +1952,28 @@ meinheld_error_log(PyObject *self, PyObject *args)
 static PyObject *
 meinheld_stop(PyObject *self, PyObject *args)
 {
-    loop_done = 0;
+    int timeout = 0;
+
+    if (!PyArg_ParseTuple(args, "|i:stop", &timeout))
+        return NULL;
+    if(timeout < 0){
+        PyErr_SetString(PyExc_ValueError, "timeout value out of range ");
+        return NULL;
+    }
+    if(timeout > 0 && main_loop && loop_done){
+        start_graceful_shutdown(timeout);
+    }else{
+        loop_done = 0;
+    }
     Py_RETURN_NONE;
 }
 
 static PyObject *
 meinheld_run_loop(PyObject *self, PyObject *args)
 {
-    int i = 0;
+    int max_wait_msec;
     //PyObject *app;
-    PyObject *watchdog_result;
+    time_t next_decay = time(NULL) + FREELIST_DECAY_SECS;
     if (!PyArg_ParseTuple(args, "O:run", &wsgi_app))
         return NULL; 
     
@@ -1217,32 +1991,62 @@ meinheld_run_loop(PyObject *self, PyObject *args)
     /* create loop */
     main_loop = picoev_create_loop(60);
     loop_done = 1;
+    draining = 0;
+    activecnt = 0;
+    inflight = 0;
     
     setsig(SIGPIPE, sigpipe_cb);
     setsig(SIGINT, sigint_cb);
-    setsig(SIGTERM, sigint_cb);
+    setsig(SIGTERM, sigterm_cb);
+    if(own_listen_sock){
+        // zero-downtime reload
+        setsig(SIGUSR2, sigusr2_cb);
+    }
 
     picoev_add(main_loop, listen_sock, PICOEV_READ, ACCEPT_TIMEOUT_SECS, accept_callback, NULL);
+    protocol_start(main_loop);
+    watcher_start(main_loop);
+    child_start(main_loop);
+
+    max_wait_msec = 10000;
+    if(watchdog || tempfile_fd){
+        //wake up for heartbeat
+        if(heartbeat_interval < max_wait_msec){
+            max_wait_msec = heartbeat_interval;
+        }
+    }
+    next_heartbeat = 0;
     
     /* loop */
     while (loop_done) {
         //Py_BEGIN_ALLOW_THREADS
-        picoev_loop_once(main_loop, 10);
+        picoev_loop_once_msec(main_loop, channel_pending() ? 0 : timer_wait_msec(watcher_wait_msec(max_wait_msec)));
         //Py_END_ALLOW_THREADS
-        i++;
-        // watchdog slow.... skip check
-        
-        //if(watchdog && i > 1){
-        if(watchdog){
-            watchdog_result = PyObject_CallFunction(watchdog, NULL);
-            if(PyErr_Occurred()){
-                PyErr_Print();
-                PyErr_Clear();
+        timer_run();
+        channel_dispatch(main_loop);
+        watcher_tick();
+        heartbeat();
+
+        if(reexec_requested){
+            reexec_requested = 0;
+            reexec_server();
+        }
+        if(shutdown_requested){
+            shutdown_requested = 0;
+            start_graceful_shutdown(graceful_timeout);
+        }
+        if(draining){
+            if(activecnt <= 0 || time(NULL) >= drain_deadline){
+#ifdef DEBUG
+                printf("graceful shutdown done active:%d \n", activecnt);
+#endif
+                loop_done = 0;
             }
-            Py_XDECREF(watchdog_result);
-            i = 0;
-        }else if(tempfile_fd){
-            fast_notify();
+        }
+        if(time(NULL) >= next_decay){
+            //shrink freelists to recent usage
+            freelist_decay_all();
+            next_decay = time(NULL) + FREELIST_DECAY_SECS;
         }
     }
 
@@ -1254,7 +2058,7 @@ meinheld_run_loop(PyObject *self, PyObject *args)
     
     clear_server_env();
 
-    if(unix_sock_name){
+    if(unix_sock_name && !reexeced){
         unlink(unix_sock_name);
     }
     printf("Bye.\n");
@@ -1308,142 +2112,483 @@ meinheld_get_backlog(PyObject *self, PyObject *args)
 }
 
 PyObject *
-meinheld_set_picoev_max_fd(PyObject *self, PyObject *args)
+meinheld_set_max_connections(PyObject *self, PyObject *args)
 {
     int temp;
     if (!PyArg_ParseTuple(args, "i", &temp))
         return NULL;
-    if(temp <= 0){
-        PyErr_SetString(PyExc_ValueError, "max_fd value out of range ");
+    if(temp < 0){
+        PyErr_SetString(PyExc_ValueError, "max_connections value out of range ");
         return NULL;
     }
-    max_fd = temp;
+    max_connections = temp;
     Py_RETURN_NONE;
 }
 
 PyObject *
-meinheld_get_picoev_max_fd(PyObject *self, PyObject *args)
+meinheld_get_max_connections(PyObject *self, PyObject *args)
 {
-    return Py_BuildValue("i", max_fd);
+    return Py_BuildValue("i", max_connections);
 }
 
 PyObject *
-meinheld_set_max_content_length(PyObject *self, PyObject *args)
+meinheld_set_max_requests(PyObject *self, PyObject *args)
 {
     int temp;
     if (!PyArg_ParseTuple(args, "i", &temp))
         return NULL;
-    if(temp <= 0){
-        PyErr_SetString(PyExc_ValueError, "max_content_length value out of range ");
+    if(temp < 0){
+        PyErr_SetString(PyExc_ValueError, "max_requests value out of range ");
         return NULL;
     }
-    max_content_length = temp;
+    max_requests = temp;
     Py_RETURN_NONE;
 }
 
 PyObject *
-meinheld_get_max_content_length(PyObject *self, PyObject *args)
+meinheld_get_max_requests(PyObject *self, PyObject *args)
 {
-    return Py_BuildValue("i", max_content_length);
+    return Py_BuildValue("i", max_requests);
 }
 
 PyObject *
-meinheld_set_client_body_buffer_size(PyObject *self, PyObject *args)
+meinheld_set_gzip_level(PyObject *self, PyObject *args)
 {
     int temp;
     if (!PyArg_ParseTuple(args, "i", &temp))
         return NULL;
-    if(temp <= 0){
-        PyErr_SetString(PyExc_ValueError, "client_body_buffer_size value out of range ");
+    if(temp < 0 || temp > 9){
+        PyErr_SetString(PyExc_ValueError, "gzip level value out of range ");
         return NULL;
     }
-    client_body_buffer_size = temp;
+    gzip_level = temp;
     Py_RETURN_NONE;
 }
 
 PyObject *
-meinheld_get_client_body_buffer_size(PyObject *self, PyObject *args)
+meinheld_get_gzip_level(PyObject *self, PyObject *args)
 {
-    return Py_BuildValue("i", client_body_buffer_size);
+    return Py_BuildValue("i", gzip_level);
 }
 
 PyObject *
-meinheld_set_listen_socket(PyObject *self, PyObject *args)
+meinheld_set_gzip_min_length(PyObject *self, PyObject *args)
 {
-    int temp_sock;
-    if (!PyArg_ParseTuple(args, "i:listen_socket", &temp_sock))
+    int temp;
+    if (!PyArg_ParseTuple(args, "i", &temp))
         return NULL;
-    if(listen_sock > 0){
-        PyErr_SetString(PyExc_Exception, "already set listen socket");
+    if(temp < 0){
+        PyErr_SetString(PyExc_ValueError, "gzip min length value out of range ");
         return NULL;
     }
-    listen_sock = temp_sock;
+    gzip_min_length = temp;
     Py_RETURN_NONE;
 }
 
 PyObject *
-meinheld_set_fastwatchdog(PyObject *self, PyObject *args)
+meinheld_get_gzip_min_length(PyObject *self, PyObject *args)
 {
-    int _fd;
-    int _ppid;
-    if (!PyArg_ParseTuple(args, "ii", &_fd, &_ppid))
-        return NULL;
-    
-    tempfile_fd = _fd;
-    ppid = _ppid;
-    Py_RETURN_NONE;
+    return Py_BuildValue("i", gzip_min_length);
 }
 
 PyObject *
-meinheld_set_watchdog(PyObject *self, PyObject *args)
+meinheld_set_precompressed(PyObject *self, PyObject *args)
 {
-    PyObject *temp;
-    if (!PyArg_ParseTuple(args, "O:watchdog", &temp))
+    int on;
+    if (!PyArg_ParseTuple(args, "i", &on))
         return NULL;
-    
-    if(!PyCallable_Check(temp)){
-        PyErr_SetString(PyExc_TypeError, "must be callable");
+    if(on < 0){
+        PyErr_SetString(PyExc_ValueError, "precompressed value out of range ");
         return NULL;
     }
-    watchdog = temp;
-    Py_INCREF(watchdog);
+    precompressed = on;
     Py_RETURN_NONE;
 }
 
 PyObject *
-meinheld_set_process_name(PyObject *self, PyObject *args)
+meinheld_get_precompressed(PyObject *self, PyObject *args)
 {
-#ifdef linux
-
-    int i = 0,argc,len;
-    char **argv;
-    char *name;
+    return Py_BuildValue("i", precompressed);
+}
 
-    if (!PyArg_ParseTuple(args, "s:process name", &name)){
+PyObject *
+meinheld_set_fast_path(PyObject *self, PyObject *args)
+{
+    int on;
+    if (!PyArg_ParseTuple(args, "i", &on))
+        return NULL;
+    if(on < 0){
+        PyErr_SetString(PyExc_ValueError, "fast_path value out of range ");
         return NULL;
     }
-
-    Py_GetArgcArgv(&argc, &argv);
-
-    for(i = 0;i < argc; i++){
-        len = strlen(argv[i]);
-        memset(argv[i], 0, len);
-    }
-
-    strcpy(*argv, name);
-    prctl(15, name, 0, 0, 0);
-#endif
-
+    fast_path = on;
     Py_RETURN_NONE;
 }
 
 PyObject *
-meinheld_suspend_client(PyObject *self, PyObject *args)
+meinheld_get_fast_path(PyObject *self, PyObject *args)
 {
-    PyObject *temp;
-    ClientObject *pyclient;
-    client_t *client;
-    PyGreenlet *parent;
+    return Py_BuildValue("i", fast_path);
+}
+
+PyObject *
+meinheld_set_greenlet_pool_size(PyObject *self, PyObject *args)
+{
+    int temp;
+    PyGreenlet **pool, *greenlet;
+
+    if (!PyArg_ParseTuple(args, "i", &temp))
+        return NULL;
+    if(temp < 0){
+        PyErr_SetString(PyExc_ValueError, "greenlet_pool_size value out of range ");
+        return NULL;
+    }
+    while(greenlet_pool_cnt > temp){
+        greenlet = greenlet_pool[--greenlet_pool_cnt];
+        greenlet_dropped++;
+        Py_DECREF(greenlet);
+    }
+    if(temp > 0){
+        pool = PyMem_Realloc(greenlet_pool, sizeof(PyGreenlet *) * temp);
+        if(pool == NULL){
+            return PyErr_NoMemory();
+        }
+        greenlet_pool = pool;
+    }else{
+        PyMem_Free(greenlet_pool);
+        greenlet_pool = NULL;
+    }
+    greenlet_pool_size = temp;
+    Py_RETURN_NONE;
+}
+
+PyObject *
+meinheld_get_greenlet_pool_size(PyObject *self, PyObject *args)
+{
+    return Py_BuildValue("i", greenlet_pool_size);
+}
+
+PyObject *
+meinheld_set_greenlet_max_stack(PyObject *self, PyObject *args)
+{
+    long temp;
+    if (!PyArg_ParseTuple(args, "l", &temp))
+        return NULL;
+    if(temp <= 0){
+        PyErr_SetString(PyExc_ValueError, "greenlet_max_stack value out of range ");
+        return NULL;
+    }
+    greenlet_max_stack = temp;
+    Py_RETURN_NONE;
+}
+
+PyObject *
+meinheld_get_greenlet_max_stack(PyObject *self, PyObject *args)
+{
+    return Py_BuildValue("l", greenlet_max_stack);
+}
+
+PyObject *
+meinheld_get_greenlet_pool_stats(PyObject *self, PyObject *args)
+{
+    return Py_BuildValue("{s:K,s:K,s:K,s:K,s:i,s:i}",
+            "created", (unsigned PY_LONG_LONG)greenlet_created,
+            "reused", (unsigned PY_LONG_LONG)greenlet_reused,
+            "discarded", (unsigned PY_LONG_LONG)greenlet_discarded,
+            "dropped", (unsigned PY_LONG_LONG)greenlet_dropped,
+            "parked", greenlet_pool_cnt,
+            "size", greenlet_pool_size);
+}
+
+PyObject *
+meinheld_set_channel_budget(PyObject *self, PyObject *args)
+{
+    int temp;
+    if (!PyArg_ParseTuple(args, "i", &temp))
+        return NULL;
+    if(temp <= 0){
+        PyErr_SetString(PyExc_ValueError, "channel_budget value out of range ");
+        return NULL;
+    }
+    channel_budget = temp;
+    Py_RETURN_NONE;
+}
+
+PyObject *
+meinheld_get_channel_budget(PyObject *self, PyObject *args)
+{
+    return Py_BuildValue("i", channel_budget);
+}
+
+PyObject *
+meinheld_set_send_queue_watermark(PyObject *self, PyObject *args)
+{
+    Py_ssize_t high, low;
+    if (!PyArg_ParseTuple(args, "nn", &high, &low))
+        return NULL;
+    if(high <= 0 || low < 0 || low > high){
+        PyErr_SetString(PyExc_ValueError, "watermark value out of range ");
+        return NULL;
+    }
+    send_queue_high = high;
+    send_queue_low = low;
+    Py_RETURN_NONE;
+}
+
+PyObject *
+meinheld_get_send_queue_watermark(PyObject *self, PyObject *args)
+{
+    return Py_BuildValue("(nn)", (Py_ssize_t)send_queue_high, (Py_ssize_t)send_queue_low);
+}
+
+PyObject *
+meinheld_set_cooperative_paths(PyObject *self, PyObject *args)
+{
+    PyObject *paths, *tuple, *item;
+    Py_ssize_t i;
+
+    if (!PyArg_ParseTuple(args, "O:set_cooperative_paths", &paths))
+        return NULL;
+    tuple = PySequence_Tuple(paths);
+    if(tuple == NULL){
+        return NULL;
+    }
+    for(i = 0; i < PyTuple_GET_SIZE(tuple); i++){
+        item = PyTuple_GET_ITEM(tuple, i);
+        if(!PyString_Check(item)){
+            Py_DECREF(tuple);
+            PyErr_SetString(PyExc_TypeError, "path prefix must be a string");
+            return NULL;
+        }
+    }
+    Py_XDECREF(cooperative_prefixes);
+    cooperative_prefixes = tuple;
+    Py_CLEAR(cooperative_paths);
+    Py_RETURN_NONE;
+}
+
+PyObject *
+meinheld_get_cooperative_paths(PyObject *self, PyObject *args)
+{
+    PyObject *learned, *res;
+
+    if(cooperative_paths){
+        learned = PyDict_Keys(cooperative_paths);
+    }else{
+        learned = PyList_New(0);
+    }
+    if(learned == NULL){
+        return NULL;
+    }
+    res = Py_BuildValue("(ON)", cooperative_prefixes ? cooperative_prefixes : Py_None, learned);
+    return res;
+}
+
+PyObject *
+meinheld_set_ssl(PyObject *self, PyObject *args)
+{
+    char *certfile, *keyfile, *ciphers = NULL;
+    if (!PyArg_ParseTuple(args, "ss|z:set_ssl", &certfile, &keyfile, &ciphers))
+        return NULL;
+    if(tls_setup(certfile, keyfile, ciphers) == -1){
+        return NULL;
+    }
+    Py_RETURN_NONE;
+}
+
+PyObject *
+meinheld_get_ssl(PyObject *self, PyObject *args)
+{
+    return Py_BuildValue("i", tls_enabled());
+}
+
+PyObject *
+meinheld_get_freelist_stats(PyObject *self, PyObject *args)
+{
+    return freelist_stats();
+}
+
+PyObject *
+meinheld_set_picoev_max_fd(PyObject *self, PyObject *args)
+{
+    int temp;
+    if (!PyArg_ParseTuple(args, "i", &temp))
+        return NULL;
+    if(temp <= 0){
+        PyErr_SetString(PyExc_ValueError, "max_fd value out of range ");
+        return NULL;
+    }
+    max_fd = temp;
+    Py_RETURN_NONE;
+}
+
+PyObject *
+meinheld_get_picoev_max_fd(PyObject *self, PyObject *args)
+{
+    return Py_BuildValue("i", max_fd);
+}
+
+PyObject *
+meinheld_set_max_content_length(PyObject *self, PyObject *args)
+{
+    int temp;
+    if (!PyArg_ParseTuple(args, "i", &temp))
+        return NULL;
+    if(temp <= 0){
+        PyErr_SetString(PyExc_ValueError, "max_content_length value out of range ");
+        return NULL;
+    }
+    max_content_length = temp;
+    Py_RETURN_NONE;
+}
+
+PyObject *
+meinheld_get_max_content_length(PyObject *self, PyObject *args)
+{
+    return Py_BuildValue("i", max_content_length);
+}
+
+PyObject *
+meinheld_set_client_body_buffer_size(PyObject *self, PyObject *args)
+{
+    int temp;
+    if (!PyArg_ParseTuple(args, "i", &temp))
+        return NULL;
+    if(temp <= 0){
+        PyErr_SetString(PyExc_ValueError, "client_body_buffer_size value out of range ");
+        return NULL;
+    }
+    client_body_buffer_size = temp;
+    Py_RETURN_NONE;
+}
+
+PyObject *
+meinheld_get_client_body_buffer_size(PyObject *self, PyObject *args)
+{
+    return Py_BuildValue("i", client_body_buffer_size);
+}
+
+PyObject *
+meinheld_set_graceful_timeout(PyObject *self, PyObject *args)
+{
+    int temp;
+    if (!PyArg_ParseTuple(args, "i", &temp))
+        return NULL;
+    if(temp < 0){
+        PyErr_SetString(PyExc_ValueError, "graceful_timeout value out of range ");
+        return NULL;
+    }
+    graceful_timeout = temp;
+    Py_RETURN_NONE;
+}
+
+PyObject *
+meinheld_get_graceful_timeout(PyObject *self, PyObject *args)
+{
+    return Py_BuildValue("i", graceful_timeout);
+}
+
+PyObject *
+meinheld_set_listen_socket(PyObject *self, PyObject *args)
+{
+    int temp_sock;
+    if (!PyArg_ParseTuple(args, "i:listen_socket", &temp_sock))
+        return NULL;
+    if(listen_sock > 0){
+        PyErr_SetString(PyExc_Exception, "already set listen socket");
+        return NULL;
+    }
+    listen_sock = temp_sock;
+    Py_RETURN_NONE;
+}
+
+PyObject *
+meinheld_set_fastwatchdog(PyObject *self, PyObject *args)
+{
+    int _fd;
+    int _ppid;
+    if (!PyArg_ParseTuple(args, "ii", &_fd, &_ppid))
+        return NULL;
+    
+    tempfile_fd = _fd;
+    ppid = _ppid;
+#ifdef linux
+    //notice parent death without polling
+    prctl(PR_SET_PDEATHSIG, SIGTERM, 0, 0, 0);
+#endif
+    Py_RETURN_NONE;
+}
+
+PyObject *
+meinheld_set_heartbeat_interval(PyObject *self, PyObject *args)
+{
+    int temp;
+    if (!PyArg_ParseTuple(args, "i", &temp))
+        return NULL;
+    if(temp <= 0){
+        PyErr_SetString(PyExc_ValueError, "heartbeat interval value out of range ");
+        return NULL;
+    }
+    heartbeat_interval = temp;
+    Py_RETURN_NONE;
+}
+
+PyObject *
+meinheld_get_heartbeat_interval(PyObject *self, PyObject *args)
+{
+    return Py_BuildValue("i", heartbeat_interval);
+}
+
+PyObject *
+meinheld_set_watchdog(PyObject *self, PyObject *args)
+{
+    PyObject *temp;
+    if (!PyArg_ParseTuple(args, "O:watchdog", &temp))
+        return NULL;
+    
+    if(!PyCallable_Check(temp)){
+        PyErr_SetString(PyExc_TypeError, "must be callable");
+        return NULL;
+    }
+    watchdog = temp;
+    Py_INCREF(watchdog);
+    Py_RETURN_NONE;
+}
+
+PyObject *
+meinheld_set_process_name(PyObject *self, PyObject *args)
+{
+#ifdef linux
+
+    int i = 0,argc,len;
+    char **argv;
+    char *name;
+
+    if (!PyArg_ParseTuple(args, "s:process name", &name)){
+        return NULL;
+    }
+
+    Py_GetArgcArgv(&argc, &argv);
+
+    for(i = 0;i < argc; i++){
+        len = strlen(argv[i]);
+        memset(argv[i], 0, len);
+    }
+
+    strcpy(*argv, name);
+    prctl(15, name, 0, 0, 0);
+#endif
+
+    Py_RETURN_NONE;
+}
+
+PyObject *
+meinheld_suspend_client(PyObject *self, PyObject *args)
+{
+    PyObject *temp;
+    ClientObject *pyclient;
+    client_t *client;
+    PyGreenlet *parent;
     int timeout = 0;
 
     if (!PyArg_ParseTuple(args, "O|i:_suspend_client", &temp, &timeout)){
@@ -1464,6 +2609,7 @@ meinheld_suspend_client(PyObject *self, PyObject *args)
     client = pyclient->client;
 
     if(!pyclient->greenlet){
+        mark_cooperative(client);
         PyErr_SetString(PyExc_ValueError, "greenlet is not set");
         return NULL;
     }
@@ -1582,11 +2728,42 @@ trampoline_switch_callback(picoev_loop* loop, int fd, int events, void* cb_arg)
     }
 }
 
+/*
+ * wait fd in the current app greenlet.
+ * a fast path request can't switch, it blocks the loop.
+ */
+inline int
+wait_fd(int fd, int event, int timeout)
+{
+    ClientObject *pyclient;
+    PyObject *res;
+
+    if(in_protocol()){
+        return protocol_wait(fd, event, timeout);
+    }
+    pyclient = (ClientObject *)current_client;
+    if(pyclient == NULL || pyclient->greenlet == NULL){
+        if(pyclient){
+            mark_cooperative(pyclient->client);
+        }
+        return wait_blocking(fd, event, timeout);
+    }
+
+    picoev_del(main_loop, fd);
+    picoev_add(main_loop, fd, event, timeout, trampoline_switch_callback, (void *)pyclient);
+
+    // switch to hub
+    res = switch_to_hub(pyclient);
+    if(res == NULL){
+        return -1;
+    }
+    Py_DECREF(res);
+    return 0;
+}
+
 static inline PyObject*
 meinheld_trampoline(PyObject *self, PyObject *args, PyObject *kwargs)
 {
-    PyGreenlet *current, *parent;
-    ClientObject *pyclient;
     int fd, event, timeout = 0;
     PyObject *read = Py_None, *write = Py_None;
 
@@ -1620,16 +2797,230 @@ meinheld_trampoline(PyObject *self, PyObject *args, PyObject *kwargs)
         }
     }
 
-    pyclient =(ClientObject *) current_client;
-    
-    picoev_del(main_loop, fd);
-    picoev_add(main_loop, fd, event, timeout, trampoline_switch_callback, (void *)pyclient);
-   
-    // switch to hub
-    current = pyclient->greenlet;
-    parent = PyGreenlet_GET_PARENT(current);
-    return PyGreenlet_Switch(parent, hub_switch_value, NULL);
+    if(wait_fd(fd, event, timeout) == -1){
+        return NULL;
+    }
+    Py_RETURN_NONE;
+}
+
+/*
+ * fds of a sequence to the array
+ */
+static inline int
+add_wait_fds(PyObject *list, int event, int *fds, int *events, int *cnt)
+{
+    PyObject *seq, *item;
+    Py_ssize_t i, len;
+    int fd;
+
+    seq = PySequence_Fast(list, "must be a sequence of fds");
+    if(seq == NULL){
+        return -1;
+    }
+    len = PySequence_Fast_GET_SIZE(seq);
+    for(i = 0; i < len; i++){
+        item = PySequence_Fast_GET_ITEM(seq, i);
+        fd = PyObject_AsFileDescriptor(item);
+        if(fd == -1){
+            Py_DECREF(seq);
+            return -1;
+        }
+        fds[*cnt] = fd;
+        events[*cnt] = event;
+        (*cnt)++;
+    }
+    Py_DECREF(seq);
+    return 0;
+}
+
+static inline PyObject*
+meinheld_wait_fds(PyObject *self, PyObject *args)
+{
+    PyObject *read_fds, *write_fds, *timeout = Py_None;
+    Py_ssize_t len;
+    int *fds = NULL, *events = NULL;
+    int cnt = 0, timeout_msec = -1, ret = -1;
+    double secs;
+
+    if (!PyArg_ParseTuple(args, "OO|O:wait_fds", &read_fds, &write_fds, &timeout)){
+        return NULL;
+    }
+    if(timeout != Py_None){
+        secs = PyFloat_AsDouble(timeout);
+        if(secs == -1.0 && PyErr_Occurred()){
+            return NULL;
+        }
+        if(secs < 0){
+            PyErr_SetString(PyExc_ValueError, "timeout value out of range ");
+            return NULL;
+        }
+        timeout_msec = secs > INT_MAX / 1000 ? INT_MAX : (int)(secs * 1000 + 0.999);
+    }
+    len = PySequence_Size(read_fds);
+    if(len == -1 || PySequence_Size(write_fds) == -1){
+        return NULL;
+    }
+    len += PySequence_Size(write_fds);
+    fds = (int *)PyMem_Malloc(sizeof(int) * (len ? len : 1));
+    events = (int *)PyMem_Malloc(sizeof(int) * (len ? len : 1));
+    if(fds == NULL || events == NULL){
+        PyErr_NoMemory();
+        goto done;
+    }
+    if(add_wait_fds(read_fds, PICOEV_READ, fds, events, &cnt) == -1 ||
+            add_wait_fds(write_fds, PICOEV_WRITE, fds, events, &cnt) == -1){
+        goto done;
+    }
+    ret = wait_fds(fds, events, cnt, timeout_msec);
+
+done:
+    PyMem_Free(fds);
+    PyMem_Free(events);
+    if(ret == -1){
+        return NULL;
+    }
+    return PyBool_FromLong(ret);
+}
+
+static inline PyObject*
+meinheld_sleep(PyObject *self, PyObject *args)
+{
+    double secs;
+    int msec;
+
+    if (!PyArg_ParseTuple(args, "d:sleep", &secs)){
+        return NULL;
+    }
+    if(secs < 0){
+        PyErr_SetString(PyExc_ValueError, "seconds value out of range ");
+        return NULL;
+    }
+    msec = secs > INT_MAX / 1000 ? INT_MAX : (int)(secs * 1000 + 0.999);
+    //no fds, wait for the timer
+    if(wait_fds(NULL, NULL, 0, msec) == -1){
+        return NULL;
+    }
+    Py_RETURN_NONE;
+}
+
+static inline PyObject*
+meinheld_waitpid(PyObject *self, PyObject *args)
+{
+    int pid, status = 0;
+    pid_t ret;
+
+    if (!PyArg_ParseTuple(args, "i:waitpid", &pid)){
+        return NULL;
+    }
+    if(pid <= 0){
+        PyErr_SetString(PyExc_ValueError, "pid value out of range ");
+        return NULL;
+    }
+    ret = wait_child(pid, &status);
+    if(ret == -1){
+        return NULL;
+    }
+    return Py_BuildValue("(ii)", (int)ret, status);
+}
 
+/*
+ * send 100 Continue and read the next part of the body of the running
+ * request. the app greenlet waits for the body like trampoline.
+ * return 0 or -1 with an error set.
+ */
+inline int
+read_pending_body(client_t *client)
+{
+    char *buf;
+    ssize_t r;
+    size_t nread, size;
+    PyObject *res;
+    ClientObject *pyclient;
+    PyGreenlet *parent;
+
+    if(client->expect_continue){
+        client->expect_continue = 0;
+        if(client->tls){
+            r = tls_write(client->tls, "HTTP/1.1 100 Continue\r\n\r\n", 25);
+        }else{
+            r = write(client->fd, "HTTP/1.1 100 Continue\r\n\r\n", 25);
+        }
+        if(r < 0){
+            goto io_error;
+        }
+    }
+
+    pyclient = (ClientObject *)PyDict_GetItem(client->environ, client_key);
+    while(client->body_pending){
+        buf = get_read_buffer(client, &size);
+        Py_BEGIN_ALLOW_THREADS
+        r = read_client(client, buf, size);
+        Py_END_ALLOW_THREADS
+        if(r == 0){
+            PyErr_SetString(PyExc_IOError, "connection closed");
+            goto error;
+        }else if(r < 0){
+            if(errno != EAGAIN && errno != EWOULDBLOCK){
+                goto io_error;
+            }
+            //wait body
+            if(pyclient->greenlet == NULL){
+                mark_cooperative(client);
+                if(wait_blocking(client->fd, PICOEV_READ, READ_TIMEOUT_SECS) == -1){
+                    goto error;
+                }
+                continue;
+            }
+            picoev_del(main_loop, client->fd);
+            picoev_add(main_loop, client->fd, PICOEV_READ, READ_TIMEOUT_SECS, trampoline_switch_callback, (void *)pyclient);
+            parent = PyGreenlet_GET_PARENT(pyclient->greenlet);
+            res = PyGreenlet_Switch(parent, hub_switch_value, NULL);
+            if(res == NULL){
+                goto error;
+            }
+            Py_DECREF(res);
+            continue;
+        }
+        nread = execute_parse(client, buf, r);
+        if(client->bad_request_code > 0){
+            PyErr_Format(PyExc_IOError, "bad request body (%d)", client->bad_request_code);
+            goto error;
+        }
+        if(client->body_pending && nread != r){
+            PyErr_SetString(PyExc_IOError, "bad request body");
+            goto error;
+        }
+        if(!client->body_pending && nread + 1 < r){
+            //pipelined data after the body
+            client->keep_alive = 0;
+        }
+        return 0;
+    }
+    return 0;
+io_error:
+    PyErr_SetFromErrno(PyExc_IOError);
+error:
+    client->body_pending = 0;
+    client->keep_alive = 0;
+    return -1;
+}
+
+/*
+ * read the whole body of the running request
+ */
+inline PyObject*
+read_continue_body(client_t *client)
+{
+    PyObject *input;
+
+    while(client->body_pending){
+        if(read_pending_body(client) == -1){
+            return NULL;
+        }
+    }
+    input = create_input(client);
+    PyDict_SetItem(client->environ, wsgi_input_key, input);
+    return input;
 }
 
 PyObject *
@@ -1644,6 +3035,9 @@ meinheld_get_ident(PyObject *self, PyObject *args)
             Py_INCREF(pyclient->greenlet);
             return (PyObject *)pyclient->greenlet;
         }
+        //fast path request
+        Py_INCREF(current_client);
+        return current_client;
     }
     Py_RETURN_NONE;
 }
@@ -1651,6 +3045,7 @@ meinheld_get_ident(PyObject *self, PyObject *args)
 
 static PyMethodDef WsMethods[] = {
     {"listen", meinheld_listen, METH_VARARGS, "set host and port num"},
+    {"serve_protocol", meinheld_serve_protocol, METH_VARARGS, "serve_protocol((host, port), handler_factory). handler_factory(stream, address) runs in a greenlet per connection"},
     {"access_log", meinheld_access_log, METH_VARARGS, "set access log file path."},
     {"error_log", meinheld_error_log, METH_VARARGS, "set error log file path."},
 
@@ -1665,23 +3060,60 @@ static PyMethodDef WsMethods[] = {
 
     {"set_backlog", meinheld_set_backlog, METH_VARARGS, "set backlog size"},
     {"get_backlog", meinheld_get_backlog, METH_VARARGS, "return backlog size"},
+    {"set_gzip_level", meinheld_set_gzip_level, METH_VARARGS, "set gzip response compression level, 0 is off (default 0)"},
+    {"get_gzip_level", meinheld_get_gzip_level, METH_VARARGS, "return gzip response compression level"},
+    {"set_gzip_min_length", meinheld_set_gzip_min_length, METH_VARARGS, "set minimum response body size to compress (default 1024)"},
+    {"get_gzip_min_length", meinheld_get_gzip_min_length, METH_VARARGS, "return minimum response body size to compress"},
+    {"set_precompressed", meinheld_set_precompressed, METH_VARARGS, "serve precompressed name.br/name.gz for file_wrapper if accepted"},
+    {"get_precompressed", meinheld_get_precompressed, METH_VARARGS, "return precompressed file support"},
+    {"set_fast_path", meinheld_set_fast_path, METH_VARARGS, "call the app without a greenlet, except cooperative paths (default 0). a fast path request that waits for io, sleeps or waits a child blocks the worker at most 1 sec, then raises server.timeout and its path runs in a greenlet from now on"},
+    {"get_fast_path", meinheld_get_fast_path, METH_VARARGS, "return fast path setting"},
+    {"set_cooperative_paths", meinheld_set_cooperative_paths, METH_VARARGS, "set PATH_INFO prefixes always run in a greenlet"},
+    {"get_cooperative_paths", meinheld_get_cooperative_paths, METH_VARARGS, "return (prefixes, learned paths) run in a greenlet"},
+    {"set_greenlet_pool_size", meinheld_set_greenlet_pool_size, METH_VARARGS, "set max parked greenlets reused by requests (0: disable, default 0)"},
+    {"get_greenlet_pool_size", meinheld_get_greenlet_pool_size, METH_VARARGS, "return greenlet pool size"},
+    {"set_greenlet_max_stack", meinheld_set_greenlet_max_stack, METH_VARARGS, "set saved stack bytes over which a greenlet is not pooled (default 65536)"},
+    {"get_greenlet_max_stack", meinheld_get_greenlet_max_stack, METH_VARARGS, "return greenlet max stack"},
+    {"get_greenlet_pool_stats", meinheld_get_greenlet_pool_stats, METH_VARARGS, "return greenlet pool statistics"},
+    {"set_channel_budget", meinheld_set_channel_budget, METH_VARARGS, "set max Channel waiters resumed per loop iteration (default 256)"},
+    {"get_channel_budget", meinheld_get_channel_budget, METH_VARARGS, "return channel budget"},
+    {"set_send_queue_watermark", meinheld_set_send_queue_watermark, METH_VARARGS, "set (high, low) bytes of the upgraded connection send queue. send() waits above high until low (default 65536, 16384)"},
+    {"get_send_queue_watermark", meinheld_get_send_queue_watermark, METH_VARARGS, "return send queue (high, low) watermark"},
+    {"set_ssl", meinheld_set_ssl, METH_VARARGS, "enable TLS. set certificate chain file, private key file (PEM) and ciphers"},
+    {"get_ssl", meinheld_get_ssl, METH_VARARGS, "return TLS enabled"},
+    {"get_freelist_stats", meinheld_get_freelist_stats, METH_VARARGS, "return freelist hit/miss statistics"},
+    {"set_max_connections", meinheld_set_max_connections, METH_VARARGS, "set max active connections (0: unlimited)"},
+    {"get_max_connections", meinheld_get_max_connections, METH_VARARGS, "return max active connections"},
+    {"set_max_requests", meinheld_set_max_requests, METH_VARARGS, "set max in-flight requests, exceeded requests get 503 (0: unlimited)"},
+    {"get_max_requests", meinheld_get_max_requests, METH_VARARGS, "return max in-flight requests"},
 
     {"set_picoev_max_fd", meinheld_set_picoev_max_fd, METH_VARARGS, "set picoev max fd size"},
     {"get_picoev_max_fd", meinheld_get_picoev_max_fd, METH_VARARGS, "return picoev max fd size"},
 
+    {"set_graceful_timeout", meinheld_set_graceful_timeout, METH_VARARGS, "set graceful shutdown timeout sec. default 0. (disable graceful shutdown)"},
+    {"get_graceful_timeout", meinheld_get_graceful_timeout, METH_VARARGS, "return graceful shutdown timeout"},
+
     {"set_process_name", meinheld_set_process_name, METH_VARARGS, "set process name"},
-    {"stop", meinheld_stop, METH_VARARGS, "stop main loop"},
+    {"stop", meinheld_stop, METH_VARARGS, "stop main loop. if timeout is set, stop accepting and wait for active connections"},
     // support gunicorn 
     {"set_listen_socket", meinheld_set_listen_socket, METH_VARARGS, "set listen_sock"},
     {"set_watchdog", meinheld_set_watchdog, METH_VARARGS, "set watchdog"},
     {"set_fastwatchdog", meinheld_set_fastwatchdog, METH_VARARGS, "set watchdog"},
+    {"set_heartbeat_interval", meinheld_set_heartbeat_interval, METH_VARARGS, "set watchdog heartbeat interval (msec)"},
+    {"get_heartbeat_interval", meinheld_get_heartbeat_interval, METH_VARARGS, "return watchdog heartbeat interval (msec)"},
     {"run", meinheld_run_loop, METH_VARARGS, "set wsgi app, run the main loop"},
     // greenlet and continuation
     {"_suspend_client", meinheld_suspend_client, METH_VARARGS, "resume client"},
     {"_resume_client", meinheld_resume_client, METH_VARARGS, "resume client"},
+    {"_watch_fd", meinheld_watch_fd, METH_VARARGS, "watch fd for events (1: read, 2: write, 0: stop)"},
+    {"_set_loop_hooks", meinheld_set_loop_hooks, METH_VARARGS, "set fd_callback(fd, events) and tick() of meinheld.eventloop"},
+    {"_is_running", meinheld_is_running, METH_NOARGS, "return True while server.run() drives the main loop"},
     // io
     {"cancel_wait", meinheld_cancel_wait, METH_VARARGS, "cancel wait"},
     {"trampoline", (PyCFunction)meinheld_trampoline, METH_VARARGS | METH_KEYWORDS, "trampoline"},
+    {"wait_fds", meinheld_wait_fds, METH_VARARGS, "wait_fds(read_fds, write_fds, timeout=None). wait for the first ready fd, return False on timeout"},
+    {"sleep", meinheld_sleep, METH_VARARGS, "sleep(seconds). park the greenlet on a loop timer"},
+    {"waitpid", meinheld_waitpid, METH_VARARGS, "waitpid(pid). wait for the child to exit, return (pid, status)"},
     {"get_ident", meinheld_get_ident, METH_VARARGS, "return thread ident "},
 
     {NULL, NULL, 0, NULL}        /* Sentinel */
@@ -1708,6 +3140,28 @@ initserver(void)
         return;
     }
 
+    if(PyType_Ready(&InputObjectType) < 0){
+        return;
+    }
+
+    if(PyType_Ready(&ChannelObjectType) < 0){
+        return;
+    }
+    Py_INCREF(&ChannelObjectType);
+    PyModule_AddObject(m, "Channel", (PyObject *)&ChannelObjectType);
+
+    if(PyType_Ready(&StreamObjectType) < 0){
+        return;
+    }
+    Py_INCREF(&StreamObjectType);
+    PyModule_AddObject(m, "Stream", (PyObject *)&StreamObjectType);
+
+    if(PyType_Ready(&ResponseParserObjectType) < 0){
+        return;
+    }
+    Py_INCREF(&ResponseParserObjectType);
+    PyModule_AddObject(m, "ResponseParser", (PyObject *)&ResponseParserObjectType);
+
     timeout_error = PyErr_NewException("meinheld.server.timeout",
 					  PyExc_IOError, NULL);
 	if (timeout_error == NULL)
@@ -33,9 +33,16 @@
 
 #define SERVER "meinheld/0.4.13"
 
+// the longest wait of a request without a greenlet, it blocks the loop
+#define BLOCKING_WAIT_MSEC 1000
+
 
 extern int max_content_length;      //max_content_length
 extern int client_body_buffer_size; //client_body_buffer_size
+extern int draining; //graceful shutdown in progress
+extern int gzip_level;      //gzip compression level (0: off)
+extern int gzip_min_length; //minimum body size to compress
+extern int precompressed;   //serve name.gz/name.br for file_wrapper
 
 extern picoev_loop* main_loop; //main loop
 
@@ -47,4 +54,7 @@ extern PyObject* timeout_error;
 inline void
 switch_wsgi_app(picoev_loop* loop, int fd, PyObject *obj);
 
+inline void
+resume_app(PyObject *obj);
+
 #endif
@@ -0,0 +1,417 @@
+#include "stream.h"
+#include "structmember.h"
+#include <sys/uio.h>
+
+/*
+ * detached connection.
+ * owns the client fd (and TLS session), reads and writes wait for
+ * the fd on the loop in the app greenlet like trampoline.
+ */
+
+#define STREAM_IOV_SIZE 64
+
+static inline int
+check_stream_closed(StreamObject *self)
+{
+    if(self->fd < 0){
+        PyErr_SetString(PyExc_IOError, "stream closed");
+        return 1;
+    }
+    return 0;
+}
+
+static inline int
+wait_io(StreamObject *self, int event)
+{
+    if(self->tls){
+        //handshake or renegotiation may want the other side
+        event = tls_want_write(self->tls) ? PICOEV_WRITE : PICOEV_READ;
+    }
+    if(wait_fd(self->fd, event, self->timeout) == -1){
+        return -1;
+    }
+    //closed while waiting
+    return check_stream_closed(self) ? -1 : 0;
+}
+
+static inline Py_ssize_t
+read_buffered(StreamObject *self, char *buf, Py_ssize_t len)
+{
+    Py_ssize_t remain;
+
+    remain = PyString_GET_SIZE(self->buffer) - self->buf_pos;
+    if(len > remain){
+        len = remain;
+    }
+    memcpy(buf, PyString_AS_STRING(self->buffer) + self->buf_pos, len);
+    self->buf_pos += len;
+    if(self->buf_pos >= PyString_GET_SIZE(self->buffer)){
+        Py_CLEAR(self->buffer);
+        self->buf_pos = 0;
+    }
+    return len;
+}
+
+/*
+ * read(2) semantics, wait while EAGAIN
+ */
+static inline Py_ssize_t
+stream_read(StreamObject *self, char *buf, Py_ssize_t len)
+{
+    ssize_t r;
+
+    if(self->buffer){
+        return read_buffered(self, buf, len);
+    }
+    while(1){
+        Py_BEGIN_ALLOW_THREADS
+        if(self->tls){
+            r = tls_read(self->tls, buf, len);
+        }else{
+            r = read(self->fd, buf, len);
+        }
+        Py_END_ALLOW_THREADS
+#ifdef DEBUG
+        printf("stream_read fd:%d read:%d \n", self->fd, (int)r);
+#endif
+        if(r >= 0){
+            return r;
+        }
+        if(errno != EAGAIN && errno != EWOULDBLOCK && errno != EINTR){
+            PyErr_SetFromErrno(PyExc_IOError);
+            return -1;
+        }
+        if(errno != EINTR && wait_io(self, PICOEV_READ) == -1){
+            return -1;
+        }
+    }
+}
+
+/*
+ * writev(2) semantics, wait while EAGAIN
+ */
+static inline Py_ssize_t
+stream_write(StreamObject *self, struct iovec *iov, int cnt)
+{
+    ssize_t w;
+
+    while(1){
+        Py_BEGIN_ALLOW_THREADS
+        if(self->tls){
+            w = tls_writev(self->tls, iov, cnt);
+        }else{
+            w = writev(self->fd, iov, cnt);
+        }
+        Py_END_ALLOW_THREADS
+#ifdef DEBUG
+        printf("stream_write fd:%d write:%d \n", self->fd, (int)w);
+#endif
+        if(w >= 0){
+            return w;
+        }
+        if(errno != EAGAIN && errno != EWOULDBLOCK && errno != EINTR){
+            PyErr_SetFromErrno(PyExc_IOError);
+            return -1;
+        }
+        if(errno != EINTR && wait_io(self, PICOEV_WRITE) == -1){
+            return -1;
+        }
+    }
+}
+
+static inline int
+stream_write_all(StreamObject *self, struct iovec *iov, int cnt)
+{
+    Py_ssize_t w;
+
+    while(cnt > 0){
+        w = stream_write(self, iov, cnt < STREAM_IOV_SIZE ? cnt : STREAM_IOV_SIZE);
+        if(w < 0){
+            return -1;
+        }
+        while(cnt > 0 && (size_t)w >= iov->iov_len){
+            w -= iov->iov_len;
+            iov++;
+            cnt--;
+        }
+        if(cnt > 0){
+            iov->iov_base = (char *)iov->iov_base + w;
+            iov->iov_len -= w;
+        }
+    }
+    return 0;
+}
+
+static inline void
+stream_close(StreamObject *self)
+{
+    if(self->fd < 0){
+        return;
+    }
+#ifdef DEBUG
+    printf("stream_close fd:%d \n", self->fd);
+#endif
+    if(main_loop && picoev_is_active(main_loop, self->fd)){
+        picoev_del(main_loop, self->fd);
+    }
+    if(self->tls){
+        tls_free(self->tls, 1);
+        self->tls = NULL;
+    }
+    close(self->fd);
+    self->fd = -1;
+    Py_CLEAR(self->buffer);
+}
+
+inline PyObject*
+StreamObject_New(int fd, void *tls, PyObject *buffer)
+{
+    StreamObject *self;
+
+    self = PyObject_NEW(StreamObject, &StreamObjectType);
+    if(self == NULL){
+        return NULL;
+    }
+    self->fd = fd;
+    self->tls = tls;
+    self->buffer = NULL;
+    self->buf_pos = 0;
+    self->timeout = 0;
+    if(buffer && PyString_Check(buffer) && PyString_GET_SIZE(buffer) > 0){
+        Py_INCREF(buffer);
+        self->buffer = buffer;
+    }
+    return (PyObject *)self;
+}
+
+static void
+StreamObject_dealloc(StreamObject *self)
+{
+    stream_close(self);
+    PyObject_DEL(self);
+}
+
+static PyObject *
+StreamObject_fileno(StreamObject *self, PyObject *args)
+{
+    return Py_BuildValue("i", self->fd);
+}
+
+static PyObject *
+StreamObject_recv(StreamObject *self, PyObject *args)
+{
+    PyObject *buf;
+    Py_ssize_t size, r;
+
+    if(!PyArg_ParseTuple(args, "n:recv", &size)){
+        return NULL;
+    }
+    if(size < 0){
+        PyErr_SetString(PyExc_ValueError, "bufsize value out of range ");
+        return NULL;
+    }
+    if(check_stream_closed(self)){
+        return NULL;
+    }
+    buf = PyString_FromStringAndSize(NULL, size);
+    if(buf == NULL){
+        return NULL;
+    }
+    r = stream_read(self, PyString_AS_STRING(buf), size);
+    if(r < 0){
+        Py_DECREF(buf);
+        return NULL;
+    }
+    if(r != size){
+        _PyString_Resize(&buf, r);
+    }
+    return buf;
+}
+
+static PyObject *
+StreamObject_recv_into(StreamObject *self, PyObject *args)
+{
+    Py_buffer view;
+    Py_ssize_t size = 0, r;
+
+    if(!PyArg_ParseTuple(args, "w*|n:recv_into", &view, &size)){
+        return NULL;
+    }
+    if(size < 0 || size > view.len){
+        PyBuffer_Release(&view);
+        PyErr_SetString(PyExc_ValueError, "nbytes value out of range ");
+        return NULL;
+    }
+    if(check_stream_closed(self)){
+        PyBuffer_Release(&view);
+        return NULL;
+    }
+    if(size == 0){
+        size = view.len;
+    }
+    r = stream_read(self, view.buf, size);
+    PyBuffer_Release(&view);
+    if(r < 0){
+        return NULL;
+    }
+    return Py_BuildValue("n", r);
+}
+
+static PyObject *
+StreamObject_send(StreamObject *self, PyObject *args)
+{
+    Py_buffer view;
+    struct iovec iov;
+    Py_ssize_t w;
+
+    if(!PyArg_ParseTuple(args, "s*:send", &view)){
+        return NULL;
+    }
+    if(check_stream_closed(self)){
+        PyBuffer_Release(&view);
+        return NULL;
+    }
+    iov.iov_base = view.buf;
+    iov.iov_len = view.len;
+    w = stream_write(self, &iov, 1);
+    PyBuffer_Release(&view);
+    if(w < 0){
+        return NULL;
+    }
+    return Py_BuildValue("n", w);
+}
+
+static PyObject *
+StreamObject_sendall(StreamObject *self, PyObject *args)
+{
+    Py_buffer view;
+    struct iovec iov;
+    int ret;
+
+    if(!PyArg_ParseTuple(args, "s*:sendall", &view)){
+        return NULL;
+    }
+    if(check_stream_closed(self)){
+        PyBuffer_Release(&view);
+        return NULL;
+    }
+    iov.iov_base = view.buf;
+    iov.iov_len = view.len;
+    ret = stream_write_all(self, &iov, 1);
+    PyBuffer_Release(&view);
+    if(ret == -1){
+        return NULL;
+    }
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+StreamObject_writev(StreamObject *self, PyObject *args)
+{
+    PyObject *data, *seq, *item;
+    struct iovec *iov;
+    Py_ssize_t i, cnt, total = 0;
+    int ret;
+
+    if(!PyArg_ParseTuple(args, "O:writev", &data)){
+        return NULL;
+    }
+    if(check_stream_closed(self)){
+        return NULL;
+    }
+    seq = PySequence_Fast(data, "must be a sequence of strings");
+    if(seq == NULL){
+        return NULL;
+    }
+    cnt = PySequence_Fast_GET_SIZE(seq);
+    iov = (struct iovec *)PyMem_Malloc(sizeof(struct iovec) * (cnt ? cnt : 1));
+    if(iov == NULL){
+        Py_DECREF(seq);
+        return PyErr_NoMemory();
+    }
+    for(i = 0; i < cnt; i++){
+        item = PySequence_Fast_GET_ITEM(seq, i);
+        if(!PyString_Check(item)){
+            PyMem_Free(iov);
+            Py_DECREF(seq);
+            PyErr_SetString(PyExc_TypeError, "must be a sequence of strings");
+            return NULL;
+        }
+        iov[i].iov_base = PyString_AS_STRING(item);
+        iov[i].iov_len = PyString_GET_SIZE(item);
+        total += PyString_GET_SIZE(item);
+    }
+    //seq keeps the strings alive while waiting
+    ret = stream_write_all(self, iov, (int)cnt);
+    PyMem_Free(iov);
+    Py_DECREF(seq);
+    if(ret == -1){
+        return NULL;
+    }
+    return Py_BuildValue("n", total);
+}
+
+static PyObject *
+StreamObject_close(StreamObject *self, PyObject *args)
+{
+    stream_close(self);
+    Py_RETURN_NONE;
+}
+
+static struct PyMethodDef StreamObject_methods[] = {
+  {"fileno",	(PyCFunction)StreamObject_fileno, METH_NOARGS, "return the fd, -1 if closed"},
+  {"recv",	(PyCFunction)StreamObject_recv, METH_VARARGS, "read up to bufsize bytes. return '' at EOF"},
+  {"recv_into",	(PyCFunction)StreamObject_recv_into, METH_VARARGS, "read up to nbytes into a writable buffer. return the number of bytes"},
+  {"send",	(PyCFunction)StreamObject_send, METH_VARARGS, "write data. return the number of bytes sent"},
+  {"sendall",	(PyCFunction)StreamObject_sendall, METH_VARARGS, "write all data"},
+  {"writev",	(PyCFunction)StreamObject_writev, METH_VARARGS, "write all strings of a sequence with writev. return the number of bytes"},
+  {"close",	(PyCFunction)StreamObject_close, METH_NOARGS, "close the connection"},
+  {NULL,	NULL}
+};
+
+static PyMemberDef StreamObject_members[] = {
+    {"timeout", T_INT, offsetof(StreamObject, timeout), 0, "io timeout secs (0: no timeout)"},
+    {NULL}
+};
+
+PyTypeObject StreamObjectType = {
+	PyObject_HEAD_INIT(&PyType_Type)
+    0,
+    "meinheld.server.Stream",             /*tp_name*/
+    sizeof(StreamObject), /*tp_basicsize*/
+    0,                         /*tp_itemsize*/
+    (destructor)StreamObject_dealloc, /*tp_dealloc*/
+    0,                         /*tp_print*/
+    0,                         /*tp_getattr*/
+    0,                         /*tp_setattr*/
+    0,                         /*tp_compare*/
+    0,                         /*tp_repr*/
+    0,                         /*tp_as_number*/
+    0,                         /*tp_as_sequence*/
+    0,                         /*tp_as_mapping*/
+    0,                         /*tp_hash */
+    0,                         /*tp_call*/
+    0,                         /*tp_str*/
+    0,                         /*tp_getattro*/
+    0,                         /*tp_setattro*/
+    0,                         /*tp_as_buffer*/
+    Py_TPFLAGS_DEFAULT,        /*tp_flags*/
+    "detached connection",      /* tp_doc */
+    0,		               /* tp_traverse */
+    0,		               /* tp_clear */
+    0,		               /* tp_richcompare */
+    0,		               /* tp_weaklistoffset */
+    0,		               /* tp_iter */
+    0,		               /* tp_iternext */
+    StreamObject_methods,        /* tp_methods */
+    StreamObject_members,        /* tp_members */
+    0,                         /* tp_getset */
+    0,                         /* tp_base */
+    0,                         /* tp_dict */
+    0,                         /* tp_descr_get */
+    0,                         /* tp_descr_set */
+    0,                         /* tp_dictoffset */
+    0,                      /* tp_init */
+    0,                         /* tp_alloc */
+    0,                           /* tp_new */
+};
@@ -0,0 +1,22 @@
+#ifndef STREAM_H
+#define STREAM_H
+
+#include <Python.h>
+#include "server.h"
+#include "client.h"
+
+typedef struct {
+    PyObject_HEAD
+    int fd;
+    void *tls;              // TLS session of the connection
+    PyObject *buffer;       // bytes read before the detach
+    Py_ssize_t buf_pos;
+    int timeout;            // io timeout secs (0: no timeout)
+} StreamObject;
+
+extern PyTypeObject StreamObjectType;
+
+inline PyObject*
+StreamObject_New(int fd, void *tls, PyObject *buffer);
+
+#endif
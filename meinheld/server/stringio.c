@@ -1,37 +1,41 @@
 #include "stringio.h"
 
-#define IO_MAXFREELIST 1024
+#define IO_MINFREELIST 256
+#define IO_MAXFREELIST 1024 * 16
 
-static StringIOObject *io_free_list[IO_MAXFREELIST];
-static int io_numfree = 0;
+static freelist io_free_list;
+
+static void *
+new_StringIOObject(void)
+{
+    return PyObject_NEW(StringIOObject, &StringIOObjectType);
+}
+
+static void
+del_StringIOObject(void *op)
+{
+    PyObject_DEL(op);
+}
 
 inline void
 StringIOObject_list_fill(void)
 {
-    StringIOObject *io;
-	while (io_numfree < IO_MAXFREELIST) {
-        io = PyObject_NEW(StringIOObject, &StringIOObjectType);
-		io_free_list[io_numfree++] = io;
-	}
+    freelist_init(&io_free_list, "StringIOObject", IO_MINFREELIST, IO_MAXFREELIST, new_StringIOObject, del_StringIOObject);
+    freelist_fill(&io_free_list);
 }
 
 inline void
 StringIOObject_list_clear(void)
 {
-	StringIOObject *op;
-
-	while (io_numfree) {
-		op = io_free_list[--io_numfree];
-        PyObject_DEL(op);
-	}
+    freelist_clear(&io_free_list);
 }
 
 static inline StringIOObject*
 alloc_StringIOObject(void)
 {
     StringIOObject *io;
-	if (io_numfree) {
-		io = io_free_list[--io_numfree];
+    io = (StringIOObject *)freelist_pop(&io_free_list);
+	if (io) {
 		_Py_NewReference((PyObject *)io);
 #ifdef DEBUG
         printf("use pooled StringIOObject %p\n", io);
@@ -52,11 +56,10 @@ dealloc_StringIOObject(StringIOObject *io)
         free_buffer(io->buffer);
         io->buffer = NULL;
     }
-	if (io_numfree < IO_MAXFREELIST){
+	if (freelist_push(&io_free_list, io)){
 #ifdef DEBUG
         printf("back to StringIOObject pool %p\n", io);
 #endif
-		io_free_list[io_numfree++] = io;
     }else{
 	    PyObject_DEL(io);
     }
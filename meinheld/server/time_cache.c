@@ -18,6 +18,7 @@ static uintptr_t        slot;
 //static uint32_t         time_lock = 1;
 
 volatile uintptr_t      current_msec;
+volatile uintptr_t      current_mono_msec;  // monotonic clock
 volatile cache_time_t     *_cached_time;
 volatile char       *err_log_time;
 volatile char       *http_time;
@@ -56,8 +57,11 @@ cache_time_update(void)
     char          *p0, *p1, *p2;
     cache_time_t      *tp;
     struct timeval   tv;
+    struct timespec  ts;
     
     gettimeofday(&tv, NULL);
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    current_mono_msec = (uintptr_t) ts.tv_sec * 1000 + ts.tv_nsec / 1000000;
 
     sec = tv.tv_sec;
     msec = tv.tv_usec / 1000;
@@ -0,0 +1,190 @@
+#include "timer.h"
+#include "time_cache.h"
+
+/*
+ * msec timers of the main loop (binary heap ordered by when, seq).
+ * a cancelled timer stays in the heap until it expires or the heap
+ * is compacted.
+ */
+
+#define TIMER_INIT_SIZE 64
+
+static loop_timer **heap = NULL;
+static int heap_size = 0;
+static int heap_cnt = 0;
+static int cancelled_cnt = 0;
+static uint64_t timer_seq = 0;
+
+static inline int
+timer_less(loop_timer *a, loop_timer *b)
+{
+    if(a->when != b->when){
+        return a->when < b->when;
+    }
+    return a->seq < b->seq;
+}
+
+static inline void
+sift_up(int i)
+{
+    loop_timer *t = heap[i];
+    int parent;
+
+    while(i > 0){
+        parent = (i - 1) / 2;
+        if(!timer_less(t, heap[parent])){
+            break;
+        }
+        heap[i] = heap[parent];
+        i = parent;
+    }
+    heap[i] = t;
+}
+
+static inline void
+sift_down(int i)
+{
+    loop_timer *t = heap[i];
+    int child;
+
+    while((child = i * 2 + 1) < heap_cnt){
+        if(child + 1 < heap_cnt && timer_less(heap[child + 1], heap[child])){
+            child++;
+        }
+        if(!timer_less(heap[child], t)){
+            break;
+        }
+        heap[i] = heap[child];
+        i = child;
+    }
+    heap[i] = t;
+}
+
+static inline loop_timer*
+pop_timer(void)
+{
+    loop_timer *t = heap[0];
+
+    heap_cnt--;
+    if(heap_cnt > 0){
+        heap[0] = heap[heap_cnt];
+        sift_down(0);
+    }
+    return t;
+}
+
+/*
+ * drop cancelled timers when they are the majority
+ */
+static inline void
+compact(void)
+{
+    int i, cnt = 0;
+
+    for(i = 0; i < heap_cnt; i++){
+        if(heap[i]->callback){
+            heap[cnt++] = heap[i];
+        }else{
+            PyMem_Free(heap[i]);
+        }
+    }
+    heap_cnt = cnt;
+    cancelled_cnt = 0;
+    for(i = heap_cnt / 2 - 1; i >= 0; i--){
+        sift_down(i);
+    }
+}
+
+inline loop_timer*
+timer_add(int msec, timer_callback callback, void *arg)
+{
+    loop_timer *t, **new_heap;
+    int size;
+
+    if(heap_cnt == heap_size){
+        size = heap_size ? heap_size * 2 : TIMER_INIT_SIZE;
+        new_heap = (loop_timer **)PyMem_Realloc(heap, sizeof(loop_timer *) * size);
+        if(new_heap == NULL){
+            PyErr_NoMemory();
+            return NULL;
+        }
+        heap = new_heap;
+        heap_size = size;
+    }
+    t = (loop_timer *)PyMem_Malloc(sizeof(loop_timer));
+    if(t == NULL){
+        PyErr_NoMemory();
+        return NULL;
+    }
+    cache_time_update();
+    t->when = current_mono_msec + (msec > 0 ? msec : 0);
+    t->seq = timer_seq++;
+    t->callback = callback;
+    t->arg = arg;
+    heap[heap_cnt] = t;
+    sift_up(heap_cnt++);
+    return t;
+}
+
+inline void
+timer_cancel(loop_timer *timer)
+{
+    if(timer->callback == NULL){
+        return;
+    }
+    timer->callback = NULL;
+    timer->arg = NULL;
+    cancelled_cnt++;
+    if(cancelled_cnt > TIMER_INIT_SIZE && cancelled_cnt * 2 > heap_cnt){
+        compact();
+    }
+}
+
+inline int
+timer_wait_msec(int max_wait_msec)
+{
+    uintptr_t wait;
+
+    while(heap_cnt > 0 && heap[0]->callback == NULL){
+        PyMem_Free(pop_timer());
+        cancelled_cnt--;
+    }
+    if(heap_cnt == 0){
+        return max_wait_msec;
+    }
+    cache_time_update();
+    if(heap[0]->when <= current_mono_msec){
+        return 0;
+    }
+    wait = heap[0]->when - current_mono_msec;
+    return wait < (uintptr_t)max_wait_msec ? (int)wait : max_wait_msec;
+}
+
+/*
+ * call the expired timers. a callback may add timers
+ */
+inline void
+timer_run(void)
+{
+    loop_timer *t;
+    timer_callback callback;
+    uintptr_t now;
+
+    if(heap_cnt == 0){
+        return;
+    }
+    cache_time_update();
+    now = current_mono_msec;
+    while(heap_cnt > 0 && heap[0]->when <= now){
+        t = pop_timer();
+        callback = t->callback;
+        if(callback){
+            //timer_cancel in the callback is a no-op
+            t->callback = NULL;
+            callback(t->arg);
+        }else{
+            cancelled_cnt--;
+        }
+        PyMem_Free(t);
+    }
+}
@@ -0,0 +1,28 @@
+#ifndef TIMER_H
+#define TIMER_H
+
+#include <Python.h>
+#include "server.h"
+
+typedef void (*timer_callback)(void *arg);
+
+typedef struct {
+    uintptr_t when;         // monotonic msec
+    uint64_t seq;
+    timer_callback callback; // NULL if cancelled
+    void *arg;
+} loop_timer;
+
+inline loop_timer*
+timer_add(int msec, timer_callback callback, void *arg);
+
+inline void
+timer_cancel(loop_timer *timer);
+
+inline int
+timer_wait_msec(int max_wait_msec);
+
+inline void
+timer_run(void);
+
+#endif
@@ -0,0 +1,310 @@
+#include "tls.h"
+
+#include <errno.h>
+
+#ifdef WITH_SSL
+
+#include <openssl/ssl.h>
+#include <openssl/err.h>
+
+#define TLS_SESSION_CACHE_SIZE 1024 * 20
+#define TLS_SESSION_TIMEOUT 300
+
+static SSL_CTX *ssl_ctx = NULL;
+
+static const unsigned char alpn_http11[] = "\x08http/1.1";
+
+static inline void
+set_ssl_error(void)
+{
+    unsigned long e = ERR_get_error();
+    char msg[256];
+
+    if(e){
+        ERR_error_string_n(e, msg, sizeof(msg));
+        PyErr_SetString(PyExc_IOError, msg);
+    }else{
+        PyErr_SetString(PyExc_IOError, "ssl error");
+    }
+    ERR_clear_error();
+}
+
+#if OPENSSL_VERSION_NUMBER >= 0x10002000L
+static int
+alpn_select_cb(SSL *ssl, const unsigned char **out, unsigned char *outlen,
+        const unsigned char *in, unsigned int inlen, void *arg)
+{
+    //only speak http/1.1
+    if(SSL_select_next_proto((unsigned char **)out, outlen, alpn_http11, sizeof(alpn_http11) - 1,
+                in, inlen) != OPENSSL_NPN_NEGOTIATED){
+        return SSL_TLSEXT_ERR_NOACK;
+    }
+    return SSL_TLSEXT_ERR_OK;
+}
+#endif
+
+inline int
+tls_setup(char *certfile, char *keyfile, char *ciphers)
+{
+    SSL_CTX *ctx;
+
+#if OPENSSL_VERSION_NUMBER >= 0x10100000L
+    ctx = SSL_CTX_new(TLS_server_method());
+#else
+    SSL_library_init();
+    SSL_load_error_strings();
+    ctx = SSL_CTX_new(SSLv23_server_method());
+#endif
+    if(ctx == NULL){
+        set_ssl_error();
+        return -1;
+    }
+    SSL_CTX_set_options(ctx, SSL_OP_NO_SSLv2 | SSL_OP_NO_SSLv3 | SSL_OP_NO_COMPRESSION |
+            SSL_OP_CIPHER_SERVER_PREFERENCE);
+    //writev_bucket retries from the moved iov base
+    SSL_CTX_set_mode(ctx, SSL_MODE_ENABLE_PARTIAL_WRITE | SSL_MODE_ACCEPT_MOVING_WRITE_BUFFER);
+#ifdef SSL_MODE_RELEASE_BUFFERS
+    SSL_CTX_set_mode(ctx, SSL_MODE_RELEASE_BUFFERS);
+#endif
+
+    if(SSL_CTX_use_certificate_chain_file(ctx, certfile) != 1){
+        goto error;
+    }
+    if(SSL_CTX_use_PrivateKey_file(ctx, keyfile, SSL_FILETYPE_PEM) != 1){
+        goto error;
+    }
+    if(SSL_CTX_check_private_key(ctx) != 1){
+        goto error;
+    }
+    if(ciphers && SSL_CTX_set_cipher_list(ctx, ciphers) != 1){
+        goto error;
+    }
+
+    //resumption, session cache and tickets (enabled by default)
+    SSL_CTX_set_session_cache_mode(ctx, SSL_SESS_CACHE_SERVER);
+    SSL_CTX_set_session_id_context(ctx, (const unsigned char *)"meinheld", 8);
+    SSL_CTX_sess_set_cache_size(ctx, TLS_SESSION_CACHE_SIZE);
+    SSL_CTX_set_timeout(ctx, TLS_SESSION_TIMEOUT);
+
+#if OPENSSL_VERSION_NUMBER >= 0x10002000L
+    SSL_CTX_set_alpn_select_cb(ctx, alpn_select_cb, NULL);
+#endif
+
+    tls_clear();
+    ssl_ctx = ctx;
+    return 0;
+error:
+    set_ssl_error();
+    SSL_CTX_free(ctx);
+    return -1;
+}
+
+inline void
+tls_clear(void)
+{
+    if(ssl_ctx){
+        SSL_CTX_free(ssl_ctx);
+        ssl_ctx = NULL;
+    }
+}
+
+inline int
+tls_enabled(void)
+{
+    return ssl_ctx != NULL;
+}
+
+inline void *
+tls_new(int fd)
+{
+    SSL *ssl = SSL_new(ssl_ctx);
+    if(ssl == NULL){
+        ERR_clear_error();
+        return NULL;
+    }
+    if(SSL_set_fd(ssl, fd) != 1){
+        ERR_clear_error();
+        SSL_free(ssl);
+        return NULL;
+    }
+    SSL_set_accept_state(ssl);
+    return ssl;
+}
+
+inline void
+tls_free(void *tls, int shutdown)
+{
+    SSL *ssl = (SSL *)tls;
+    if(shutdown && SSL_is_init_finished(ssl)){
+        //send close_notify, don't wait for the peer
+        SSL_set_quiet_shutdown(ssl, 0);
+        SSL_shutdown(ssl);
+    }
+    ERR_clear_error();
+    SSL_free(ssl);
+}
+
+static inline ssize_t
+tls_result(SSL *ssl, int ret)
+{
+    switch(SSL_get_error(ssl, ret)){
+        case SSL_ERROR_WANT_READ:
+        case SSL_ERROR_WANT_WRITE:
+            errno = EAGAIN;
+            return -1;
+        case SSL_ERROR_ZERO_RETURN:
+            //close_notify
+            return 0;
+        case SSL_ERROR_SYSCALL:
+            ERR_clear_error();
+            if(errno == 0){
+                //unexpected EOF
+                return 0;
+            }
+            return -1;
+        default:
+            ERR_clear_error();
+            errno = ECONNRESET;
+            return -1;
+    }
+}
+
+inline ssize_t
+tls_read(void *tls, char *buf, size_t len)
+{
+    SSL *ssl = (SSL *)tls;
+    int ret;
+
+    errno = 0;
+    ret = SSL_read(ssl, buf, (int)len);
+    if(ret > 0){
+        return ret;
+    }
+    return tls_result(ssl, ret);
+}
+
+inline ssize_t
+tls_write(void *tls, const char *buf, size_t len)
+{
+    SSL *ssl = (SSL *)tls;
+    int ret;
+
+    if(len == 0){
+        return 0;
+    }
+    errno = 0;
+    ret = SSL_write(ssl, buf, (int)len);
+    if(ret > 0){
+        return ret;
+    }
+    ret = tls_result(ssl, ret);
+    if(ret == 0){
+        errno = EPIPE;
+        return -1;
+    }
+    return ret;
+}
+
+inline ssize_t
+tls_writev(void *tls, struct iovec *iov, int iovcnt)
+{
+    ssize_t total = 0, w;
+    int i;
+
+    for(i = 0; i < iovcnt; i++){
+        if(iov[i].iov_len == 0){
+            continue;
+        }
+        w = tls_write(tls, iov[i].iov_base, iov[i].iov_len);
+        if(w < 0){
+            if(total > 0 && errno == EAGAIN){
+                return total;
+            }
+            return w;
+        }
+        total += w;
+        if((size_t)w < iov[i].iov_len){
+            //partial write
+            break;
+        }
+    }
+    return total;
+}
+
+inline int
+tls_pending(void *tls)
+{
+    return SSL_pending((SSL *)tls);
+}
+
+inline int
+tls_want_write(void *tls)
+{
+    return SSL_want_write((SSL *)tls);
+}
+
+#else
+
+inline int
+tls_setup(char *certfile, char *keyfile, char *ciphers)
+{
+    PyErr_SetString(PyExc_NotImplementedError, "meinheld is built without ssl support");
+    return -1;
+}
+
+inline void
+tls_clear(void)
+{
+}
+
+inline int
+tls_enabled(void)
+{
+    return 0;
+}
+
+inline void *
+tls_new(int fd)
+{
+    return NULL;
+}
+
+inline void
+tls_free(void *tls, int shutdown)
+{
+}
+
+inline ssize_t
+tls_read(void *tls, char *buf, size_t len)
+{
+    errno = ENOTSUP;
+    return -1;
+}
+
+inline ssize_t
+tls_write(void *tls, const char *buf, size_t len)
+{
+    errno = ENOTSUP;
+    return -1;
+}
+
+inline ssize_t
+tls_writev(void *tls, struct iovec *iov, int iovcnt)
+{
+    errno = ENOTSUP;
+    return -1;
+}
+
+inline int
+tls_pending(void *tls)
+{
+    return 0;
+}
+
+inline int
+tls_want_write(void *tls)
+{
+    return 0;
+}
+
+#endif
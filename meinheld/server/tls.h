@@ -0,0 +1,43 @@
+#ifndef TLS_H
+#define TLS_H
+
+#include <Python.h>
+#include <sys/uio.h>
+
+/*
+ * TLS termination (OpenSSL), built with WITH_SSL.
+ * tls_read/tls_writev have read(2)/writev(2) semantics,
+ * a handshake or renegotiation in progress returns -1 with EAGAIN.
+ */
+
+inline int
+tls_setup(char *certfile, char *keyfile, char *ciphers);
+
+inline void
+tls_clear(void);
+
+inline int
+tls_enabled(void);
+
+inline void *
+tls_new(int fd);
+
+inline void
+tls_free(void *tls, int shutdown);
+
+inline ssize_t
+tls_read(void *tls, char *buf, size_t len);
+
+inline ssize_t
+tls_write(void *tls, const char *buf, size_t len);
+
+inline ssize_t
+tls_writev(void *tls, struct iovec *iov, int iovcnt);
+
+inline int
+tls_pending(void *tls);
+
+inline int
+tls_want_write(void *tls);
+
+#endif
@@ -0,0 +1,192 @@
+#include "watcher.h"
+#include "log.h"
+#include <math.h>
+
+/*
+ * fd watchers and the per iteration hook of meinheld.eventloop.
+ * fd_callback(fd, events) is called when a watched fd is ready,
+ * tick() runs the ready callbacks after each iteration and returns
+ * the secs until the next timer (None: no timer).
+ */
+
+static PyObject *fd_callback = NULL;
+static PyObject *tick_hook = NULL;
+static PyObject *watched = NULL;    // {fd: events}
+static int next_wait_msec = -1;     // -1: no timer
+
+static inline PyObject*
+call_hook(PyObject *hook, PyObject *args)
+{
+    PyObject *res, *old_client = current_client;
+
+    //not in a request
+    current_client = NULL;
+    res = PyObject_Call(hook, args, NULL);
+    current_client = old_client;
+    if(res == NULL){
+        write_error_log(__FILE__, __LINE__);
+    }
+    return res;
+}
+
+static void
+watcher_callback(picoev_loop* loop, int fd, int events, void* cb_arg)
+{
+    PyObject *args, *res;
+
+    if(fd_callback == NULL){
+        return;
+    }
+    args = Py_BuildValue("(ii)", fd, events & PICOEV_READWRITE);
+    if(args == NULL){
+        write_error_log(__FILE__, __LINE__);
+        return;
+    }
+    res = call_hook(fd_callback, args);
+    Py_DECREF(args);
+    Py_XDECREF(res);
+}
+
+inline int
+watcher_set_hooks(PyObject *fd_cb, PyObject *tick)
+{
+    if(fd_cb == Py_None){
+        fd_cb = NULL;
+    }
+    if(tick == Py_None){
+        tick = NULL;
+    }
+    if((fd_cb && !PyCallable_Check(fd_cb)) || (tick && !PyCallable_Check(tick))){
+        PyErr_SetString(PyExc_TypeError, "must be callable");
+        return -1;
+    }
+    Py_XINCREF(fd_cb);
+    Py_XINCREF(tick);
+    Py_XDECREF(fd_callback);
+    Py_XDECREF(tick_hook);
+    fd_callback = fd_cb;
+    tick_hook = tick;
+    //run the tick on the next iteration
+    next_wait_msec = tick ? 0 : -1;
+    return 0;
+}
+
+/*
+ * watch fd for events (PICOEV_READ | PICOEV_WRITE), 0 stops watching.
+ * loop is NULL when the server is not running, watch on start.
+ */
+inline int
+watcher_watch(picoev_loop *loop, int fd, int events)
+{
+    PyObject *key, *value;
+    int found;
+
+    if(watched == NULL){
+        watched = PyDict_New();
+        if(watched == NULL){
+            return -1;
+        }
+    }
+    key = PyInt_FromLong(fd);
+    if(key == NULL){
+        return -1;
+    }
+    found = PyDict_GetItem(watched, key) != NULL;
+    if(loop){
+        if(!PICOEV_IS_INITED_AND_FD_IN_RANGE(fd)){
+            Py_DECREF(key);
+            PyErr_SetString(PyExc_ValueError, "fileno value out of range ");
+            return -1;
+        }
+        if(picoev_is_active(loop, fd)){
+            if(!found){
+                Py_DECREF(key);
+                PyErr_SetString(PyExc_IOError, "fd is used by the server");
+                return -1;
+            }
+            picoev_del(loop, fd);
+        }
+        if(events && picoev_add(loop, fd, events, 0, watcher_callback, NULL) == -1){
+            PyErr_SetFromErrno(PyExc_IOError);
+            if(found){
+                PyDict_DelItem(watched, key);
+            }
+            Py_DECREF(key);
+            return -1;
+        }
+    }
+    if(events){
+        value = PyInt_FromLong(events);
+        if(value == NULL || PyDict_SetItem(watched, key, value) == -1){
+            Py_XDECREF(value);
+            Py_DECREF(key);
+            return -1;
+        }
+        Py_DECREF(value);
+    }else if(found){
+        PyDict_DelItem(watched, key);
+    }
+    Py_DECREF(key);
+    return 0;
+}
+
+inline void
+watcher_start(picoev_loop *loop)
+{
+    PyObject *key, *value;
+    Py_ssize_t pos = 0;
+    int fd;
+
+    if(watched == NULL){
+        return;
+    }
+    while(PyDict_Next(watched, &pos, &key, &value)){
+        fd = (int)PyInt_AS_LONG(key);
+        if(PICOEV_IS_INITED_AND_FD_IN_RANGE(fd) && !picoev_is_active(loop, fd)){
+            picoev_add(loop, fd, (int)PyInt_AS_LONG(value), 0, watcher_callback, NULL);
+        }
+    }
+}
+
+inline int
+watcher_wait_msec(int max_wait_msec)
+{
+    if(tick_hook == NULL || next_wait_msec < 0 || next_wait_msec > max_wait_msec){
+        return max_wait_msec;
+    }
+    return next_wait_msec;
+}
+
+inline void
+watcher_tick(void)
+{
+    PyObject *args, *res;
+    double secs;
+
+    if(tick_hook == NULL){
+        return;
+    }
+    next_wait_msec = -1;
+    args = PyTuple_New(0);
+    if(args == NULL){
+        write_error_log(__FILE__, __LINE__);
+        return;
+    }
+    res = call_hook(tick_hook, args);
+    Py_DECREF(args);
+    if(res == NULL || res == Py_None){
+        Py_XDECREF(res);
+        return;
+    }
+    secs = PyFloat_AsDouble(res);
+    Py_DECREF(res);
+    if(secs == -1.0 && PyErr_Occurred()){
+        write_error_log(__FILE__, __LINE__);
+        return;
+    }
+    if(secs <= 0){
+        next_wait_msec = 0;
+    }else if(secs < 3600){
+        next_wait_msec = (int)ceil(secs * 1000);
+    }
+}
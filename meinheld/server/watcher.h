@@ -0,0 +1,22 @@
+#ifndef WATCHER_H
+#define WATCHER_H
+
+#include <Python.h>
+#include "server.h"
+
+inline int
+watcher_set_hooks(PyObject *fd_callback, PyObject *tick);
+
+inline int
+watcher_watch(picoev_loop *loop, int fd, int events);
+
+inline void
+watcher_start(picoev_loop *loop);
+
+inline int
+watcher_wait_msec(int max_wait_msec);
+
+inline void
+watcher_tick(void);
+
+#endif
@@ -35,6 +35,7 @@ import sys
 import errno
 from meinheld.socket import socket, _fileobject, timeout, wait_read, wait_write, timeout_default
 from meinheld.socket import error as socket_error, EBADF
+from meinheld.socket import timeout as socket_timeout
 
 
 for name in __imports__[:]:
@@ -55,6 +56,33 @@ del name, value
 
 __all__ = __implements__ + __imports__
 
+# max TLS record payload, read whole records into the buffer
+READ_BLOCK_SIZE = 16384
+
+_len = len
+
+# Python 2.7.9+ has SSLContext and no _ssl.sslwrap
+_has_context = hasattr(__ssl__, 'SSLContext')
+
+_contexts = {}
+
+def _get_context(keyfile, certfile, cert_reqs, ssl_version, ca_certs, ciphers):
+    """Return a cached SSLContext.
+    Loading the cert chain and CA certs is expensive, do it once per settings."""
+    key = (keyfile, certfile, cert_reqs, ssl_version, ca_certs, ciphers)
+    context = _contexts.get(key)
+    if context is None:
+        context = __ssl__.SSLContext(ssl_version)
+        context.verify_mode = cert_reqs
+        if certfile:
+            context.load_cert_chain(certfile, keyfile)
+        if ca_certs:
+            context.load_verify_locations(ca_certs)
+        if ciphers:
+            context.set_ciphers(ciphers)
+        _contexts[key] = context
+    return context
+
 
 class SSLSocket(socket):
 
@@ -62,11 +90,24 @@ class SSLSocket(socket):
                  server_side=False, cert_reqs=CERT_NONE,
                  ssl_version=PROTOCOL_SSLv23, ca_certs=None,
                  do_handshake_on_connect=True,
-                 suppress_ragged_eofs=True):
+                 suppress_ragged_eofs=True, ciphers=None,
+                 server_hostname=None):
         socket.__init__(self, _sock=sock)
 
         if certfile and not keyfile:
             keyfile = certfile
+        self.keyfile = keyfile
+        self.certfile = certfile
+        self.cert_reqs = cert_reqs
+        self.ssl_version = ssl_version
+        self.ca_certs = ca_certs
+        self.ciphers = ciphers
+        self.server_hostname = server_hostname
+        self.do_handshake_on_connect = do_handshake_on_connect
+        self.suppress_ragged_eofs = suppress_ragged_eofs
+        self._makefile_refs = 0
+        self._rbuf = ''
+        self._rpos = 0
         # see if it's connected
         try:
             socket.getpeername(self)
@@ -77,88 +118,86 @@ class SSLSocket(socket):
             self._sslobj = None
         else:
             # yes, create the SSL object
-            if ciphers is None:
-                self._sslobj = _ssl.sslwrap(self._sock, server_side,
-                                            keyfile, certfile,
-                                            cert_reqs, ssl_version, ca_certs)
-            else:
-                self._sslobj = _ssl.sslwrap(self._sock, server_side,
-                                            keyfile, certfile,
-                                            cert_reqs, ssl_version, ca_certs,
-                                            ciphers)
+            self._sslobj = self._wrap(server_side)
             if do_handshake_on_connect:
                 self.do_handshake()
-        self.keyfile = keyfile
-        self.certfile = certfile
-        self.cert_reqs = cert_reqs
-        self.ssl_version = ssl_version
-        self.ca_certs = ca_certs
-        self.ciphers = ciphers
-        self.do_handshake_on_connect = do_handshake_on_connect
-        self.suppress_ragged_eofs = suppress_ragged_eofs
-        self._makefile_refs = 0
 
-    def read(self, len=1024):
-        """Read up to LEN bytes and return them.
-        Return zero-length string on EOF."""
+    def _wrap(self, server_side):
+        if _has_context:
+            context = _get_context(self.keyfile, self.certfile, self.cert_reqs,
+                                   self.ssl_version, self.ca_certs, self.ciphers)
+            return context._wrap_socket(self._sock, server_side, self.server_hostname)
+        if self.ciphers is None:
+            return _ssl.sslwrap(self._sock, server_side,
+                                self.keyfile, self.certfile,
+                                self.cert_reqs, self.ssl_version, self.ca_certs)
+        return _ssl.sslwrap(self._sock, server_side,
+                            self.keyfile, self.certfile,
+                            self.cert_reqs, self.ssl_version, self.ca_certs,
+                            self.ciphers)
+
+    def _sslcall(self, func, *args, **kwargs):
+        """Call the SSL object, wait for the socket the call wants."""
+        timeout = kwargs.get('timeout', self.timeout)
         while True:
             try:
-                return self._sslobj.read(len)
+                return func(*args)
             except SSLError, ex:
-                if ex.args[0] == SSL_ERROR_EOF and self.suppress_ragged_eofs:
-                    return ''
-                elif ex.args[0] == SSL_ERROR_WANT_READ:
-                    if self.timeout == 0.0:
-                        raise
-                    sys.exc_clear()
-                    try:
-                        wait_read(self.fileno(), timeout=self.timeout, event=self._read_event)
-                    except socket_error, ex:
-                        if ex[0] == EBADF:
-                            return ''
-                        raise
+                if ex.args[0] == SSL_ERROR_WANT_READ:
+                    wait = wait_read
                 elif ex.args[0] == SSL_ERROR_WANT_WRITE:
-                    if self.timeout == 0.0:
-                        raise
-                    sys.exc_clear()
-                    try:
-                        wait_write(self.fileno(), timeout=self.timeout, event=self._write_event)
-                    except socket_error, ex:
-                        if ex[0] == EBADF:
-                            return ''
-                        raise
+                    wait = wait_write
                 else:
                     raise
+                if timeout == 0.0:
+                    raise
+                sys.exc_clear()
+                wait(self.fileno(), timeout=timeout)
+
+    def _fill(self, size):
+        """Read a block into the read buffer, return False on EOF."""
+        try:
+            data = self._sslcall(self._sslobj.read, max(size, READ_BLOCK_SIZE))
+        except SSLError, ex:
+            if ex.args[0] == SSL_ERROR_EOF and self.suppress_ragged_eofs:
+                return False
+            raise
+        except socket_error, ex:
+            if ex[0] == EBADF:
+                return False
+            raise
+        self._rbuf = data
+        self._rpos = 0
+        return _len(data) > 0
+
+    def _buffered(self):
+        return _len(self._rbuf) - self._rpos
+
+    def read(self, len=1024):
+        """Read up to LEN bytes and return them.
+        Return zero-length string on EOF."""
+        if not self._buffered() and not self._fill(len):
+            return ''
+        buf, pos = self._rbuf, self._rpos
+        if pos == 0 and len >= _len(buf):
+            self._rbuf = ''
+            return buf
+        data = buf[pos:pos + len]
+        self._rpos = pos + _len(data)
+        if self._rpos >= _len(buf):
+            self._rbuf = ''
+            self._rpos = 0
+        return data
 
     def write(self, data):
         """Write DATA to the underlying SSL channel.  Returns
         number of bytes of DATA actually transmitted."""
-        while True:
-            try:
-                return self._sslobj.write(data)
-            except SSLError, ex:
-                if ex.args[0] == SSL_ERROR_WANT_READ:
-                    if self.timeout == 0.0:
-                        raise
-                    sys.exc_clear()
-                    try:
-                        wait_read(self.fileno(), timeout=self.timeout, event=self._read_event)
-                    except socket_error, ex:
-                        if ex[0] == EBADF:
-                            return 0
-                        raise
-                elif ex.args[0] == SSL_ERROR_WANT_WRITE:
-                    if self.timeout == 0.0:
-                        raise
-                    sys.exc_clear()
-                    try:
-                        wait_write(self.fileno(), timeout=self.timeout, event=self._write_event)
-                    except socket_error, ex:
-                        if ex[0] == EBADF:
-                            return 0
-                        raise
-                else:
-                    raise
+        try:
+            return self._sslcall(self._sslobj.write, data)
+        except socket_error, ex:
+            if ex[0] == EBADF:
+                return 0
+            raise
 
     def getpeercert(self, binary_form=False):
         """Returns a formatted version of the data in the
@@ -181,34 +220,16 @@ class SSLSocket(socket):
                 raise ValueError(
                     "non-zero flags not allowed in calls to send() on %s" %
                     self.__class__)
-            while True:
-                try:
-                    v = self._sslobj.write(data)
-                except SSLError, x:
-                    if x.args[0] == SSL_ERROR_WANT_READ:
-                        if self.timeout == 0.0:
-                            raise timeout(str(x))
-                        sys.exc_clear()
-                        try:
-                            wait_read(self.fileno(), timeout=timeout, event=self._read_event)
-                        except socket_error, ex:
-                            if ex[0] == EBADF:
-                                return 0
-                            raise
-                    elif x.args[0] == SSL_ERROR_WANT_WRITE:
-                        if self.timeout == 0.0:
-                            raise timeout(str(x))
-                        sys.exc_clear()
-                        try:
-                            wait_write(self.fileno(), timeout=timeout, event=self._write_event)
-                        except socket_error, ex:
-                            if ex[0] == EBADF:
-                                return 0
-                            raise
-                    else:
-                        raise
-                else:
-                    return v
+            try:
+                return self._sslcall(self._sslobj.write, data, timeout=timeout)
+            except SSLError, x:
+                if x.args[0] in (SSL_ERROR_WANT_READ, SSL_ERROR_WANT_WRITE):
+                    raise socket_timeout(str(x))
+                raise
+            except socket_error, ex:
+                if ex[0] == EBADF:
+                    return 0
+                raise
         else:
             return socket.send(self, data, flags, timeout)
     # is it possible for sendall() to send some data without encryption if another end shut down SSL?
@@ -226,29 +247,13 @@ class SSLSocket(socket):
                 raise ValueError(
                     "non-zero flags not allowed in calls to recv() on %s" %
                     self.__class__)
-            while True:
-                try:
-                    return self.read(buflen)
-                except SSLError, x:
-                    if x.args[0] == SSL_ERROR_WANT_READ:
-                        sys.exc_clear()
-                        if self.timeout == 0.0:
-                            raise timeout(str(x))
-                        try:
-                            wait_read(self.fileno(), timeout=self.timeout, event=self._read_event)
-                        except socket_error, ex:
-                            if ex[0] == EBADF:
-                                return ''
-                            raise
-                        continue
-                    else:
-                        raise
+            return self.read(buflen)
         else:
             return socket.recv(self, buflen, flags)
 
     def recv_into(self, buffer, nbytes=None, flags=0):
         if buffer and (nbytes is None):
-            nbytes = len(buffer)
+            nbytes = _len(buffer)
         elif nbytes is None:
             nbytes = 1024
         if self._sslobj:
@@ -256,26 +261,22 @@ class SSLSocket(socket):
                 raise ValueError(
                   "non-zero flags not allowed in calls to recv_into() on %s" %
                   self.__class__)
-            while True:
+            if not self._buffered() and _has_context and nbytes >= READ_BLOCK_SIZE:
+                # large read, decrypt into the caller's buffer
                 try:
-                    tmp_buffer = self.read(nbytes)
-                    v = len(tmp_buffer)
-                    buffer[:v] = tmp_buffer
-                    return v
-                except SSLError, x:
-                    if x.args[0] == SSL_ERROR_WANT_READ:
-                        sys.exc_clear()
-                        if self.timeout == 0.0:
-                            raise timeout(str(x))
-                        try:
-                            wait_read(self.fileno(), timeout=self.timeout, event=self._read_event)
-                        except socket_error, ex:
-                            if ex[0] == EBADF:
-                                return 0
-                            raise
-                        continue
-                    else:
-                        raise
+                    return self._sslcall(self._sslobj.read, nbytes, buffer)
+                except SSLError, ex:
+                    if ex.args[0] == SSL_ERROR_EOF and self.suppress_ragged_eofs:
+                        return 0
+                    raise
+                except socket_error, ex:
+                    if ex[0] == EBADF:
+                        return 0
+                    raise
+            tmp_buffer = self.read(nbytes)
+            v = _len(tmp_buffer)
+            buffer[:v] = tmp_buffer
+            return v
         else:
             return socket.recv_into(self, buffer, nbytes, flags)
 
@@ -295,13 +296,13 @@ class SSLSocket(socket):
 
     def pending(self):
         if self._sslobj:
-            return self._sslobj.pending()
+            return self._buffered() + self._sslobj.pending()
         else:
             return 0
 
     def unwrap(self):
         if self._sslobj:
-            s = self._sslobj.shutdown()
+            s = self._sslcall(self._sslobj.shutdown)
             self._sslobj = None
             return socket(_sock=s)
         else:
@@ -314,28 +315,14 @@ class SSLSocket(socket):
     def close(self):
         if self._makefile_refs < 1:
             self._sslobj = None
+            self._rbuf = ''
             socket.close(self)
         else:
             self._makefile_refs -= 1
 
     def do_handshake(self):
         """Perform a TLS/SSL handshake."""
-        while True:
-            try:
-                return self._sslobj.do_handshake()
-            except SSLError, ex:
-                if ex.args[0] == SSL_ERROR_WANT_READ:
-                    if self.timeout == 0.0:
-                        raise
-                    sys.exc_clear()
-                    wait_read(self.fileno(), timeout=self.timeout, event=self._read_event)
-                elif ex.args[0] == SSL_ERROR_WANT_WRITE:
-                    if self.timeout == 0.0:
-                        raise
-                    sys.exc_clear()
-                    wait_write(self.fileno(), timeout=self.timeout, event=self._write_event)
-                else:
-                    raise
+        return self._sslcall(self._sslobj.do_handshake)
 
     def connect(self, addr):
         """Connects to remote ADDR, and then wraps the connection in
@@ -345,14 +332,7 @@ class SSLSocket(socket):
         if self._sslobj:
             raise ValueError("attempt to connect already-connected SSLSocket!")
         socket.connect(self, addr)
-        if self.ciphers is None:
-            self._sslobj = _ssl.sslwrap(self._sock, False, self.keyfile, self.certfile,
-                                        self.cert_reqs, self.ssl_version,
-                                        self.ca_certs)
-        else:
-            self._sslobj = _ssl.sslwrap(self._sock, False, self.keyfile, self.certfile,
-                                        self.cert_reqs, self.ssl_version,
-                                        self.ca_certs, self.ciphers)
+        self._sslobj = self._wrap(False)
         if self.do_handshake_on_connect:
             self.do_handshake()
 
@@ -385,17 +365,18 @@ def wrap_socket(sock, keyfile=None, certfile=None,
                 server_side=False, cert_reqs=CERT_NONE,
                 ssl_version=PROTOCOL_SSLv23, ca_certs=None,
                 do_handshake_on_connect=True,
-                suppress_ragged_eofs=True, ciphers=None):
+                suppress_ragged_eofs=True, ciphers=None,
+                server_hostname=None):
     """Create a new :class:`SSLSocket` instance."""
     return SSLSocket(sock, keyfile=keyfile, certfile=certfile,
                      server_side=server_side, cert_reqs=cert_reqs,
                      ssl_version=ssl_version, ca_certs=ca_certs,
                      do_handshake_on_connect=do_handshake_on_connect,
                      suppress_ragged_eofs=suppress_ragged_eofs,
-                     ciphers=ciphers)
+                     ciphers=ciphers, server_hostname=server_hostname)
 
 
-def get_server_certificate (addr, ssl_version=PROTOCOL_SSLv3, ca_certs=None):
+def get_server_certificate (addr, ssl_version=PROTOCOL_SSLv23, ca_certs=None):
     """Retrieve the certificate from the server at the specified address,
     and return it as a PEM-encoded string.
     If 'ca_certs' is specified, validate the server cert against it.
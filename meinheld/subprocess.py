@@ -0,0 +1,257 @@
+"""Cooperative subprocess.
+
+The pipes of Popen are non-blocking, reads and writes wait for the fd
+with trampoline. wait() parks the greenlet until the SIGCHLD reaper of
+the meinheld loop collected the child.
+"""
+import errno
+import fcntl
+import os
+
+from meinheld import server
+
+__subprocess__ = __import__('subprocess')
+
+PIPE = __subprocess__.PIPE
+STDOUT = __subprocess__.STDOUT
+CalledProcessError = __subprocess__.CalledProcessError
+
+__all__ = ['Popen', 'PIPE', 'STDOUT', 'call', 'check_call', 'check_output',
+           'CalledProcessError']
+
+_BUFSIZE = 65536
+_WOULDBLOCK = (errno.EAGAIN, errno.EWOULDBLOCK)
+
+
+def _set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+class _Pipe(object):
+    """non-blocking end of a child pipe, the file object keeps the fd"""
+
+    def __init__(self, fileobj, universal_newlines=False):
+        self._file = fileobj
+        self._fd = fileobj.fileno()
+        self._universal_newlines = universal_newlines
+        self._buf = ''
+        self._cr = False
+        self._eof = False
+        _set_nonblocking(self._fd)
+
+    @property
+    def closed(self):
+        return self._file.closed
+
+    @property
+    def name(self):
+        return self._file.name
+
+    @property
+    def mode(self):
+        return self._file.mode
+
+    def fileno(self):
+        return self._fd
+
+    def close(self):
+        self._file.close()
+
+    def flush(self):
+        pass
+
+    def _fill(self, block=True):
+        """read a chunk into the buffer, False on EOF"""
+        if self._eof:
+            return False
+        while True:
+            try:
+                data = os.read(self._fd, _BUFSIZE)
+                break
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno not in _WOULDBLOCK:
+                    raise IOError(e.errno, e.strerror)
+                if not block:
+                    return True
+                server.trampoline(self._fd, read=True)
+
+        if not data:
+            self._eof = True
+            if self._cr:
+                self._buf += '\n'
+                self._cr = False
+            return False
+        if self._universal_newlines:
+            # \r\n may be split over two chunks
+            if self._cr:
+                data = '\r' + data
+            self._cr = data.endswith('\r')
+            if self._cr:
+                data = data[:-1]
+            data = data.replace('\r\n', '\n').replace('\r', '\n')
+        self._buf += data
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            while self._fill():
+                pass
+            data, self._buf = self._buf, ''
+            return data
+        while len(self._buf) < size and self._fill():
+            pass
+        data, self._buf = self._buf[:size], self._buf[size:]
+        return data
+
+    def readline(self, size=-1):
+        start = 0
+        while True:
+            i = self._buf.find('\n', start)
+            if i >= 0:
+                end = i + 1
+                break
+            if size is not None and 0 <= size <= len(self._buf):
+                end = size
+                break
+            start = len(self._buf)
+            if not self._fill():
+                end = len(self._buf)
+                break
+        if size is not None and 0 <= size < end:
+            end = size
+        line, self._buf = self._buf[:end], self._buf[end:]
+        return line
+
+    def readlines(self, sizehint=0):
+        lines = []
+        total = 0
+        for line in self:
+            lines.append(line)
+            total += len(line)
+            if 0 < sizehint <= total:
+                break
+        return lines
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def _write(self, data, offset=0, block=True):
+        """write from offset, return the bytes written"""
+        while True:
+            try:
+                return os.write(self._fd, buffer(data, offset))
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno not in _WOULDBLOCK:
+                    raise IOError(e.errno, e.strerror)
+                if not block:
+                    return 0
+                server.trampoline(self._fd, write=True)
+
+    def write(self, data):
+        offset = 0
+        while offset < len(data):
+            offset += self._write(data, offset)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+
+class Popen(__subprocess__.Popen):
+
+    def __init__(self, *args, **kwargs):
+        super(Popen, self).__init__(*args, **kwargs)
+        if self.stdin is not None:
+            self.stdin = _Pipe(self.stdin)
+        if self.stdout is not None:
+            self.stdout = _Pipe(self.stdout, self.universal_newlines)
+        if self.stderr is not None:
+            self.stderr = _Pipe(self.stderr, self.universal_newlines)
+
+    def communicate(self, input=None):
+        readers = [pipe for pipe in (self.stdout, self.stderr) if pipe is not None]
+        writers = []
+        offset = 0
+        if self.stdin is not None:
+            if input:
+                writers.append(self.stdin)
+            else:
+                self.stdin.close()
+
+        while readers or writers:
+            server.wait_fds(readers, writers)
+            if writers:
+                try:
+                    offset += self.stdin._write(input, offset, block=False)
+                except IOError as e:
+                    # the child does not read all of it
+                    if e.errno != errno.EPIPE:
+                        raise
+                    offset = len(input)
+                if offset >= len(input):
+                    self.stdin.close()
+                    writers = []
+            for pipe in readers[:]:
+                if not pipe._fill(block=False):
+                    readers.remove(pipe)
+
+        stdout = stderr = None
+        if self.stdout is not None:
+            stdout = self.stdout.read()
+            self.stdout.close()
+        if self.stderr is not None:
+            stderr = self.stderr.read()
+            self.stderr.close()
+        self.wait()
+        return stdout, stderr
+
+    def wait(self):
+        while self.returncode is None:
+            try:
+                pid, status = server.waitpid(self.pid)
+            except OSError as e:
+                if e.errno != errno.ECHILD:
+                    raise
+                # reaped by someone else, the status is lost
+                status = 0
+            self._handle_exitstatus(status)
+        return self.returncode
+
+
+def call(*popenargs, **kwargs):
+    return Popen(*popenargs, **kwargs).wait()
+
+
+def check_call(*popenargs, **kwargs):
+    retcode = call(*popenargs, **kwargs)
+    if retcode:
+        cmd = kwargs.get("args")
+        if cmd is None:
+            cmd = popenargs[0]
+        raise CalledProcessError(retcode, cmd)
+    return 0
+
+
+def check_output(*popenargs, **kwargs):
+    if 'stdout' in kwargs:
+        raise ValueError('stdout argument not allowed, it will be overridden.')
+    process = Popen(stdout=PIPE, *popenargs, **kwargs)
+    output, unused_err = process.communicate()
+    retcode = process.poll()
+    if retcode:
+        cmd = kwargs.get("args")
+        if cmd is None:
+            cmd = popenargs[0]
+        raise CalledProcessError(retcode, cmd, output=output)
+    return output
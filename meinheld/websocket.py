@@ -1,9 +1,9 @@
 import collections
 import string
 import struct
-from itertools import izip, cycle, imap
 import random
 import socket
+import zlib
 
 try:
     from hashlib import md5, sha1
@@ -20,11 +20,118 @@ import socket
 def _extract_comma(value):
     return [x.strip() for x in value.split(',')]
 
+_DEFLATE_TAIL = '\x00\x00\xff\xff'
+# server_no_context_takeover connections share one deflater per window
+# size, it is reset by Z_FULL_FLUSH after every message
+_shared_deflaters = {}
+
+def _negotiate_deflate(environ, context_takeover=True, window_bits=15):
+    """Pick the first acceptable permessage-deflate (RFC 7692) offer.
+
+    Returns (extension response, deflate params) or (None, None)."""
+    offers = environ.get('HTTP_SEC_WEBSOCKET_EXTENSIONS')
+    if not offers:
+        return None, None
+    for offer in _extract_comma(offers):
+        parts = [x.strip() for x in offer.split(';')]
+        if parts[0] != 'permessage-deflate':
+            continue
+        params = {}
+        for part in parts[1:]:
+            key, _, value = part.partition('=')
+            params[key.strip()] = value.strip().strip('"')
+        server_takeover = context_takeover
+        client_takeover = context_takeover
+        server_bits = window_bits
+        client_bits = None
+        try:
+            for key, value in params.items():
+                if key == 'server_no_context_takeover' and not value:
+                    server_takeover = False
+                elif key == 'client_no_context_takeover' and not value:
+                    client_takeover = False
+                elif key == 'server_max_window_bits':
+                    # zlib can't make 8 bits windows
+                    if not 9 <= int(value) <= 15:
+                        raise ValueError(value)
+                    server_bits = min(server_bits, int(value))
+                elif key == 'client_max_window_bits':
+                    if value and not 8 <= int(value) <= 15:
+                        raise ValueError(value)
+                    client_bits = min(window_bits, int(value or 15))
+                else:
+                    raise ValueError(key)
+        except ValueError:
+            continue
+
+        response = ['permessage-deflate']
+        if not server_takeover:
+            response.append('server_no_context_takeover')
+        if not client_takeover:
+            response.append('client_no_context_takeover')
+        if server_bits != 15 or 'server_max_window_bits' in params:
+            response.append('server_max_window_bits=%d' % server_bits)
+        if client_bits is not None and client_bits != 15:
+            response.append('client_max_window_bits=%d' % client_bits)
+        return '; '.join(response), dict(
+                server_takeover=server_takeover,
+                client_takeover=client_takeover,
+                server_bits=server_bits,
+                client_bits=client_bits or 15)
+    return None, None
+
+def _unmask(data, maskdata):
+    n = len(data)
+    if not n:
+        return data
+    mask = (maskdata * (n // 4 + 1))[:n]
+    x = int(data.encode('hex'), 16) ^ int(mask.encode('hex'), 16)
+    return ('%0*x' % (n * 2, x)).decode('hex')
+
+def broadcast(sockets, message):
+    """Send *message* to every open websocket in *sockets*.
+
+    The frame is packed once per protocol version and compression
+    setting and queued on each connection. The server writes it when
+    the socket is writable, so a slow client does not delay the
+    others. Returns the number of websockets the message was queued
+    on."""
+    frames = {}
+    cnt = 0
+    for ws in sockets:
+        if ws.websocket_closed:
+            continue
+        key = ws._frame_key
+        packed = frames.get(key)
+        if packed is None:
+            packed = ws._pack_message(message)
+            if key is not None:
+                frames[key] = packed
+        try:
+            ws._queue(packed)
+        except IOError:
+            continue
+        cnt += 1
+    return cnt
+
 
 class WebSocketMiddleware(object):
+    """Upgrade websocket requests and set ``wsgi.websocket``.
 
-    def __init__(self, app):
+    With *compress* the permessage-deflate extension is accepted when
+    the client offers it. Messages shorter than *compress_threshold*
+    bytes are sent raw. Without *context_takeover* every message is
+    compressed on its own and the zlib state is shared by all
+    connections, so compression costs no memory per connection.
+    *window_bits* (9-15) caps the LZ77 window of both sides."""
+
+    def __init__(self, app, compress=False, compress_threshold=256,
+            context_takeover=True, window_bits=15):
         self.app = app
+        self.compress = compress
+        self.compress_threshold = compress_threshold
+        self.context_takeover = context_takeover
+        self.window_bits = window_bits
 
     def _extract_number(self, value):
         out = ""
@@ -57,10 +164,17 @@ class WebSocketMiddleware(object):
         else:
             protocol_version = 75
 
+        extension = deflate = None
+        if self.compress and protocol_version == 13:
+            extension, deflate = _negotiate_deflate(environ,
+                    self.context_takeover, self.window_bits)
+            if deflate:
+                deflate['threshold'] = self.compress_threshold
+
         # Get the underlying socket and wrap a WebSocket class around it
         client = environ[CLIENT_KEY]
         sock = socket.fromfd(client.get_fd(), socket.AF_INET, socket.SOCK_STREAM)
-        ws = WebSocket(sock, environ, protocol_version)
+        ws = WebSocket(sock, environ, protocol_version, deflate)
         
         # If it's new-version, we need to work out our challenge response
         if protocol_version == 76:
@@ -110,12 +224,14 @@ class WebSocketMiddleware(object):
                                "Upgrade: websocket\r\n"
                                "Connection: Upgrade\r\n"
                                "Origin: %s\r\n"
-                               "Sec-WebSocket-Accept: %s\r\n"
-                               "\r\n"% (
+                               "Sec-WebSocket-Accept: %s\r\n" % (
                     environ.get('HTTP_ORIGIN'),
                     response))
             if 'HTTP_SEC_WEBSOCKET_PROTOCOL' in environ:
                 handshake_reply += 'Sec-WebSocket-Protocol: %s\r\n' % environ.get('HTTP_SEC_WEBSOCKET_PROTOCOL')
+            if extension:
+                handshake_reply += 'Sec-WebSocket-Extensions: %s\r\n' % extension
+            handshake_reply += '\r\n'
         else: #pragma NO COVER
             raise ValueError("Unknown WebSocket protocol version.") 
         
@@ -277,24 +393,51 @@ class WebSocket(object):
         The full WSGI environment for this request.
 
     """
-    def __init__(self, sock, environ, version=76):
+    def __init__(self, sock, environ, version=76, deflate=None):
         """
         :param socket: The eventlet socket
         :type socket: :class:`eventlet.greenio.GreenSocket`
         :param environ: The wsgi environment
         :param version: The WebSocket spec version to follow (default is 76)
+        :param deflate: The negotiated permessage-deflate params
         """
         self.socket = sock
         self.origin = environ.get('HTTP_ORIGIN')
         self.protocol = environ.get('HTTP_WEBSOCKET_PROTOCOL')
         self.path = environ.get('PATH_INFO')
         self.environ = environ
+        self.client = environ.get(CLIENT_KEY)
         self.version = version
         self.websocket_closed = False
         self._buf = ""
         self._msgs = collections.deque()
+        self._frames = []
+        self._frame_opcode = None
+        self._frame_compressed = False
         #self._sendlock = semaphore.Semaphore()
 
+        # frames of the same key are the same bytes, see broadcast()
+        self._frame_key = version
+        self._deflate = deflate
+        if deflate:
+            bits = deflate['server_bits']
+            if deflate['server_takeover']:
+                self._deflater = zlib.compressobj(
+                        zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -bits)
+                self._frame_key = None
+            else:
+                self._deflater = _shared_deflaters.get(bits)
+                if self._deflater is None:
+                    self._deflater = _shared_deflaters[bits] = zlib.compressobj(
+                            zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -bits)
+                self._frame_key = (version, bits, deflate['threshold'])
+            if deflate['client_takeover']:
+                self._inflater = zlib.decompressobj(-15)
+            else:
+                # a fresh inflater per message, a final block or an error
+                # ends the zlib stream
+                self._inflater = None
+
     def _pack_message(self, message):
         """Pack the message inside ``00`` and ``FF``
 
@@ -310,22 +453,35 @@ class WebSocket(object):
         elif self.version in (13,):
             # payload
             opcode = 2
+            payload = message
             if isinstance(message, unicode):
                 payload = message.encode('utf-8')
                 opcode = 1
             elif not isinstance(message, str):
                 payload = str(message)
 
+            # permessage-deflate
+            rsv = 0
+            if self._deflate and len(payload) >= self._deflate['threshold']:
+                if self._deflate['server_takeover']:
+                    flush = zlib.Z_SYNC_FLUSH
+                else:
+                    # reset the shared state for the next message
+                    flush = zlib.Z_FULL_FLUSH
+                payload = (self._deflater.compress(payload) +
+                        self._deflater.flush(flush))[:-4]
+                rsv = 0x40
+
             # header(fin,maskflag,opcode,length)
             fin = 0x80  #0x80:fin, 0:continuation
-            mask = 0x80  #0:unmasked, 0x80:masked
+            mask = 0  #server frames are not masked
             length = len(payload)
             if length < 126:
-                header = struct.pack(">BB", fin|opcode, mask|length)
+                header = struct.pack(">BB", fin|rsv|opcode, mask|length)
             elif 126 <= length <= 0xffff:
-                header = struct.pack(">BBH", fin|opcode, mask|126, length)
+                header = struct.pack(">BBH", fin|rsv|opcode, mask|126, length)
             elif 0xffff < length <= 0xffffffffffffffff:
-                header = struct.pack(">BBQ", fin|opcode, mask|127, length)
+                header = struct.pack(">BBQ", fin|rsv|opcode, mask|127, length)
             else:
                 #TODO: partial packet
                 raise ValueError("Can't send over 64bit length. (partial packet are not supported)") 
@@ -334,8 +490,7 @@ class WebSocket(object):
             maskdata = ''
             if mask:
                 maskdata = struct.pack(">I", random.randint(0,0xffffffff))
-                masklist = cycle(ord(x) for x in maskdata)
-                payload = ''.join(chr(ord(d)^m) for d,m in izip(payload, masklist))
+                payload = _unmask(payload, maskdata)
 
             packed = header + maskdata + payload
 
@@ -344,6 +499,10 @@ class WebSocket(object):
 
         return packed
 
+    def _pack_frame(self, payload, opcode):
+        """Pack a control frame, it is never compressed"""
+        return struct.pack(">BB", 0x80|opcode, len(payload)) + payload
+
     def _parse_messages(self):
         """ Parses for messages in the buffer *buf*.  It is assumed that
         the buffer contains the start character for a message, but that it
@@ -374,71 +533,92 @@ class WebSocket(object):
                     raise ValueError("Don't understand how to parse this type of message: %r" % buf)
 
         elif self.version in (13,):
-            idx = 0
-            while buf:
-                b1, b2 = struct.unpack('>BB', buf[idx:idx+1])
-                idx += 2
-                fin = bool(b1 & 0x80)  #TODO with opcode==0
+            while len(buf) >= 2:
+                b1, b2 = struct.unpack('>BB', buf[:2])
+                idx = 2
+                fin = bool(b1 & 0x80)
+                rsv1 = bool(b1 & 0x40)  #permessage-deflate
                 opcode = b1 & 0x0f
                 mask = bool(b2 & 0x80)
                 length = (b2 & 0x7f)
                 if length == 126:
-                    length = struct.unpack('>H', buf[idx:idx+2])
-                    idx += 2
+                    if len(buf) < 4:
+                        break
+                    length, = struct.unpack('>H', buf[2:4])
+                    idx = 4
                 elif length == 127:
-                    length = struct.unpack('>Q', buf[dx::idx+8])
-                    idx += 8
+                    if len(buf) < 10:
+                        break
+                    length, = struct.unpack('>Q', buf[2:10])
+                    idx = 10
 
                 if mask:
                     maskdata = buf[idx:idx+4]
                     idx += 4
 
+                if len(buf) < idx + length:
+                    # partial frame
+                    break
                 data = buf[idx:idx+length]
-                idx += length
+                buf = buf[idx+length:]
 
                 if mask:
-                    data = ''.join(chr(d^m) for d,m in izip(
-                                                    imap(ord, data),
-                                                    cycle(imap(ord, maskdata))
-                                                    ))
-
-                if opcode == 0:  #continuation
-                    pass  #TODO with fin
-                elif opcode == 1:  #text
-                    data = data.decode('utf-8', 'replace')
-                elif opcode == 2:  #binary
-                    pass
-                elif opcode == 8:  #close
+                    data = _unmask(data, maskdata)
+
+                if opcode == 8:  #close
                     self.websocket_closed = True
                     #TODO process 2byte close status
                     break
                 elif opcode == 9:  #ping
-                    pass  #TODO
+                    self._queue(self._pack_frame(data, 10))
+                    continue
                 elif opcode == 10: #pong
-                    pass  #TODO
-                else:
+                    continue
+                elif opcode in (1, 2):  #text, binary
+                    self._frame_opcode = opcode
+                    self._frame_compressed = rsv1 and self._deflate is not None
+                    self._frames = []
+                elif opcode != 0:  #continuation
                     raise ValueError("Don't understand how to parse this type of message: %r" % buf)
+
+                self._frames.append(data)
+                if not fin:
+                    continue
+                data = ''.join(self._frames)
+                self._frames = []
+                if self._frame_compressed:
+                    inflater = self._inflater or zlib.decompressobj(-15)
+                    data = inflater.decompress(data + _DEFLATE_TAIL)
+                if self._frame_opcode == 1:
+                    data = data.decode('utf-8', 'replace')
                 msgs.append(data)
-                buf = buf[idx:]
         else:
             raise ValueError("Unknown WebSocket protocol version.") 
 
         self._buf = buf
         return msgs
     
+    def _queue(self, packed):
+        """Queue a packed frame on the connection, frames queued by
+        :func:`broadcast` and :meth:`send` keep their order."""
+        if self.client is None:
+            return self.socket.sendall(packed)
+        self.client.queue_send(packed)
+
+    def _flush(self):
+        """Wait until the queued frames are written."""
+        if self.client is not None:
+            self.client.wait_sent()
+
     def send(self, message):
         """Send a message to the browser.  *message* should be
         convertable to a string; unicode objects should be encodable
         as utf-8."""
         packed = self._pack_message(message)
-        # if two greenthreads are trying to send at the same time
-        # on the same socket, sendlock prevents interleaving and corruption
-        
-        #self._sendlock.acquire()
-        #try:
-        return self.socket.sendall(packed)
-        #finally:
-        #    self._sendlock.release()
+        if self.client is None:
+            return self.socket.sendall(packed)
+        # returns at once unless the queue is over the high watermark
+        self.client.send(packed)
 
     def wait(self):
         """Waits for and deserializes messages. Returns a single
@@ -458,15 +638,16 @@ class WebSocket(object):
 
     def _send_closing_frame(self, ignore_send_errors=False):
         """Sends the closing frame to the client, if required."""
-        if self.version == 76 and not self.websocket_closed:
-            try:
-                self.socket.send("\xff\x00")
-            except IOError:
-                # Sometimes, like when the remote side cuts off the connection,
-                # we don't care about this.
-                if not ignore_send_errors: #pragma NO COVER
-                    raise
-            self.websocket_closed = True
+        try:
+            if self.version == 76 and not self.websocket_closed:
+                self._queue("\xff\x00")
+            self._flush()
+        except IOError:
+            # Sometimes, like when the remote side cuts off the connection,
+            # we don't care about this.
+            if not ignore_send_errors: #pragma NO COVER
+                raise
+        self.websocket_closed = True
 
     def close(self):
         """Forcibly close the websocket; generally it is preferable to
@@ -31,6 +31,22 @@ else:
 library_dirs=['/usr/local/lib']
 include_dirs=[]
 define_macros=[]
+libraries=['z']
+
+def find_openssl():
+    for d in ('/usr/include', '/usr/local/include', '/usr/local/opt/openssl/include'):
+        if os.path.exists(os.path.join(d, 'openssl', 'ssl.h')):
+            return d
+
+if os.environ.get('MEINHELD_NO_SSL') is None:
+    ssl_include = find_openssl()
+    if ssl_include:
+        # native TLS termination (server.set_ssl)
+        define_macros.append(('WITH_SSL', None))
+        if ssl_include != '/usr/include':
+            include_dirs.append(ssl_include)
+            library_dirs.append(os.path.join(os.path.dirname(ssl_include), 'lib'))
+        libraries.extend(['ssl', 'crypto'])
 
 setup(name='meinheld',
     version="0.4.13",
@@ -55,13 +71,21 @@ setup(name='meinheld',
         Extension('meinheld.server',
             sources=['meinheld/server/server.c', poller_file,
                 'meinheld/server/http_parser.c','meinheld/server/http_request_parser.c',
+                'meinheld/server/http_response_parser.c',
                 'meinheld/server/response.c', 'meinheld/server/time_cache.c', 'meinheld/server/log.c',
                 'meinheld/server/buffer.c', 'meinheld/server/request.c',
                 'meinheld/server/client.c', 'meinheld/server/util.c',
-                'meinheld/server/stringio.c'],
+                'meinheld/server/stringio.c', 'meinheld/server/arena.c',
+                'meinheld/server/freelist.c', 'meinheld/server/compress.c',
+                'meinheld/server/input.c', 'meinheld/server/tls.c',
+                'meinheld/server/channel.c', 'meinheld/server/sendqueue.c',
+                'meinheld/server/stream.c', 'meinheld/server/protocol.c',
+                'meinheld/server/watcher.c', 'meinheld/server/timer.c',
+                'meinheld/server/fdwait.c', 'meinheld/server/child.c'],
                 define_macros=define_macros,
                 include_dirs=include_dirs,
                 library_dirs=library_dirs,
+                libraries=libraries,
                 #libraries=["profiler"],
                 #extra_compile_args=["-DDEBUG"],
             )],